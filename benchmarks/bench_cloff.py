@@ -0,0 +1,289 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""Times cloff end to end against a local stand-in upstream.
+
+A local HTTP server plays the Cloudify repositories and GitHub: it
+serves a synthetic manager blueprints tarball referencing synthetic
+resources (with md5 files), optionally adding latency to every request
+and capping its bandwidth. `create`, `modify`, `validate` and the
+throughput of `serve` are then timed and the results are written as
+JSON. Given the results of a previous run, regressions beyond a
+tolerance are reported and make the benchmark exit with 1.
+
+    python -m benchmarks.bench_cloff [--resources 50] [--size-kb 256]
+        [--latency-ms 20] [--bandwidth 50M] [--output results.json]
+        [--baseline previous.json]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tarfile
+import platform
+import tempfile
+import argparse
+import threading
+import urllib2
+from contextlib import closing
+
+from cloff import cloff, server, utils
+
+
+TAG = 'bench'
+RESOURCES_PATH = 'org/bench'
+
+
+class LatencyHandler(server.ResourceRequestHandler):
+    """Delays every request by `latency` seconds and caps the bandwidth of
+    every connection at `connection_bandwidth` bytes per second, like a
+    distant upstream.
+    """
+    latency = 0
+    connection_bandwidth = None
+
+    def send_head(self):
+        if self.latency:
+            time.sleep(self.latency)
+        return server.ResourceRequestHandler.send_head(self)
+
+    def copyfile(self, source, outputfile):
+        if not self.connection_bandwidth:
+            return server.ResourceRequestHandler.copyfile(
+                self, source, outputfile)
+        while True:
+            chunk = source.read(self.throttled_buffer_size)
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            self.bytes_sent += len(chunk)
+            time.sleep(len(chunk) / float(self.connection_bandwidth))
+
+
+def start_server(root, latency=0, bandwidth=None, connection_bandwidth=None,
+                 **kwargs):
+    class Handler(LatencyHandler):
+        pass
+    Handler.latency = latency
+    Handler.connection_bandwidth = connection_bandwidth
+    httpd = server.ResourceServer(
+        root, '127.0.0.1', 0, rate_limit=bandwidth, handler=Handler, **kwargs)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd, 'http://127.0.0.1:{0}'.format(httpd.server_port)
+
+
+def make_upstream(root, url, resources, size, blueprints, large=0):
+    """Writes synthetic resources, their md5 files and a manager blueprints
+    tarball referencing all of them under `root`. With `large`, a resource
+    of that size is referenced last. Returns the url of the tarball.
+    """
+    resources_dir = os.path.join(root, *RESOURCES_PATH.split('/'))
+    os.makedirs(resources_dir)
+    names = []
+    for i in range(resources + (1 if large else 0)):
+        # every fourth resource is a compressible script
+        name = 'resource-{0}.{1}'.format(
+            i, 'sh' if i % 4 == 0 and i < resources else 'rpm')
+        data = 'echo {0}\n'.format(i) * (size // 8) if name.endswith('.sh') \
+            else os.urandom(size if i < resources else large)
+        with open(os.path.join(resources_dir, name), 'wb') as f:
+            f.write(data)
+        with open(os.path.join(resources_dir, name + '.md5'), 'w') as f:
+            f.write('{0}  {1}\n'.format(hashlib.md5(data).hexdigest(), name))
+        names.append(name)
+    inputs = ''.join(
+        '  {0}:\n    default: {1}/{2}/{3}\n'.format(
+            name.replace('.', '_'), url, RESOURCES_PATH, name)
+        for name in names)
+    repo = 'cloudify-manager-blueprints-{0}'.format(TAG)
+    source = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(source, repo))
+        for i in range(blueprints):
+            path = os.path.join(
+                source, repo, 'bench{0}-manager-blueprint.yaml'.format(i))
+            with open(path, 'w') as f:
+                f.write('tosca_definitions_version: cloudify_dsl_1_2\n'
+                        'inputs:\n' + inputs)
+        with closing(tarfile.open(
+                os.path.join(root, 'blueprints.tar.gz'), 'w:gz')) as tar:
+            tar.add(os.path.join(source, repo), arcname=repo)
+    finally:
+        shutil.rmtree(source)
+    return url + '/blueprints.tar.gz', names
+
+
+def timed(func, *args, **kwargs):
+    start, cpu = time.time(), time.clock()
+    func(*args, **kwargs)
+    return {'seconds': time.time() - start, 'cpu_seconds': time.clock() - cpu}
+
+
+def bench_serve(archive, names, clients, rounds):
+    """Downloads every resource `rounds` times from `clients` concurrent
+    clients of a server serving `archive`.
+    """
+    serve_under = tempfile.mkdtemp()
+    try:
+        clo = cloff.Cloff(archive)
+        root = clo._extract_for_serving(serve_under)
+        metadata = clo._get_meta(root)
+        httpd, url = start_server(
+            root, rewrite=(clo._fix_file_server(metadata['file_server']),
+                           None, clo._find_rewritten_files(root, metadata)))
+        paths = ['/resources/{0}/{1}'.format(RESOURCES_PATH, name)
+                 for name in names] * rounds
+        downloaded = []
+
+        def client(paths):
+            for path in paths:
+                with closing(urllib2.urlopen(url + path)) as response:
+                    downloaded.append(len(response.read()))
+
+        start = time.time()
+        threads = [threading.Thread(target=client, args=(paths[i::clients],))
+                   for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        httpd.shutdown()
+        httpd.server_close()
+    finally:
+        shutil.rmtree(serve_under)
+    return {'seconds': elapsed, 'requests': len(downloaded),
+            'bytes': sum(downloaded),
+            'requests_per_second': len(downloaded) / elapsed,
+            'bytes_per_second': sum(downloaded) / elapsed}
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='cloff-bench-')
+    cwd = os.getcwd()
+    upstream_root = os.path.join(workdir, 'upstream')
+    os.makedirs(upstream_root)
+    httpd, url = start_server(
+        upstream_root, latency=args.latency_ms / 1000.0,
+        bandwidth=args.bandwidth,
+        connection_bandwidth=args.connection_bandwidth)
+    try:
+        source, names = make_upstream(
+            upstream_root, url, args.resources, args.size_kb * 1024,
+            args.blueprints, args.large_mb * 1024 ** 2)
+        os.chdir(workdir)
+        archive = os.path.join(workdir, 'cloudify-offline.tar.gz')
+        results = {}
+        results['create'] = timed(
+            cloff.Cloff(source, TAG, prefixes=[url + '/org']).create,
+            file_server='http://10.0.0.1:8000', gzip=args.gzip,
+            workers=args.workers)
+        results['create']['archive_bytes'] = os.path.getsize(archive)
+        results['validate'] = timed(cloff.Cloff(archive).validate)
+        results['modify'] = timed(
+            cloff.Cloff(archive).modify, 'http://10.0.0.2:8000')
+        results['serve'] = bench_serve(
+            archive, names, args.clients, args.rounds)
+    finally:
+        os.chdir(cwd)
+        httpd.shutdown()
+        httpd.server_close()
+        shutil.rmtree(workdir)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns the regressions of `results` compared to `baseline`.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        if result['seconds'] > previous['seconds'] * (1 + tolerance):
+            regressions.append('{0}: {1:.3f}s (was {2:.3f}s)'.format(
+                name, result['seconds'], previous['seconds']))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--resources', type=int, default=50)
+    parser.add_argument('--size-kb', type=int, default=256)
+    parser.add_argument('--blueprints', type=int, default=2)
+    parser.add_argument('--large-mb', type=int, default=0,
+                        help='Add a resource this large, referenced last.')
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--bandwidth', type=utils.parse_size, default=None,
+                        help='Upstream bandwidth in bytes/sec (e.g. 50M).')
+    parser.add_argument('--connection-bandwidth', type=utils.parse_size,
+                        default=None,
+                        help='Upstream bandwidth per connection.')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--rounds', type=int, default=2)
+    parser.add_argument('--output', help='Write the results to this file.')
+    parser.add_argument('--baseline',
+                        help='Results of a previous run to compare with.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Slowdown (0.2 is 20%%) reported as regression.')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.basicConfig(stream=sys.stderr)
+    else:
+        logging.getLogger('user').addHandler(logging.NullHandler())
+        logging.getLogger('user').propagate = False
+
+    results = run(args)
+    report = {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'params': dict((k, v) for k, v in vars(args).items()
+                       if k not in ('output', 'baseline', 'verbose')),
+        'results': results,
+    }
+    print('{0:<10} {1:>10} {2:>10}'.format('phase', 'seconds', 'cpu'))
+    for name, result in sorted(results.items()):
+        print('{0:<10} {1:>10.3f} {2:>10}'.format(
+            name, result['seconds'], '{0:.3f}'.format(result['cpu_seconds'])
+            if 'cpu_seconds' in result else '-'))
+    print('serve: {0:.1f} requests/s, {1:.1f} MB/s'.format(
+        results['serve']['requests_per_second'],
+        results['serve']['bytes_per_second'] / 1024 ** 2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'],
+                                  args.tolerance)
+        for regression in regressions:
+            print('REGRESSION {0}'.format(regression))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
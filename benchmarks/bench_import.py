@@ -0,0 +1,151 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""Measures how long cloff takes to start.
+
+Times importing `cloff.cloff` and running `cloff --help`, each in a
+fresh interpreter, and checks that none of the modules only some
+commands need were imported. Exits with 1 if the median time of either
+exceeds `--max-ms`, if it is slower than the results of a previous run
+beyond a tolerance, or if a lazy module was imported.
+
+    python -m benchmarks.bench_import [--runs 20] [--max-ms 150]
+        [--output results.json] [--baseline previous.json]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+# modules which must only be imported by the commands using them
+LAZY_MODULES = ('yaml', 'cloff.dictconfig', 'cloff.server', 'cProfile',
+                'pstats')
+
+SCENARIOS = {
+    'import': 'import cloff.cloff\n',
+    'help': (
+        'from cloff import cloff\n'
+        'try:\n'
+        '    cloff.main(["--help"])\n'
+        'except SystemExit:\n'
+        '    pass\n'),
+}
+
+REPORT_MODULES = (
+    'import sys\n'
+    'sys.stderr.write(" ".join(\n'
+    '    m for m in {0!r} if sys.modules.get(m)))\n').format(LAZY_MODULES)
+
+
+def _run(code):
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(
+            [sys.executable, '-c', code], stdout=devnull,
+            stderr=subprocess.PIPE)
+        _, err = process.communicate()
+    if process.returncode:
+        raise RuntimeError(err)
+    return err
+
+
+def time_startup(code, runs):
+    """Returns the median wall time, in milliseconds, of running `code`
+    in a new interpreter.
+    """
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        _run(code)
+        times.append((time.time() - start) * 1000)
+    return sorted(times)[len(times) // 2]
+
+
+def imported_lazy_modules(code):
+    return _run(code + REPORT_MODULES).split()
+
+
+def run(args):
+    results = {}
+    baseline_ms = time_startup('pass', args.runs)
+    for name, code in sorted(SCENARIOS.items()):
+        ms = time_startup(code, args.runs)
+        results[name] = {
+            'ms': ms,
+            # what cloff adds to starting the interpreter
+            'cloff_ms': ms - baseline_ms,
+            'lazy_modules_imported': imported_lazy_modules(code),
+        }
+    return results
+
+
+def check(results, baseline, max_ms, tolerance):
+    """Returns the problems found in `results`.
+    """
+    problems = []
+    for name, result in sorted(results.items()):
+        if result['lazy_modules_imported']:
+            problems.append('{0}: imported {1}'.format(
+                name, ', '.join(result['lazy_modules_imported'])))
+        if max_ms and result['ms'] > max_ms:
+            problems.append('{0}: {1:.1f}ms (max {2:.1f}ms)'.format(
+                name, result['ms'], max_ms))
+        previous = (baseline or {}).get(name)
+        if previous and \
+                result['cloff_ms'] > previous['cloff_ms'] * (1 + tolerance):
+            problems.append('{0}: {1:.1f}ms (was {2:.1f}ms)'.format(
+                name, result['cloff_ms'], previous['cloff_ms']))
+    return problems
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='Fail if a median startup time exceeds this.')
+    parser.add_argument('--output', help='Write the results to this file.')
+    parser.add_argument('--baseline',
+                        help='Results of a previous run to compare with.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Slowdown (0.2 is 20%%) reported as regression.')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    print('{0:<8} {1:>10} {2:>10}'.format('scenario', 'ms', 'cloff ms'))
+    for name, result in sorted(results.items()):
+        print('{0:<8} {1:>10.1f} {2:>10.1f}'.format(
+            name, result['ms'], result['cloff_ms']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'timestamp': time.time(),
+                       'python': platform.python_version(),
+                       'results': results}, f, indent=2, sort_keys=True)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    problems = check(results, baseline, args.max_ms, args.tolerance)
+    for problem in problems:
+        print('REGRESSION {0}'.format(problem))
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
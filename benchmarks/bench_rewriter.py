@@ -0,0 +1,114 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""Measures url rewriting throughput on large synthetic blueprints.
+
+Compares `cloff.rewriter.UrlRewriter` with the regex alternation based
+approach it replaced, for a growing number of url prefixes spread over
+50 hosts or all under the same host.
+
+    python -m benchmarks.bench_rewriter [--size-mb 8] [--repeat 3]
+"""
+
+import re
+import sys
+import time
+import random
+import argparse
+
+from cloff import rewriter
+
+
+def make_prefixes(count, hosts=50):
+    prefixes = ['http://repository.cloudifysource.org/org',
+                'http://www.getcloudify.org/spec']
+    for i in range(count - len(prefixes)):
+        prefixes.append('http://mirror{0}.example.com/path{1}'.format(
+            i % hosts, i))
+    return prefixes
+
+
+def make_blueprint(prefixes, size):
+    random.seed(0)
+    lines = ['inputs:']
+    length = 0
+    i = 0
+    while length < size:
+        if i % 3:
+            url = '{0}/dir{1}/resource-{1}.rpm'.format(
+                random.choice(prefixes), i)
+        else:
+            url = 'http://unrelated.example.org/file-{0}.tar.gz'.format(i)
+        line = "  input_{0}:\n    default: '{1}'\n    description: x".format(
+            i, url)
+        lines.append(line)
+        length += len(line) + 1
+        i += 1
+    return '\n'.join(lines)
+
+
+def legacy(content, prefixes, file_server):
+    urls = re.findall(r'(\'?https?://[^\s\'\""]+\'?)', content)
+    urls = [u.strip("'").strip('"').rstrip('\n\r') for u in urls]
+    urls = [u for u in urls if u.startswith(tuple(prefixes))]
+    content = re.sub(r'{0}'.format('|'.join(prefixes)),
+                     file_server + 'resources', content)
+    return content, urls
+
+
+def single_pass(content, prefixes, file_server):
+    engine = rewriter.UrlRewriter(prefixes)
+    return engine.rewrite(
+        content, lambda prefix, url: file_server + 'resources' +
+        url[len(prefix):])
+
+
+def measure(func, content, prefixes, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        _, urls = func(content, prefixes, 'http://10.0.0.1:8000/')
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(urls)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size-mb', type=float, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--prefixes', type=int, nargs='+',
+                        default=[2, 20, 200, 800])
+    args = parser.parse_args(argv)
+
+    print('{0:>9} {1:>6} {2:>10} {3:>8} {4:>12} {5:>12}'.format(
+        'prefixes', 'hosts', 'size (MB)', 'urls', 'legacy MB/s',
+        'single MB/s'))
+    for count in args.prefixes:
+        for hosts in (50, 1):
+            prefixes = make_prefixes(count, hosts)
+            content = make_blueprint(prefixes, int(args.size_mb * 1024 ** 2))
+            size = len(content) / 1024.0 ** 2
+            legacy_time, _ = measure(legacy, content, prefixes, args.repeat)
+            single_time, urls = measure(
+                single_pass, content, prefixes, args.repeat)
+            print('{0:>9} {1:>6} {2:>10.1f} {3:>8} {4:>12.1f} '
+                  '{5:>12.1f}'.format(count, hosts, size, urls,
+                                      size / legacy_time,
+                                      size / single_time))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
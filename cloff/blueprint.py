@@ -0,0 +1,163 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import urlparse
+import threading
+from collections import namedtuple, OrderedDict
+
+from . import logger, utils
+
+
+yaml = utils.LazyModule('yaml')
+
+lgr = logger.init()
+
+
+def normalize_url(url):
+    """Strips surrounding whitespace and quotes from a url and lowercases
+    its scheme and host.
+    """
+    url = url.strip().strip('\'"').rstrip('\n\r')
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    return urlparse.urlunsplit(
+        (scheme.lower(), netloc.lower(), path, query, fragment))
+
+
+class Location(namedtuple('Location', 'blueprint path line')):
+    """Where a url appears in a blueprint.
+
+    `path` is the list of keys (and sequence indices) leading to the
+    scalar holding the url, e.g. `['inputs', 'rpm', 'default']`.
+    """
+
+    @property
+    def input(self):
+        if len(self.path) > 1 and self.path[0] == 'inputs':
+            return self.path[1]
+
+    @property
+    def node(self):
+        if len(self.path) > 1 and self.path[0] == 'node_templates':
+            return self.path[1]
+
+    @property
+    def property_path(self):
+        return '.'.join(str(p) for p in self.path[2:])
+
+    def __str__(self):
+        return '{0}:{1} ({2})'.format(
+            self.blueprint, self.line, '.'.join(str(p) for p in self.path))
+
+
+class UrlIndex(object):
+    """Maps normalised resource urls to their locations in blueprints.
+
+    Urls are kept in the order they were first found. The index may be
+    shared by threads indexing different blueprints. It can be seeded
+    with `urls` known in advance, which are then never reported as new.
+    """
+
+    def __init__(self, urls=()):
+        self._lock = threading.Lock()
+        self.locations = OrderedDict((url, []) for url in urls)
+
+    def add(self, url, location):
+        """Records a location of `url`. Returns True if `url` is new.
+        """
+        with self._lock:
+            new = url not in self.locations
+            self.locations.setdefault(url, []).append(location)
+            return new
+
+    def __contains__(self, url):
+        return url in self.locations
+
+    def __iter__(self):
+        return iter(list(self.locations))
+
+    def __len__(self):
+        return len(self.locations)
+
+    def to_dict(self):
+        return OrderedDict(
+            (url, [str(location) for location in locations])
+            for url, locations in self.locations.items())
+
+
+def loader():
+    """Returns the LibYAML based loader, which is much faster, if it is
+    available.
+    """
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def _walk(node, path):
+    if isinstance(node, yaml.MappingNode):
+        for key, value in node.value:
+            for item in _walk(value, path + [key.value]):
+                yield item
+    elif isinstance(node, yaml.SequenceNode):
+        for i, value in enumerate(node.value):
+            for item in _walk(value, path + [i]):
+                yield item
+    elif isinstance(node, yaml.ScalarNode):
+        yield node, path
+
+
+def index_urls(content, rewriter, index, name='<blueprint>'):
+    """Indexes the resource urls of a blueprint.
+
+    The blueprint is composed once and every scalar in it is scanned for
+    urls matching `rewriter`'s prefixes. Urls in comments are ignored.
+    Each url is added to `index` along with its location, and yielded
+    the first time it is seen (in this or any other blueprint sharing
+    `index`) so that it can be handled right away.
+    """
+    Loader = loader()
+    lgr.debug('Indexing urls in {0} using {1}'.format(name, Loader.__name__))
+    root = yaml.compose(content, Loader=Loader)
+    if root is None:
+        return
+    for node, path in _walk(root, []):
+        for url in rewriter.find(node.value):
+            url = normalize_url(url)
+            location = Location(name, path, node.start_mark.line + 1)
+            if index.add(url, location):
+                yield url
+
+
+def validate(content, path='<blueprint>'):
+    """Verifies that `content` is valid YAML without constructing it.
+
+    Raises a `yaml.YAMLError` describing the problem if it is not.
+    """
+    Loader = loader()
+    lgr.debug('Validating {0} using {1}'.format(path, Loader.__name__))
+    try:
+        yaml.compose(content, Loader=Loader)
+    except yaml.YAMLError as ex:
+        lgr.error('{0} is not valid YAML: {1}'.format(path, ex))
+        raise
+
+
+def write(path, content):
+    """Validates and writes a rewritten blueprint.
+
+    The content is written as is so that key order, formatting and
+    comments of the original blueprint are preserved.
+    """
+    validate(content, path)
+    with open(path, 'w') as f:
+        f.write(content)
@@ -0,0 +1,117 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from . import logger, utils
+
+
+DEFAULT_CACHE_DIR = os.path.join('~', '.cloff', 'cache')
+DEFAULT_CACHE_SIZE = 10 * 1024 ** 3
+
+lgr = logger.init()
+
+
+class ResourceCache(object):
+    """A content addressed cache of downloaded resources.
+
+    Resources are stored under `<root>/<md5[:2]>/<md5>` so that the same
+    content is only stored once, whatever url it was downloaded from.
+    Entries are written to a temporary file and renamed into place, so
+    concurrent builds sharing a cache never see partial entries.
+
+    With `max_size`, `trim` evicts the least recently used entries
+    (by their mtime, which is touched on every hit) until the cache
+    fits in it.
+    """
+
+    def __init__(self, root, max_size=None):
+        self.root = os.path.expanduser(root)
+        self.max_size = max_size
+
+    def path(self, md5):
+        return os.path.join(self.root, md5[:2], md5)
+
+    def __contains__(self, md5):
+        return os.path.isfile(self.path(md5))
+
+    def get(self, md5, size=None):
+        """Returns an open file with the content hashed `md5`, or None.
+
+        Entries not matching `size` (if given) are ignored.
+        """
+        path = self.path(md5)
+        if not os.path.isfile(path) or \
+                size is not None and os.path.getsize(path) != size:
+            return None
+        lgr.debug('Cache hit for %s', md5)
+        try:
+            os.utime(path, None)
+        except OSError:
+            # evicted by a concurrent build, or a read only cache
+            pass
+        return open(path, 'rb')
+
+    def put(self, md5, fileobj):
+        """Stores the content of `fileobj` (which is rewound) as `md5`.
+        """
+        path = self.path(md5)
+        if os.path.isfile(path):
+            return
+        utils.makedirs(os.path.dirname(path))
+        fd, partial = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                fileobj.seek(0)
+                shutil.copyfileobj(fileobj, f, utils.CHUNK_SIZE)
+            os.rename(partial, path)
+        except Exception:
+            if os.path.isfile(partial):
+                os.remove(partial)
+            raise
+        finally:
+            fileobj.seek(0)
+
+    def trim(self):
+        """Evicts the least recently used entries until the cache is no
+        larger than `max_size`. Returns the number of bytes evicted.
+        """
+        if not self.max_size or not os.path.isdir(self.root):
+            return 0
+        entries = []
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total - evicted <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            evicted += size
+        if evicted:
+            lgr.info('Evicted {0} bytes from the cache at {1}'.format(
+                evicted, self.root))
+        return evicted
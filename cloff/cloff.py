@@ -22,20 +22,23 @@
 
 import logging
 import os
-import re
+import glob
+import fnmatch
 import tempfile
 import json
 import urlparse
 import shutil
-import sys
+import time
 import hashlib
+import tarfile
+import threading
+from StringIO import StringIO
+from contextlib import closing
 
 import click
-import sh
-import yaml
-from retrying import retry
 
-from . import logger, utils
+from . import (logger, utils, pipeline, rewriter, blueprint, crawler, cache,
+               lockfile, planner, timing, profiling, events, hosts, mirrors)
 
 
 DEFAULT_MP_URL = 'http://github.com/cloudify-cosmo/cloudify-manager-blueprints/archive/{0}.tar.gz'  # NOQA
@@ -43,183 +46,926 @@ FILE_SERVER_MODIFIERS = [
     'http://repository.cloudifysource.org/org',
     'http://www.getcloudify.org/spec',
 ]
+# parts of the manager blueprints repo which are not needed for bootstrapping
+MANAGER_BLUEPRINTS_EXCLUDES = [
+    '.*', 'tests', 'docs', '*.md', '*.rst', 'tox.ini', 'circle.yml',
+    'dev-requirements.txt',
+]
+MANAGER_BLUEPRINT_PATTERN = '*-manager-blueprint.yaml'
+# the console and file formatters of each `--log-format`
+LOG_FORMATS = {
+    'text': ('console', 'file'),
+    'json': ('json', 'json'),
+    'json-file': ('console', 'json'),
+}
 
 lgr = logger.init()
 
 
 class Cloff():
-    def __init__(self, source=DEFAULT_MP_URL, tag=None, verbose=False):
+    def __init__(self, source=DEFAULT_MP_URL, tag=None, verbose=False,
+                 prefixes=None):
         if verbose:
             lgr.setLevel(logging.DEBUG)
         else:
             lgr.setLevel(logging.INFO)
         self.tag = tag
         self.source = source.format(tag) if tag else source
+        # urls starting with these are downloaded and served by cloff
+        self.prefixes = prefixes or FILE_SERVER_MODIFIERS
+        self.rewriter = rewriter.UrlRewriter(self.prefixes)
+        # per-phase timings of the last operation
+        self.report = timing.Report()
+        # concurrency and retries of the downloads of the last operation
+        self.hosts = hosts.Hosts(pipeline.DEFAULT_WORKERS)
+        # where resources under mirrored prefixes are downloaded from
+        self.mirrors = mirrors.Mirrors(())
+        self._on_event = None
+        self._emit = events.emitter(None)
 
-    def _get_simple_manager_blueprint(self, tmp):
-            manager_blueprints_archive = os.path.join(tmp, 'mp.tar.gz')
-            if not os.path.isfile(manager_blueprints_archive):
-                utils.download_file(self.source, manager_blueprints_archive)
-            else:
-                lgr.info('{0} already exists. Skipping...'.format(
-                    manager_blueprints_archive))
-            utils.untar(manager_blueprints_archive, tmp)
-            os.remove(manager_blueprints_archive)
-
-            # load simple manager blueprint
-            manager_blueprints = os.path.join(
-                tmp,
-                'cloudify-manager-blueprints-{0}'.format(self.tag))
-            simple_manager_blueprint_path = os.path.join(
-                manager_blueprints, 'simple-manager-blueprint.yaml')
-            lgr.debug('Loading Blueprint: {0}'.format(
-                simple_manager_blueprint_path))
-            return simple_manager_blueprint_path
-
-    def create(self, file_server='http://10.0.2.2:8000/'):
+    def _is_manager_blueprints_member(self, name):
+        parts = name.split('/')[1:]
+        return not any(fnmatch.fnmatch(part, pattern)
+                       for part in parts
+                       for pattern in MANAGER_BLUEPRINTS_EXCLUDES)
+
+    def _is_manager_blueprint(self, name):
+        parts = name.split('/')
+        return len(parts) == 2 and \
+            fnmatch.fnmatch(parts[1], MANAGER_BLUEPRINT_PATTERN)
+
+    def _find_manager_blueprints(self, manager_blueprints):
+        return sorted(glob.glob(os.path.join(
+            manager_blueprints, MANAGER_BLUEPRINT_PATTERN)))
+
+    def _get_manager_blueprints(self, tmp, on_read=None):
+        """Streams the manager blueprints archive into `tmp` and returns the
+        paths of all manager blueprints found in it.
+
+        The archive is extracted as it is downloaded, skipping the parts
+        of the repo not needed for bootstrapping.
+        """
+        reads = []
+
+        def _on_read(size, seconds):
+            reads.append((size, seconds))
+            self._emit(events.BYTES, self.source, size)
+            if on_read:
+                on_read(size, seconds)
+
+        start, cpu = time.time(), timing.thread_cpu_time()
+        utils.untar_stream(
+            self.source, tmp,
+            include=self._is_manager_blueprints_member, on_read=_on_read)
+        # time spent reading the source is fetching, the rest is untarring.
+        # reading mostly waits for the network, so the CPU time is taken
+        # to be untarring.
+        fetched = sum(size for size, _ in reads)
+        fetching = sum(seconds for _, seconds in reads)
+        self.report.add('fetch', fetching, size=fetched, start=start,
+                        end=start + fetching)
+        self.report.add('untar', time.time() - start - fetching,
+                        timing.thread_cpu_time() - cpu, fetched,
+                        start=start)
+        manager_blueprints = os.path.join(
+            tmp, 'cloudify-manager-blueprints-{0}'.format(self.tag))
+        blueprints = self._find_manager_blueprints(manager_blueprints)
+        if not blueprints:
+            raise IOError('No manager blueprints found in {0}'.format(
+                self.source))
+        lgr.debug('Loading Blueprints: {0}'.format(', '.join(blueprints)))
+        return blueprints
+
+    def create(self, file_server='http://10.0.2.2:8000/', gzip=False,
+               workers=pipeline.DEFAULT_WORKERS,
+               spool_size=pipeline.DEFAULT_SPOOL_SIZE,
+               depth=crawler.DEFAULT_DEPTH, cache_dir=None, write_lock=None,
+               from_lock=None, on_event=None,
+               retry_budget=hosts.DEFAULT_RETRY_BUDGET, mirrors=None,
+               cache_size=None):
+        """Creates an archive with everything needed to bootstrap offline.
+
+        All manager blueprints in the repo are handled. They are parsed
+        in parallel into a single index of resource urls and their
+        locations, so resources shared between blueprints are only
+        downloaded once. The index drives the rewriting of the
+        blueprints and is stored in the archive's metadata.
+
+        Resources are crawled: the scripts and config files in the repo
+        are scanned and rewritten like the blueprints, and downloaded
+        scripts, configs and archives are scanned for more urls, up to
+        `depth` levels deep. Downloaded scripts and configs are rewritten
+        (and their md5 files updated). Archives are only scanned.
+
+        Creation is pipelined: urls are sized with HEAD requests as soon
+        as they are found in the repo, `workers` threads download and
+        verify them, and every finished download is handed straight to
+        a single thread writing the archive (downloads wait for it once
+        `2 * workers` files are queued). Downloads start once the
+        repo was scanned, largest first (with sizes taken from the lock
+        if there is one), so that no large resource is left to download
+        last. One of the workers takes the smallest resources instead,
+        starting right away.
+
+        How many of the workers download from the same host at once
+        adapts to the host's throughput and failures (see `hosts.Hosts`).
+        Failed downloads are retried with backoff for up to
+        `retry_budget` seconds.
+
+        `mirrors` is a list of `(prefix, mirror)` tuples. Resources under
+        a mirrored prefix are downloaded from the fastest of its mirrors
+        and the prefix itself, as probed with the first resource under it,
+        failing over to the next ones (see `mirrors.Mirrors`). Only
+        resources with an md5 file, or locked ones, are taken from
+        mirrors, and they are always verified against the md5 of the
+        canonical resource.
+
+        Resources are not staged on disk. Each download is kept in memory
+        (resources larger than `spool_size` spill to a temporary file
+        which is removed as soon as it was archived) and verified before
+        being written to the archive. The rewritten blueprints and the
+        metadata are appended last.
+
+        With `cache_dir`, downloads are stored in (and, when their md5 is
+        known upfront, taken from) a content addressed cache. Downloads
+        are stored from a separate thread once they were archived, and
+        the least recently used entries are evicted once the cache grows
+        beyond `cache_size` bytes.
+
+        With `write_lock`, the resolved resources (urls, sizes and md5s)
+        are recorded in a lock file. With `from_lock`, the source, tag,
+        prefixes and depth recorded in the lock are used and all locked
+        resources are fetched right away, without waiting for the repo
+        to be discovered. Any resource whose content changed, or any url
+        missing from the lock, fails the build.
+
+        `on_event` is called with an `events.Event` for every resource
+        queued, verified, taken from the cache and archived, and for every
+        chunk read from the repo or a resource. It is called from the
+        worker threads, so it must be thread safe and should be quick.
+        """
+        self.report = timing.Report('create')
+        self.hosts = hosts.Hosts(workers, retry_budget)
+        self._listen(on_event)
+        locked = self._use_lock(from_lock)
+        self._use_mirrors(mirrors)
+        if locked:
+            depth = locked['depth']
+        resource_cache = cache.ResourceCache(cache_dir, cache_size) \
+            if cache_dir else None
         tmp = tempfile.mkdtemp(prefix='cloudify-offline-')
         if not os.path.isdir(tmp):
             os.makedirs(tmp)
         lgr.debug('Using temp dir: {0}'.format(tmp))
+        archive = None
+        created = False
+        # stopped if creation fails, so that nothing is left downloading
+        pools = []
 
         try:
-            simple_manager_blueprint_path = \
-                self._get_simple_manager_blueprint(tmp)
-            with open(simple_manager_blueprint_path) as f:
-                content = f.read()
-
-            urls = self._get_urls_from_file(content)
-            # meh. need to strip some stuff here as no one is perfect in
-            # writing yaml
-            urls = [u.strip("'").strip('"').rstrip('\n\r') for u in urls]
-
-            def _handle_url(url):
-                relative_path = \
-                    self._get_relative_path_from_url(url).lstrip('/')
-                destination_dir = os.path.join(
-                    tmp, 'resources', os.path.dirname(relative_path))
-                destination_path = os.path.join(
-                    destination_dir, os.path.basename(relative_path))
-                if os.path.isfile(destination_path):
-                    lgr.warn('{0} already exists. Skipping...'.format(
-                        destination_path))
+            contents = {}
+            # downloads wait for the archiver once it falls behind
+            archive = pipeline.ArchiveWriter(
+                'cloudify-offline.tar.gz', tmp, self.report, self._emit,
+                maxsize=2 * workers)
+            archived = set()
+            resolved = dict(locked['resources']) if locked else {}
+            index = blueprint.UrlIndex(
+                locked['resources'] if locked else ())
+            lock = threading.Lock()
+
+            def _archive(relative_path, fileobj, size, name=None,
+                         on_archived=None):
+                # compress before queuing as the archiver closes `fileobj`
+                compressed = None
+                if gzip and utils.is_compressible(relative_path):
+                    with self.report.phase('gzip', size):
+                        compressed = utils.gzip_fileobj(fileobj, spool_size)
+                archive.add_file(relative_path, fileobj, size, name,
+                                 on_archived)
+                if compressed:
+                    archive.add_file(
+                        relative_path + '.gz', compressed,
+                        utils.get_size(compressed))
+
+            def _queue(urls, depth):
+                for url in urls:
+                    if locked:
+                        # locked urls are already queued, so this is new
+                        raise IOError('{0} is not in lock file {1}'.format(
+                            url, from_lock))
+                    if depth == 1:
+                        sizes.put(url)
+                    else:
+                        # found while downloading, which is not held up
+                        # by sizing in the download thread
+                        _put(url, depth, self._get_size(url))
+
+            def _put(url, depth, size):
+                self._emit(events.QUEUED, url, size)
+                downloads.put((url, depth), size=size)
+
+            def _crawl(relative_path, data, size, md5, depth):
+                # urls found in a resource are one level deeper than it
+                if crawler.is_archive(relative_path):
+                    urls = []
+                    with self.report.phase('scan', size):
+                        for member, content in crawler.read_archive(
+                                data, relative_path):
+                            urls.extend(crawler.index_file(
+                                content, self.rewriter, index,
+                                '{0}!{1}'.format(relative_path, member)))
+                    _queue(urls, depth + 1)
+                    return data, size, md5
+                if not crawler.is_scannable(relative_path) or \
+                        size > crawler.MAX_SCAN_SIZE:
+                    return data, size, md5
+                # the caller closes `data`, which may still be cached
+                content = data.read()
+                data.seek(0)
+                with self.report.phase('scan', size):
+                    urls = crawler.index_file(
+                        content, self.rewriter, index, relative_path)
+                _queue(urls, depth + 1)
+                rewritten = self._modify_file_server(
+                    relative_path, content, file_server, index)
+                if md5 and rewritten != content:
+                    md5 = md5.replace(
+                        md5.split()[0], hashlib.md5(rewritten).hexdigest())
+                return StringIO(rewritten), len(rewritten), md5
+
+            def _handle_url(item):
+                url, depth = item
+                relative_path = self._get_resource_path(url)
+                # resources which are not archived are locked without a size
+                entry = {'path': relative_path, 'size': None, 'md5': None,
+                         'md5_file': None, 'depth': depth}
+                with lock:
+                    resolved[url] = entry
+                    if relative_path in archived:
+                        lgr.warn('{0} already exists. Skipping...'.format(
+                            relative_path))
+                        return
+                    archived.add(relative_path)
+                if locked:
+                    resource = self._fetch_locked_resource(
+                        url, locked['resources'][url], spool_size,
+                        resource_cache)
+                else:
+                    resource = self._download_manager_resource(
+                        url, spool_size, resource_cache)
+                if not resource:
                     return
-                # only handle url with relevant prefix (i.e, manager resources)
-                if url.startswith(tuple(FILE_SERVER_MODIFIERS)):
-                    if not os.path.isdir(destination_dir):
-                        lgr.debug('Creating: {0}'.format(destination_dir))
-                        os.makedirs(destination_dir)
-                    self._download_manager_resource(url, destination_path)
-
-            for url in urls:
-                _handle_url(url)
-            self._modify_file_server(
-                simple_manager_blueprint_path, content, file_server)
-            with open(os.path.join(tmp, 'metadata.json'), 'w') as f:
-                f.write(json.dumps(
-                    {'file_server': file_server, 'tag': self.tag}))
-            utils.tar(tmp, 'cloudify-offline.tar.gz')
+                data, size, md5, md5_returned = resource
+                entry.update(size=size, md5=md5_returned, md5_file=md5)
+                # downloads are cached from their own thread once nothing
+                # else reads them, so that downloads never wait for it
+                store = None
+                if resource_cache and md5_returned not in resource_cache:
+                    def store(fileobj):
+                        cache_writes.put((md5_returned, fileobj))
+                original = data
+                if depth <= depth_limit:
+                    data, size, md5 = _crawl(
+                        relative_path, data, size, md5, depth)
+                if data is not original:
+                    # read and replaced while crawling
+                    if store:
+                        store(original)
+                        store = None
+                    else:
+                        original.close()
+                _archive(relative_path, data, size, url, store)
+                if md5:
+                    _archive(relative_path + '.md5', StringIO(md5), len(md5))
+
+            # the large downloads start once the urls found in the repo
+            # were sized, largest first. the small ones start right away.
+            downloads = pipeline.WorkerPool(
+                _handle_url, workers, name='download',
+                queue=pipeline.SizeQueue(held=True))
+            sizes = pipeline.WorkerPool(
+                lambda url: _put(url, 1, self._get_size(url)),
+                workers * 2, name='size')
+            cache_writes = pipeline.WorkerPool(
+                lambda item: self._store(resource_cache, *item), 1,
+                name='cache')
+            pools.extend([sizes, downloads, cache_writes])
+
+            def _handle_file(path):
+                with open(path) as f:
+                    content = f.read()
+                # urls shared by several files are only yielded once.
+                with self.report.phase('scan', len(content)):
+                    if path in blueprints:
+                        urls = list(self._get_urls_from_file(
+                            content, index, path))
+                    else:
+                        urls = crawler.index_file(
+                            content, self.rewriter, index,
+                            os.path.relpath(path, manager_blueprints))
+                _queue(urls, 1)
+                rewritten = self._modify_file_server(
+                    path, content, file_server, index)
+                if path in blueprints or rewritten != content:
+                    contents[path] = rewritten
+
+            depth_limit = depth
+            if locked:
+                for url, entry in sorted(locked['resources'].items()):
+                    if entry['size'] is not None:
+                        _put(url, entry['depth'], entry['size'])
+                downloads.release()
+            blueprints = self._get_manager_blueprints(tmp)
+            manager_blueprints = os.path.dirname(blueprints[0])
+            files = sorted(
+                set(blueprints + crawler.find_files(manager_blueprints)))
+            self._map(_handle_file, files, workers, 'scan')
+            sizes.join()
+            downloads.release()
+            downloads.join()
+
+            def _write(path):
+                with self.report.phase('write', len(contents[path])):
+                    if path in blueprints:
+                        self._write_blueprint(path, contents[path])
+                    else:
+                        self._write_file(path, contents[path])
+
+            self._map(_write, list(contents), workers, 'write')
+            metadata_path = os.path.join(tmp, 'metadata.json')
+            with open(metadata_path, 'w') as f:
+                f.write(json.dumps({
+                    'file_server': file_server,
+                    'tag': self.tag,
+                    'resources': index.to_dict(),
+                }, indent=2))
+            if gzip:
+                with self.report.phase('gzip'):
+                    utils.gzip_compressible_files(manager_blueprints)
+                    utils.gzip_file(metadata_path)
+            archive.add(manager_blueprints)
+            for path in (metadata_path, metadata_path + '.gz'):
+                if os.path.isfile(path):
+                    archive.add(path)
+            archive.close()
+            cache_writes.join()
+            if resource_cache:
+                resource_cache.trim()
+            created = True
+            if write_lock:
+                lockfile.write(write_lock, self.source, self.tag,
+                               self.prefixes, depth, resolved)
         finally:
+            if not created:
+                for pool in pools:
+                    pool.stop()
+            if archive and not created:
+                archive.abort()
             shutil.rmtree(tmp)
+            self.report.finish()
+
+    def plan(self, workers=pipeline.DEFAULT_WORKERS, cache_dir=None,
+             from_lock=None):
+        """Resolves what `create` would fetch, without fetching it.
+
+        The manager blueprints repo is fetched and scanned for urls, as
+        `create` does, measuring the throughput of the transfer. With
+        `from_lock`, the locked resources are used instead and the repo is
+        not fetched. Every resource is then checked with a HEAD request,
+        `workers` at a time, and looked up in the cache at `cache_dir`.
+
+        Downloaded resources are not crawled, as that would require
+        downloading them, unless they are listed in the lock.
+        Returns a `planner.Plan`.
+        """
+        self.report = timing.Report('plan')
+        locked = self._use_lock(from_lock)
+        resource_cache = cache.ResourceCache(cache_dir) if cache_dir else None
+        throughput = None
+        if locked:
+            index = blueprint.UrlIndex(
+                url for url, entry in sorted(locked['resources'].items())
+                if entry['size'] is not None)
+        else:
+            index = blueprint.UrlIndex()
+            tmp = tempfile.mkdtemp(prefix='cloudify-offline-')
+            try:
+                read = []
+                started = time.time()
+                blueprints = self._get_manager_blueprints(
+                    tmp, on_read=lambda size, seconds: read.append(size))
+                elapsed = time.time() - started
+                if not os.path.isfile(self.source) and elapsed:
+                    throughput = sum(read) / elapsed
+                manager_blueprints = os.path.dirname(blueprints[0])
+                for path in sorted(set(
+                        blueprints + crawler.find_files(manager_blueprints))):
+                    with open(path) as f:
+                        list(crawler.index_file(
+                            f.read(), self.rewriter, index,
+                            os.path.relpath(path, manager_blueprints)))
+            finally:
+                shutil.rmtree(tmp)
+
+        result = planner.Plan(workers, throughput)
+        self._map(lambda url: result.add(self._plan_resource(
+            url, len(index.locations[url]) or 1,
+            locked['resources'][url] if locked else None, resource_cache)),
+            list(index), workers, 'plan')
+        self.report.finish()
+        return result
 
-    @retry(stop_max_attempt_number=5)
-    def _download_manager_resource(self, url, destination_path):
-        utils.download_file(url, destination_path)
-        md5_file_path = destination_path + '.md5'
-        utils.download_file(url + '.md5', md5_file_path)
+    def _plan_resource(self, url, references, locked=None,
+                       resource_cache=None):
+        path = self._get_resource_path(url)
+        # a resource which cannot be checked (e.g. the server rejects HEAD
+        # requests) is planned with what is known about it, rather than
+        # failing the whole plan
+        errors = []
+        started = time.time()
+        try:
+            headers = utils.head_url(url)
+        except Exception as ex:
+            lgr.warn('Could not check %s (%s)', url, ex)
+            errors.append(str(ex))
+            headers = {}
+        latency = time.time() - started
+        if headers is None:
+            return planner.PlannedResource(
+                url, path, missing=True, references=references,
+                latency=latency)
+        size = headers.get('Content-Length')
+        size = int(size) if size and size.isdigit() else None
+        if locked:
+            md5 = locked['md5']
+        else:
+            try:
+                md5_file = utils.read_url(url + '.md5')
+            except Exception as ex:
+                lgr.warn('Could not read the md5 of %s (%s)', url, ex)
+                errors.append(str(ex))
+                md5_file = None
+            md5 = md5_file.split()[0] if md5_file else None
+        return planner.PlannedResource(
+            url, path, size=size, etag=headers.get('ETag'), md5=md5,
+            cached=bool(resource_cache and md5 and md5 in resource_cache),
+            changed=bool(locked and size is not None and
+                         size != locked['size']),
+            references=references, latency=latency,
+            error='; '.join(errors) or None)
+
+    def _get_size(self, url):
+        """Returns the size of a resource according to a HEAD request, or
+        None if it is unknown.
+        """
+        with self.report.phase('size'):
+            try:
+                headers = utils.head_url(url)
+            except Exception as ex:
+                lgr.debug('Could not get the size of %s (%s)', url, ex)
+                return None
+        size = headers.get('Content-Length') if headers else None
+        return int(size) if size and size.isdigit() else None
+
+    def _map(self, func, items, workers, name):
+        pool = pipeline.WorkerPool(func, min(workers, len(items)), name)
+        for item in items:
+            pool.put(item)
+        pool.join()
+
+    def _download_manager_resource(self, url, spool_size, resource_cache=None):
+        """Downloads a resource and verifies it against its md5 file.
+
+        Resources with an md5 file are taken from `resource_cache`, if it
+        has them. Failed downloads, including corrupt ones, are retried.
+
+        Returns a `(fileobj, size, md5 file content, md5)` tuple, or None if
+        the resource does not exist.
+        """
         # unfortunately, not all resources currently have md5 checksum files.
         # one all do, we'll remove this and fail if the md5 file is not found.
-        if os.path.isfile(md5_file_path):
-            if self._validate_md5_checksum(destination_path, md5_file_path):
-                return True
+        with self.report.phase('verify'):
+            # too small to tell anything about the host's throughput
+            md5 = self.hosts.call(url, lambda: utils.read_url(url + '.md5'))
+        original_md5 = md5.rstrip('\n\r').split()[0] if md5 else None
+        if original_md5 and resource_cache:
+            cached = self._get_cached(url, resource_cache, original_md5)
+            if cached:
+                return cached, utils.get_size(cached), md5, original_md5
+
+        def _download():
+            resource = self._spool(url, spool_size)
+            if resource and md5 and not self._validate_md5_checksum(
+                    url, original_md5, resource[2]):
+                resource[0].close()
+                raise IOError('md5 checksum validation failed for {0}'.format(
+                    url))
+            return resource
+
+        # without an md5, a mirror's copy could not be verified
+        resource = md5 and self._download_from_mirrors(
+            url, spool_size, lambda resource: resource[2] == original_md5)
+        resource = resource or self._download_to_spool(
+            url, spool_size, _download)
+        if not resource:
+            return None
+        fileobj, size, md5_returned = resource
+        if md5:
+            self._emit(events.VERIFIED, url, size)
+        return fileobj, size, md5, md5_returned
+
+    def _spool(self, url, spool_size, source=None):
+        """Downloads `url`, or its copy at `source`.
+        """
+        start = time.time()
+        on_read = (lambda size, seconds: self._emit(events.BYTES, url, size)) \
+            if self._on_event else None
+        source = source or url
+        with logger.span(lgr, 'download', source) as span:
+            with self.report.phase('download') as download:
+                resource = utils.download_to_spool(
+                    source, spool_size, on_read)
+                download.bytes = span['bytes'] = \
+                    resource[1] if resource else 0
+            if not resource:
+                span['outcome'] = 'missing'
+        if resource:
+            self.report.transfer(url, resource[1], time.time() - start)
+        return resource
+
+    def _download_to_spool(self, url, spool_size, download=None):
+        return self.hosts.call(
+            url, download or (lambda: self._spool(url, spool_size)),
+            _get_spooled_size)
+
+    def _download_from_mirrors(self, url, spool_size, verify):
+        """Downloads a resource from the mirrors of its prefix, failing
+        over from one to the next.
+
+        Returns None once the canonical location is next, or if no mirror
+        has an intact copy, leaving the download (and retrying it) to the
+        caller. `verify` returns whether a download matches the canonical
+        md5.
+        """
+        for mirror in self.mirrors.choose(url):
+            if mirror.canonical:
+                return None
+            source = mirror.locate(url)
+            resource = None
+            ok = False
+            self.mirrors.started(mirror)
+            try:
+                resource = self.hosts.attempt(
+                    source, lambda: self._spool(url, spool_size, source),
+                    _get_spooled_size)
+                # mirrors may only have some of the resources
+                ok = not resource or verify(resource)
+            except Exception as ex:
+                lgr.warn('Failed downloading %s from mirror %s (%s)',
+                         url, mirror.url, ex)
+            finally:
+                self.mirrors.finished(mirror, ok)
+            if resource and ok:
+                return resource
+            if resource:
+                resource[0].close()
+                lgr.warn('%s from mirror %s does not match the canonical '
+                         'md5', url, mirror.url)
+            lgr.info('Failing over to the next mirror of %s', url)
+        return None
+
+    def _store(self, resource_cache, md5, fileobj):
+        """Stores a download in the cache and closes it. A cache which
+        cannot be written to does not fail the build.
+        """
+        with closing(fileobj):
+            try:
+                with self.report.phase('cache', utils.get_size(fileobj)):
+                    resource_cache.put(md5, fileobj)
+            except (IOError, OSError) as ex:
+                lgr.warn('Could not cache %s (%s)', md5, ex)
+
+    def _get_cached(self, url, resource_cache, md5, size=None):
+        with self.report.phase('cache') as lookup:
+            cached = resource_cache.get(md5, size)
+            lookup.bytes = utils.get_size(cached) if cached else 0
+        if cached:
+            lgr.info('Using cached %s', url)
+            self._emit(events.CACHED, url, lookup.bytes)
+        return cached
+
+    def _fetch_locked_resource(self, url, locked, spool_size,
+                               resource_cache=None):
+        """Gets a locked resource from `resource_cache` or downloads it.
 
-    def serve(self, serve_under=None, file_server='',
-              python_exec=sys.executable):
+        Fails right away if the resource is gone or its content is not the
+        one recorded in the lock.
+        """
+        if resource_cache:
+            cached = self._get_cached(
+                url, resource_cache, locked['md5'], locked['size'])
+            if cached:
+                return cached, locked['size'], locked['md5_file'], \
+                    locked['md5']
+        resource = self._download_from_mirrors(
+            url, spool_size, lambda resource: resource[1:] == (
+                locked['size'], locked['md5']))
+        resource = resource or self._download_to_spool(url, spool_size)
+        if not resource:
+            raise IOError('Locked resource {0} does not exist'.format(url))
+        fileobj, size, md5_returned = resource
+        if (size, md5_returned) != (locked['size'], locked['md5']):
+            fileobj.close()
+            raise IOError(
+                '{0} changed since it was locked (size {1}, md5 {2}; '
+                'expected size {3}, md5 {4})'.format(
+                    url, size, md5_returned, locked['size'], locked['md5']))
+        self._emit(events.VERIFIED, url, size)
+        return fileobj, size, locked['md5_file'], md5_returned
+
+    def serve(self, serve_under=None, file_server='', address='', port=8000,
+              rate_limit=None, client_rate_limit=None, upstream=False):
         """Runs a webserver serving the relevant files for bootstrapping.
 
-        This runs a SimpleHTTPServer serving Cloudify's Resources.
+        This runs a threaded HTTP server serving Cloudify's Resources.
+        Precomputed gzip variants are sent to clients accepting them.
+        Bandwidth can be capped in total and per client, in which case
+        it is shared fairly between the clients currently downloading.
+
+        With `upstream`, resources missing from the archive (or all of
+        them, if no archive is given) are fetched once from the original
+        prefix hosts and cached under `serve_under`.
+
+        The archive is extracted once (and not at all if `serve_under`
+        already holds an extraction of it). Instead of modifying the
+        archive, blueprints are rewritten as they are served to point at
+        `file_server` or, if it is not set, at the host the client used.
         """
         serve_under = \
             serve_under or tempfile.mkdtemp(prefix='cloudify-offline-')
-        # this should be done in a single step. currently, it will untar,
-        # modify, tar and then untar again for serving. what a waste. eh.
-        if file_server:
-            self.modify(file_server)
-        utils.untar(self.source, serve_under)
-        self._run_http_server(os.path.join(
-            serve_under, os.listdir(serve_under)[0]), python_exec)
+        rewrite = None
+        if not self.source:
+            if not upstream:
+                raise ValueError('A source archive is required '
+                                 'unless serving from upstream.')
+            root = serve_under
+        else:
+            with self.report.phase('extract'):
+                root = self._extract_for_serving(serve_under)
+            metadata = self._get_meta(root)
+            rewrite = (
+                self._fix_file_server(metadata['file_server']),
+                self._fix_file_server(file_server) if file_server else None,
+                self._find_rewritten_files(root, metadata))
+        start = time.time()
+        httpd = self._run_http_server(
+            root, address, port, rate_limit=rate_limit,
+            client_rate_limit=client_rate_limit,
+            upstream_prefixes=self.prefixes if upstream else None,
+            rewrite=rewrite)
+        if httpd:
+            # everything sent while serving counts as a single phase
+            self.report.add(
+                'serve', time.time() - start,
+                size=sum(httpd.metrics.bytes_sent.values()), start=start,
+                count=sum(httpd.metrics.requests.values()))
+        self.report.finish()
+
+    def _extract_for_serving(self, serve_under):
+        """Extracts the source archive under `serve_under` unless it was
+        already extracted there, and returns the extracted root.
+
+        The marker left next to the extraction records the archive and
+        the root it was extracted to. The extraction of another archive
+        is removed before extracting this one.
+        """
+        marker = os.path.join(serve_under, '.cloff-source')
+        stat = os.stat(self.source)
+        source_id = '{0} {1} {2}'.format(
+            os.path.abspath(self.source), stat.st_size, stat.st_mtime)
+        previous_id, previous_root = None, None
+        if os.path.isfile(marker):
+            with open(marker) as f:
+                lines = f.read().splitlines()
+            previous_id = lines[0] if lines else None
+            previous_root = lines[1] if len(lines) > 1 else None
+        if previous_id == source_id and previous_root and os.path.isfile(
+                os.path.join(serve_under, previous_root, 'metadata.json')):
+            lgr.info('{0} was already extracted under {1}. Skipping...'.format(
+                self.source, serve_under))
+            return os.path.join(serve_under, previous_root)
+        if previous_root and os.path.isdir(
+                os.path.join(serve_under, previous_root)):
+            lgr.info('Removing the previous extraction {0}...'.format(
+                previous_root))
+            shutil.rmtree(os.path.join(serve_under, previous_root))
+        roots = [name.split('/')[0] for name in utils.untar(
+            self.source, serve_under) if name.count('/') == 1 and
+            name.endswith('/metadata.json')]
+        if not roots:
+            raise IOError('No metadata.json found in {0}'.format(self.source))
+        with open(marker, 'w') as f:
+            f.write('{0}\n{1}\n'.format(source_id, roots[0]))
+        return os.path.join(serve_under, roots[0])
 
     def _fix_file_server(self, file_server):
         return file_server + '/' if not file_server.endswith('/') \
             else file_server
 
-    def _modify_file_server(self, blueprint_path, content, file_server):
-        lgr.info('Editing {0}'.format(blueprint_path))
+    def _modify_file_server(self, blueprint_path, content, file_server,
+                            index):
+        """Points the resource urls in `content` at `file_server`.
+
+        Only urls in `index` are rewritten, so urls appearing in comments
+        are left alone. Urls are rewritten in place, in a single pass,
+        leaving the rest of the content untouched.
+        """
+        lgr.info('Editing %s', blueprint_path)
         file_server = self._fix_file_server(file_server)
-        lgr.info('Applying server: {0} to all resource urls.'.format(
-            file_server))
-        content = re.sub(
-            r'{0}'.format('|'.join(FILE_SERVER_MODIFIERS)),
-            file_server + 'resources', content)
-        yaml_content = yaml.safe_load(content)
-        lgr.debug(json.dumps(yaml_content, indent=2))
-
-        with open(blueprint_path, 'w') as f:
-            f.write(yaml.dump(yaml_content, default_flow_style=False))
-
-    def modify(self, file_server):
-        """This modifies the file server inside the manager blueprint.
+        lgr.info('Applying server: %s to all resource urls.', file_server)
+
+        def _replace(prefix, url):
+            if blueprint.normalize_url(url) not in index:
+                return url
+            # resources are stored under `resources/<url path>`. only the
+            # host is replaced, so that whatever follows the path in the
+            # matched text is kept
+            return file_server + 'resources' + rewriter.split_host(url)[1]
+
+        with self.report.phase('rewrite', len(content)):
+            content, _ = self.rewriter.rewrite(content, _replace)
+        return content
+
+    def _write_blueprint(self, blueprint_path, content):
+        blueprint.write(blueprint_path, content)
+
+    def _write_file(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def _find_rewritten_files(self, root, metadata):
+        """Returns the paths of the files in an extracted archive whose
+        urls point at its file server: the manager blueprints and the
+        scripts, configs and resources recorded in the metadata's index.
         """
+        manager_blueprints = os.path.join(
+            root, 'cloudify-manager-blueprints-{0}'.format(metadata['tag']))
+        paths = set(self._find_manager_blueprints(manager_blueprints))
+        for name in crawler.rewritten_files(metadata.get('resources', {})):
+            # resources are indexed relative to the root, repo files
+            # relative to the repo
+            base = root if name.split('/')[0] == 'resources' \
+                else manager_blueprints
+            path = os.path.join(base, name)
+            if os.path.isfile(path):
+                paths.add(path)
+        return sorted(paths)
+
+    def _replace_file_server(self, path, original, file_server):
+        lgr.info('Editing {0}'.format(path))
+        with open(path) as f:
+            content = f.read()
+        lgr.info('Replacing {0} with {1}.'.format(original, file_server))
+        with self.report.phase('rewrite', len(content)):
+            content = content.replace(original, file_server)
+        with self.report.phase('write', len(content)):
+            if fnmatch.fnmatch(
+                    os.path.basename(path), MANAGER_BLUEPRINT_PATTERN):
+                blueprint.write(path, content)
+            else:
+                self._write_file(path, content)
+        self._emit(events.REWRITTEN, path, len(content))
+        # keep the md5 file and the precomputed gzip variant in sync with
+        # the new content
+        if os.path.isfile(path + '.md5'):
+            with open(path + '.md5') as f:
+                md5 = f.read()
+            if md5.split():
+                self._write_file(path + '.md5', md5.replace(
+                    md5.split()[0], hashlib.md5(content).hexdigest()))
+        if os.path.isfile(path + '.gz'):
+            with self.report.phase('gzip', len(content)):
+                utils.gzip_file(path)
+
+    def modify(self, file_server, on_event=None):
+        """This modifies the file server inside the manager blueprints and
+        the scripts, configs and resources pointing at it.
+
+        `on_event` is called with an `events.Event` for every file
+        rewritten and, once it was written, for the new archive.
+        """
+        self.report = timing.Report('modify')
+        self._listen(on_event)
         file_server = self._fix_file_server(file_server)
         serve_under = tempfile.mkdtemp(prefix='cloudify-offline-')
         lgr.info('Running on {0}'.format(serve_under))
         try:
-            utils.untar(self.source, serve_under)
+            with self.report.phase('untar', os.path.getsize(self.source)):
+                utils.untar(self.source, serve_under)
             path = os.path.join(serve_under, os.listdir(serve_under)[0])
             metadata = self._get_meta(path)
             lgr.info(metadata)
-            # from here on, this can definitely be consolidated as it is also
-            # done under `create`
-            manager_blueprints = os.path.join(
-                path, 'cloudify-manager-blueprints-{0}'.format(
-                    metadata['tag']))
-            simple_manager_blueprint_path = os.path.join(
-                manager_blueprints, 'simple-manager-blueprint.yaml')
-            lgr.info('Editing {0}'.format(simple_manager_blueprint_path))
-            with open(simple_manager_blueprint_path) as f:
-                # read yaml also
-                content = f.read()
-                lgr.info('Replacing {0} with {1}.'.format(
-                    metadata['file_server'], file_server))
-                content = content.replace(metadata['file_server'], file_server)
-                yaml_content = yaml.safe_load(content)
-            with open(simple_manager_blueprint_path, 'w') as f:
-                f.write(yaml.dump(yaml_content, default_flow_style=False))
+            original = self._fix_file_server(metadata['file_server'])
+            self._map(lambda rewritten_path: self._replace_file_server(
+                rewritten_path, original, file_server),
+                self._find_rewritten_files(path, metadata),
+                pipeline.DEFAULT_WORKERS, 'rewrite')
+            metadata['file_server'] = file_server
+            with open(os.path.join(path, 'metadata.json'), 'w') as f:
+                f.write(json.dumps(metadata))
             try:
                 shutil.remove(self.source)
             except:
                 lgr.error('Could not remove original source {0}'.format(
                     self.source))
-            utils.tar(path, 'cloudify-offline.tar.gz')
+            with self.report.phase('tar'):
+                utils.tar(path, 'cloudify-offline.tar.gz')
+            self._emit(events.ARCHIVED, 'cloudify-offline.tar.gz',
+                       os.path.getsize('cloudify-offline.tar.gz'))
         finally:
             shutil.rmtree(serve_under)
+            self.report.finish()
 
-    def validate(self):
+    def validate(self, on_event=None):
         """Validates resources inside the manager blueprint via
         md5 verification and metadata comparison.
-        """
-        raise NotImplementedError()
 
-    def _validate_md5_checksum(self, resource_path, md5_checksum_file_path):
-        lgr.info('Validating md5 checksum for {0}'.format(resource_path))
-        with open(md5_checksum_file_path) as checksum_file:
-            original_md5 = checksum_file.read().rstrip('\n\r').split()[0]
+        The archive is read once, as a stream. Every resource with an md5
+        file must match it, the manager blueprints must be those of the
+        tag in the metadata and every resource the blueprints fetch from
+        the file server in the metadata must be in the archive. Raises an
+        IOError listing all problems found.
 
-        with open(resource_path) as file_to_check:
-            data = file_to_check.read()
-            # pipe contents of the file through
-            md5_returned = hashlib.md5(data).hexdigest()
+        `on_event` is called with an `events.Event` for every chunk read
+        from the archive and for every resource matching its md5.
+        """
+        self._listen(on_event)
+        lgr.info('Validating {0}...'.format(self.source))
+        md5s = {}
+        expected_md5s = {}
+        blueprints = {}
+        metadata = None
+        with closing(utils.open_stream(self.source)) as stream:
+            if on_event:
+                stream = utils.MeteredStream(
+                    stream, lambda size, seconds: self._emit(
+                        events.BYTES, self.source, size))
+            with closing(tarfile.open(fileobj=stream, mode='r|gz')) as tar:
+                for member in tar:
+                    if not member.isfile() or '/' not in member.name:
+                        continue
+                    name = member.name.split('/', 1)[1]
+                    f = tar.extractfile(member)
+                    if name == 'metadata.json':
+                        metadata = json.loads(f.read())
+                    elif self._is_manager_blueprint(name):
+                        blueprints[name] = f.read()
+                    elif name.endswith('.md5'):
+                        content = f.read().split()
+                        expected_md5s[name[:-len('.md5')]] = \
+                            content[0] if content else None
+                    else:
+                        md5s[name] = utils.md5_fileobj(f)
+
+        errors = []
+        if metadata is None:
+            errors.append('metadata.json is missing')
+        for name, expected in sorted(expected_md5s.items()):
+            if name not in md5s:
+                errors.append('{0} is missing'.format(name))
+            elif md5s[name] != expected:
+                errors.append('{0} does not match its md5 ({1} != {2})'.format(
+                    name, md5s[name], expected))
+            else:
+                self._emit(events.VERIFIED, name)
+        if metadata:
+            repo = 'cloudify-manager-blueprints-{0}'.format(metadata['tag'])
+            if not blueprints:
+                errors.append('No manager blueprints found')
+            resources = self._fix_file_server(
+                metadata['file_server']) + 'resources/'
+            for name, content in sorted(blueprints.items()):
+                if name.split('/')[0] != repo:
+                    errors.append('{0} does not match tag {1}'.format(
+                        name, metadata['tag']))
+                for url in rewriter.URL_PATTERN.findall(content):
+                    url = url.rstrip(rewriter.TRAILING_PUNCTUATION)
+                    if url.startswith(resources) and 'resources/' + \
+                            urlparse.urlsplit(url[len(resources):]).path \
+                            not in md5s:
+                        errors.append('{0} refers to missing {1}'.format(
+                            name, url))
+        for error in errors:
+            lgr.error(error)
+        if errors:
+            raise IOError('Validation of {0} failed ({1} errors)'.format(
+                self.source, len(errors)))
+        lgr.info('{0} is valid ({1} resources, {2} verified).'.format(
+            self.source, len(md5s), len(expected_md5s)))
 
+    def _validate_md5_checksum(self, resource, original_md5, md5_returned):
+        lgr.info('Validating md5 checksum for %s', resource)
         if original_md5 == md5_returned:
             return True
         else:
@@ -229,17 +975,18 @@ class Cloff():
                           original_md5, md5_returned))
             return False
 
+    def _listen(self, on_event):
+        self._on_event = on_event
+        self._emit = events.emitter(on_event)
+
     def _get_meta(self, path):
         with open(os.path.join(path, 'metadata.json')) as f:
             return json.loads(f.read())
 
-    def _run_http_server(self, serve_under, python_exec):
-        lgr.info('Serving {0}'.format(serve_under))
-        prev = os.getcwd()
-        os.chdir(serve_under)
-        server = sh.Command(python_exec)
-        server('-m', 'SimpleHTTPServer', _bg=True)
-        os.chdir(prev)
+    def _run_http_server(self, serve_under, address, port, **kwargs):
+        # only serving needs the HTTP server modules
+        from . import server
+        return server.serve(serve_under, address, port, **kwargs)
 
     def _get_file_name_from_path(self, url_path):
         return os.path.dirname(url_path)
@@ -247,9 +994,39 @@ class Cloff():
     def _get_relative_path_from_url(self, url):
         return urlparse.urlparse(url).path
 
-    def _get_urls_from_file(self, content):
-        # specifically look for the relevant bucket/cdn
-        return re.findall(r'(\'?https?://[^\s\'\""]+\'?)', content)
+    def _get_resource_path(self, url):
+        # resources are archived under `resources/<url path>`
+        return os.path.join(
+            'resources', self._get_relative_path_from_url(url).lstrip('/'))
+
+    def _use_mirrors(self, urls):
+        self.mirrors = mirrors.Mirrors(urls or ())
+        if urls and not all(self.rewriter.match(prefix)
+                            for prefix in self.mirrors.rewriter.prefixes):
+            lgr.warn('Mirrors were given for prefixes which are not '
+                     'downloaded: {0}'.format(', '.join(
+                         prefix for prefix in self.mirrors.rewriter.prefixes
+                         if not self.rewriter.match(prefix))))
+
+    def _use_lock(self, from_lock):
+        """Reads a lock file and switches to the source, tag and prefixes
+        recorded in it. Returns the lock, or None without `from_lock`.
+        """
+        if not from_lock:
+            return None
+        locked = lockfile.read(from_lock)
+        self.source, self.tag = locked['source'], locked['tag']
+        self.prefixes = locked['prefixes']
+        self.rewriter = rewriter.UrlRewriter(self.prefixes)
+        return locked
+
+    def _get_urls_from_file(self, content, index=None,
+                            blueprint_path='<blueprint>'):
+        # specifically look for the relevant bucket/cdn. urls are yielded as
+        # they are found so that they can be handled right away.
+        index = blueprint.UrlIndex() if index is None else index
+        return blueprint.index_urls(
+            content, self.rewriter, index, os.path.basename(blueprint_path))
 
     def _get_file_name_from_url(self, url):
         return url.split('/')[-1]
@@ -261,9 +1038,60 @@ class Cloff():
         return url.split('/')[-2]
 
 
+def _get_spooled_size(resource):
+    return resource[1] if resource else 0
+
+
+def _get_mirrors(mirror, mirrors_file):
+    mirror_urls = list(mirror)
+    if mirrors_file:
+        mirror_urls.extend(mirrors.read_mirrors(mirrors_file))
+    return mirror_urls or None
+
+
+def _get_prefixes(prefixes, prefixes_file):
+    prefixes = list(prefixes)
+    if prefixes_file:
+        prefixes.extend(rewriter.read_prefixes(prefixes_file))
+    return prefixes or None
+
+
+def _print_report(clo, report):
+    logger.flush()
+    click.echo(clo.report.render())
+    if report:
+        clo.report.write(report)
+
+
+def _parse_size(ctx, param, value):
+    try:
+        return utils.parse_size(value)
+    except ValueError as ex:
+        raise click.BadParameter(str(ex))
+
+
 @click.group()
-def main():
-    pass
+@click.option('--profile', type=click.Path(),
+              help='Profile the command and write the profile to this '
+                   'file. The profile of each thread is written next to it.')
+@click.option('--profile-mode', type=click.Choice(profiling.MODES),
+              default='auto',
+              help='`sample` writes collapsed stacks for flame graphs, '
+                   '`cprofile` writes pstats. `auto` samples when possible.')
+@click.option('--profile-interval', type=float,
+              default=profiling.DEFAULT_INTERVAL,
+              help='Seconds between samples with `--profile-mode sample`.')
+@click.option('--log-format', type=click.Choice(LOG_FORMATS),
+              default='text', envvar='CLOFF_LOG_FORMAT',
+              help='`json` writes JSON log lines with the operation, url, '
+                   'bytes, duration and outcome of downloads and requests. '
+                   '`json-file` only does so in the log file.')
+@click.pass_context
+def main(ctx, profile, profile_mode, profile_interval, log_format):
+    logger.set_format(*LOG_FORMATS[log_format])
+    if profile:
+        profiler = profiling.start(profile, profile_mode, profile_interval)
+        ctx.call_on_close(profiler.stop)
 
 
 @click.command()
@@ -271,47 +1099,168 @@ def main():
               help='Source URL, or local path of manager blueprints.')
 @click.option('-t', '--tag', default='3.3',
               help='cloudify-manager-blueprints repo tag.')
-@click.option('--file-server', required=True,
+@click.option('--file-server',
               help='Server the resources will be served on '
-                   '(e.g. http://10.10.10.10:8000).')
+                   '(e.g. http://10.10.10.10:8000). Required unless --plan '
+                   'is set.')
+@click.option('-z', '--gzip', default=False, is_flag=True,
+              help='Precompute gzip variants of compressible resources '
+                   'so that `serve` can send them compressed.')
+@click.option('-w', '--workers', default=pipeline.DEFAULT_WORKERS, type=int,
+              help='Number of resources to download in parallel.')
+@click.option('--retry-budget', default=hosts.DEFAULT_RETRY_BUDGET,
+              type=float,
+              help='Seconds after its first failure during which a '
+                   'download is retried with backoff.')
+@click.option('--spool-size', default=str(pipeline.DEFAULT_SPOOL_SIZE),
+              callback=_parse_size,
+              help='Resources up to this size (e.g. 32M) are buffered in '
+                   'memory before being archived. Larger ones spill to a '
+                   'temporary file.')
+@click.option('--prefix', multiple=True,
+              help='Url prefix of resources to download (may be repeated). '
+                   'Defaults to the Cloudify repositories.')
+@click.option('--prefixes-file', type=click.Path(exists=True),
+              help='File with url prefixes of resources to download, '
+                   'one per line.')
+@click.option('--mirror', nargs=2, multiple=True,
+              metavar='PREFIX MIRROR',
+              help='Url of a mirror of the resources under a prefix (may '
+                   'be repeated). The fastest mirrors are used, and '
+                   'resources are verified against the md5 files of the '
+                   'prefix.')
+@click.option('--mirrors-file', type=click.Path(exists=True),
+              help='File with a url prefix and its mirrors, separated by '
+                   'spaces, on each line.')
+@click.option('-d', '--depth', default=crawler.DEFAULT_DEPTH, type=int,
+              help='How many levels of downloaded scripts, configs and '
+                   'archives to scan for more resources (0 to only scan '
+                   'the manager blueprints repo).')
+@click.option('--cache-dir',
+              help='Directory to cache downloaded resources in (e.g. {0}). '
+                   'Resources are not cached by default.'.format(
+                       cache.DEFAULT_CACHE_DIR))
+@click.option('--cache-size', default=str(cache.DEFAULT_CACHE_SIZE),
+              callback=_parse_size,
+              help='Evict the least recently used resources once the cache '
+                   'grows beyond this size (e.g. 10G).')
+@click.option('--write-lock', type=click.Path(),
+              help='Record the resolved resources (urls, sizes and md5s) '
+                   'in this lock file.')
+@click.option('--from-lock', type=click.Path(exists=True),
+              help='Create from a lock file written by --write-lock. The '
+                   'source, tag, prefixes and depth recorded in the lock '
+                   'are used and changed resources fail the build.')
+@click.option('--plan', default=False, is_flag=True,
+              help='Only report the resources that would be downloaded, '
+                   'their sizes, cache hits and an estimated transfer '
+                   'time, using HEAD requests.')
+@click.option('--report', type=click.Path(),
+              help='Write per-phase timings and transfer rates to this '
+                   'JSON file.')
 @click.option('-v', '--verbose', default=False, is_flag=True)
-def create(source, tag, file_server, verbose):
+def create(source, tag, file_server, gzip, workers, retry_budget, spool_size,
+           prefix, prefixes_file, mirror, mirrors_file, depth, cache_dir,
+           cache_size, write_lock, from_lock, plan, report, verbose):
     """Creates an offline env for bootstrappin
     """
     logger.configure()
-    clo = Cloff(source, tag, verbose)
-    clo.create(file_server=file_server)
+    clo = Cloff(source, tag, verbose, _get_prefixes(prefix, prefixes_file))
+    if plan:
+        result = clo.plan(workers=workers, cache_dir=cache_dir,
+                          from_lock=from_lock)
+        logger.flush()
+        click.echo(result.render())
+        return
+    if not file_server:
+        raise click.UsageError('--file-server is required unless --plan '
+                               'is set.')
+    try:
+        clo.create(file_server=file_server, gzip=gzip, workers=workers,
+                   spool_size=spool_size, depth=depth, cache_dir=cache_dir,
+                   cache_size=cache_size, write_lock=write_lock,
+                   from_lock=from_lock, retry_budget=retry_budget,
+                   mirrors=_get_mirrors(mirror, mirrors_file))
+    finally:
+        _print_report(clo, report)
 
 
 @click.command()
 @click.argument('source')
 @click.argument('server')
+@click.option('--report', type=click.Path(),
+              help='Write per-phase timings to this JSON file.')
 @click.option('-v', '--verbose', default=False, is_flag=True)
-def modify(source, server, verbose):
+def modify(source, server, report, verbose):
     """Creates an offline env for bootstrappin
     """
     logger.configure()
     clo = Cloff(source, verbose=verbose)
-    clo.modify(server)
+    try:
+        clo.modify(server)
+    finally:
+        _print_report(clo, report)
 
 
 @click.command()
-@click.argument('source')
+@click.argument('source', required=False)
 @click.option('-u', '--serve-under', default='',
               help='Path under which the files will be served.')
 @click.option('--file-server',
               help='Server the resources will be served on '
-                   '(e.g. http://10.10.10.10:8000). This defaults to whatever '
-                   'is already defined in the blueprint.')
+                   '(e.g. http://10.10.10.10:8000). This defaults to the '
+                   'host each client used to reach the server.')
+@click.option('-a', '--address', default='',
+              help='Address to bind the server to (defaults to all).')
+@click.option('-p', '--port', default=8000, type=int,
+              help='Port to serve on.')
+@click.option('--rate-limit', callback=_parse_size,
+              help='Total bandwidth for all clients in bytes/sec '
+                   '(e.g. 50M). Shared evenly between active clients.')
+@click.option('--client-rate-limit', callback=_parse_size,
+              help='Bandwidth per client address in bytes/sec (e.g. 5M).')
+@click.option('--upstream', default=False, is_flag=True,
+              help='Fetch resources missing from SOURCE (or all resources '
+                   'if SOURCE is omitted) from their original hosts and '
+                   'cache them.')
+@click.option('--prefix', multiple=True,
+              help='Url prefix to pull resources through from with '
+                   '--upstream (may be repeated).')
+@click.option('--prefixes-file', type=click.Path(exists=True),
+              help='File with url prefixes for --upstream, one per line.')
+@click.option('--report', type=click.Path(),
+              help='Write timings and the amount served to this JSON file '
+                   'once the server is stopped.')
 @click.option('-v', '--verbose', default=False, is_flag=True)
-def serve(source, serve_under, file_server, verbose):
+def serve(source, serve_under, file_server, address, port, rate_limit,
+          client_rate_limit, upstream, prefix, prefixes_file, report,
+          verbose):
     """Creates an offline env for bootstrappin
     """
     logger.configure()
+    if not source and not upstream:
+        raise click.UsageError('SOURCE is required unless --upstream is set.')
+    clo = Cloff(source, verbose=verbose,
+                prefixes=_get_prefixes(prefix, prefixes_file))
+    try:
+        clo.serve(serve_under, file_server, address, port, rate_limit,
+                  client_rate_limit, upstream)
+    finally:
+        _print_report(clo, report)
+
+
+@click.command()
+@click.argument('source')
+@click.option('-v', '--verbose', default=False, is_flag=True)
+def validate(source, verbose):
+    """Validates an offline env for bootstrappin
+    """
+    logger.configure()
     clo = Cloff(source, verbose=verbose)
-    clo.serve(serve_under, file_server)
+    clo.validate()
 
 
 main.add_command(create)
 main.add_command(modify)
 main.add_command(serve)
+main.add_command(validate)
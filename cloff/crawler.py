@@ -0,0 +1,131 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import os
+import re
+import tarfile
+import zipfile
+from contextlib import closing
+
+from . import logger, blueprint, utils
+
+
+# how many levels of downloaded resources are scanned for more urls
+DEFAULT_DEPTH = 2
+# files larger than this are never scanned
+MAX_SCAN_SIZE = 4 * 1024 ** 2
+
+SCANNABLE_EXTENSIONS = (
+    '.sh', '.bash', '.py', '.ps1', '.bat', '.yaml', '.yml', '.json', '.cfg',
+    '.conf', '.ini', '.properties', '.repo', '.j2', '.jinja2', '.template',
+    '.tmpl', '.xml', '.txt')
+ARCHIVE_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.zip')
+# the file a location (see `blueprint.Location`) in a stored index is in
+LOCATION_FILE = re.compile(r'(.+?):\d+ \(')
+
+yaml = utils.LazyModule('yaml')
+
+lgr = logger.init()
+
+
+def is_scannable(path):
+    return path.lower().endswith(SCANNABLE_EXTENSIONS)
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def is_yaml(path):
+    return path.lower().endswith(('.yaml', '.yml'))
+
+
+def rewritten_files(resources):
+    """Returns the names of the files an index of urls was built from,
+    given the index as stored in an archive's metadata (see
+    `blueprint.UrlIndex.to_dict`). The urls in these files point at the
+    archive's file server. Archive members are left out, as archives are
+    only scanned.
+    """
+    names = set()
+    for locations in resources.values():
+        for location in locations:
+            match = LOCATION_FILE.match(location)
+            if match and '!' not in match.group(1):
+                names.add(match.group(1))
+    return sorted(names)
+
+
+def find_files(root):
+    """Returns the scannable files under `root`, sorted.
+    """
+    found = []
+    for directory, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(directory, name)
+            if is_scannable(path) and os.path.getsize(path) <= MAX_SCAN_SIZE:
+                found.append(path)
+    return sorted(found)
+
+
+def index_text(content, rewriter, index, name):
+    """Indexes the urls in a text file (e.g. a script or a config file).
+
+    Unlike blueprints, text files are scanned line by line and every
+    matching url is indexed, wherever it appears. Like `index_urls`, new
+    urls are yielded as they are found.
+    """
+    for line_number, line in enumerate(content.splitlines(), 1):
+        for url in rewriter.find(line):
+            url = blueprint.normalize_url(url)
+            if index.add(url, blueprint.Location(name, [], line_number)):
+                yield url
+
+
+def index_file(content, rewriter, index, name):
+    """Indexes a blueprint repo file or a resource according to its type.
+
+    YAML files which cannot be parsed are scanned as text.
+    """
+    if is_yaml(name):
+        try:
+            return list(blueprint.index_urls(content, rewriter, index, name))
+        except yaml.YAMLError:
+            lgr.debug('{0} is not valid YAML. Scanning as text'.format(name))
+    return list(index_text(content, rewriter, index, name))
+
+
+def read_archive(fileobj, name):
+    """Yields the name and content of the scannable members of an archive.
+
+    `fileobj` must be seekable. It is rewound once the archive was read.
+    """
+    try:
+        if name.lower().endswith('.zip'):
+            with closing(zipfile.ZipFile(fileobj)) as archive:
+                for info in archive.infolist():
+                    if is_scannable(info.filename) and \
+                            info.file_size <= MAX_SCAN_SIZE:
+                        yield info.filename, archive.read(info)
+        else:
+            with closing(tarfile.open(fileobj=fileobj, mode='r:*')) as archive:
+                for member in archive:
+                    if member.isfile() and is_scannable(member.name) and \
+                            member.size <= MAX_SCAN_SIZE:
+                        yield member.name, archive.extractfile(member).read()
+    except (tarfile.TarError, zipfile.BadZipfile, EOFError, IOError) as ex:
+        lgr.warn('Could not scan archive {0} ({1})'.format(name, ex))
+    finally:
+        fileobj.seek(0)
@@ -0,0 +1,108 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import sys
+import time
+import Queue
+import threading
+from collections import namedtuple
+
+from . import six
+
+
+# a resource url was queued for download
+QUEUED = 'queued'
+# `size` bytes of `name` were read (emitted for every chunk)
+BYTES = 'bytes'
+# a resource matched its md5
+VERIFIED = 'verified'
+# a resource was taken from the download cache
+CACHED = 'cached'
+# a file was written to the archive
+ARCHIVED = 'archived'
+# a blueprint was pointed at a new file server
+REWRITTEN = 'rewritten'
+
+TYPES = (QUEUED, BYTES, VERIFIED, CACHED, ARCHIVED, REWRITTEN)
+
+_END = object()
+
+
+class Event(namedtuple('Event', 'type name size time')):
+    """A progress event of a cloff operation.
+
+    `name` is the url of a resource or, where there is none, the path
+    of a file in the archive. `size` is the number of bytes the event
+    is about (a chunk for `BYTES`, the whole file otherwise), or None
+    if it is unknown.
+    """
+    __slots__ = ()
+
+
+def emitter(on_event):
+    """Returns a function emitting events to `on_event`, which does
+    nothing if there is no `on_event`.
+    """
+    if not on_event:
+        return _ignore
+
+    def _emit(type, name, size=None):
+        on_event(Event(type, name, size, time.time()))
+    return _emit
+
+
+def _ignore(type, name, size=None):
+    pass
+
+
+class EventStream(object):
+    """Runs a cloff operation in a background thread and yields its
+    events as they happen.
+
+        for event in EventStream(clo.create, file_server=url):
+            ...
+
+    The operation is called with `on_event` set. Once it finishes, the
+    iteration ends, re-raising the error the operation failed with, if
+    any. `maxsize` bounds the events waiting to be consumed, slowing the
+    operation down rather than buffering without limit.
+    """
+
+    def __init__(self, operation, *args, **kwargs):
+        self._queue = Queue.Queue(kwargs.pop('maxsize', 0))
+        self.error = None
+        kwargs['on_event'] = self._queue.put
+        self._thread = threading.Thread(
+            target=self._run, args=(operation, args, kwargs), name='events')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, operation, args, kwargs):
+        try:
+            operation(*args, **kwargs)
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            self._queue.put(_END)
+
+    def __iter__(self):
+        while True:
+            event = self._queue.get()
+            if event is _END:
+                break
+            yield event
+        self._thread.join()
+        if self.error:
+            six.reraise(*self.error)
@@ -0,0 +1,218 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import sys
+import time
+import random
+import urllib2
+import urlparse
+import threading
+
+from . import logger, six
+
+
+# seconds after the first failure of a download during which it is retried
+DEFAULT_RETRY_BUDGET = 120
+DEFAULT_INITIAL_CONCURRENCY = 2
+# backoff delays double from the base delay up to the max delay
+BASE_DELAY = 0.5
+MAX_DELAY = 30
+# throughput has to improve this much for concurrency to grow
+IMPROVEMENT = 0.1
+# http errors which say nothing about the resource itself
+RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+
+lgr = logger.init()
+
+
+def is_retryable(ex):
+    if isinstance(ex, urllib2.HTTPError):
+        return ex.code in RETRYABLE_STATUSES
+    return True
+
+
+def retry_after(ex):
+    """Returns the seconds a `Retry-After` header of an HTTP error asks
+    to wait, if any.
+    """
+    if not isinstance(ex, urllib2.HTTPError) or not ex.hdrs:
+        return None
+    value = ex.hdrs.get('Retry-After')
+    return min(int(value), MAX_DELAY) if value and value.isdigit() else None
+
+
+class HostController(object):
+    """Adapts the number of concurrent downloads from one host.
+
+    Concurrency starts at `initial` and grows by one whenever the
+    throughput of the last `limit` downloads beats that of the ones
+    before (additive increase), up to `maximum`. A failure halves it
+    (multiplicative decrease) and pauses the host for a jittered delay
+    which doubles with every failure in a row, or for as long as the
+    host asked with a `Retry-After` header.
+    """
+
+    def __init__(self, host, maximum, initial=DEFAULT_INITIAL_CONCURRENCY,
+                 clock=time.time):
+        self.host = host
+        self.maximum = max(maximum, 1)
+        self.limit = min(initial, self.maximum)
+        self.active = 0
+        self.failures = 0
+        self.resume_at = 0
+        # bytes per second of the last window of downloads
+        self.rate = None
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_bytes = 0
+        self._window_count = 0
+        self._window_start = None
+
+    def acquire(self):
+        """Blocks until a download from the host may start.
+        """
+        with self._cond:
+            while True:
+                wait = self.resume_at - self._clock()
+                if wait <= 0 and self.active < self.limit:
+                    break
+                self._cond.wait(wait if wait > 0 else None)
+            self.active += 1
+            if self._window_start is None:
+                self._window_start = self._clock()
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def succeeded(self, size=None):
+        """Records a finished download of `size` bytes. Requests without
+        a size (e.g. of small metadata files) do not count towards the
+        throughput.
+        """
+        with self._cond:
+            self.failures = 0
+            if size is None:
+                return
+            self._window_bytes += size
+            self._window_count += 1
+            if self._window_start is None:
+                # the window was reset by a failure during the download
+                self._window_start = self._clock()
+            if self._window_count < self.limit:
+                return
+            elapsed = self._clock() - self._window_start
+            rate = self._window_bytes / elapsed if elapsed > 0 else None
+            improved = rate and (
+                self.rate is None or rate > self.rate * (1 + IMPROVEMENT))
+            if improved and self.limit < self.maximum:
+                self.limit += 1
+                lgr.debug('Downloading up to %s files at once from %s',
+                          self.limit, self.host)
+                self._cond.notify_all()
+            self.rate = rate or self.rate
+            self._reset_window()
+
+    def failed(self, retry_after=None):
+        """Backs off after a failed download and returns the delay before
+        the host is used again.
+        """
+        with self._cond:
+            self.failures += 1
+            self.limit = max(self.limit // 2, 1)
+            delay = retry_after if retry_after is not None else \
+                min(MAX_DELAY, BASE_DELAY * 2 ** (self.failures - 1)) * \
+                random.uniform(0.5, 1)
+            self.resume_at = max(self.resume_at, self._clock() + delay)
+            self._reset_window()
+            return delay
+
+
+class Hosts(object):
+    """Controls the downloads from every host (see `HostController`) and
+    retries failed downloads.
+    """
+
+    def __init__(self, maximum, budget=DEFAULT_RETRY_BUDGET,
+                 clock=time.time, sleep=time.sleep):
+        self.maximum = maximum
+        self.budget = budget
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._controllers = {}
+
+    def get(self, url):
+        host = urlparse.urlsplit(url).netloc.lower()
+        with self._lock:
+            if host not in self._controllers:
+                self._controllers[host] = HostController(
+                    host, self.maximum, clock=self._clock)
+            return self._controllers[host]
+
+    def attempt(self, url, func, size=None):
+        """Calls `func` once a download from the host of `url` may start.
+
+        A failure backs the host off and is raised. `size` returns the
+        bytes transferred, given what `func` returned. Without it, the
+        call does not count towards the host's throughput.
+        """
+        controller = self.get(url)
+        controller.acquire()
+        try:
+            result = func()
+        except Exception as ex:
+            error = sys.exc_info()
+            if is_retryable(ex):
+                controller.failed(retry_after(ex))
+            six.reraise(*error)
+        else:
+            controller.succeeded(size(result) if size else None)
+            return result
+        finally:
+            controller.release()
+
+    def call(self, url, func, size=None):
+        """Calls `func` like `attempt` does, retrying failures.
+
+        Failures are retried once the host's backoff delay passed, until
+        `budget` seconds have passed since the first one. HTTP errors
+        other than timeouts, throttling and server errors are not
+        retried.
+        """
+        deadline = None
+        while True:
+            try:
+                return self.attempt(url, func, size)
+            except Exception as ex:
+                error = sys.exc_info()
+                if not is_retryable(ex):
+                    six.reraise(*error)
+                now = self._clock()
+                # the host was paused by this or a concurrent failure
+                delay = max(self.get(url).resume_at - now, 0)
+                if deadline is None:
+                    deadline = now + self.budget
+                if now + delay > deadline:
+                    lgr.error('Giving up on %s (retry budget of %ss spent)',
+                              url, self.budget)
+                    six.reraise(*error)
+                lgr.warn('Failed fetching %s (%s). Retrying in %.1fs',
+                         url, ex, delay)
+            self._sleep(delay)
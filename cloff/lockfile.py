@@ -0,0 +1,62 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import json
+
+from . import logger
+
+
+VERSION = 1
+
+lgr = logger.init()
+
+
+def write(path, source, tag, prefixes, depth, resources):
+    """Writes a lock file recording everything `create` resolved.
+
+    `resources` maps each url to a dict with the `path` it is archived
+    under, its `size` and `md5` and the content of its md5 file (`md5_file`,
+    if there is one), and the `depth` it was found at. Resources not archived
+    (missing, or sharing their path with another url) have a `size` of
+    None.
+    """
+    lgr.info('Writing lock file {0}...'.format(path))
+    with open(path, 'w') as f:
+        json.dump({
+            'version': VERSION,
+            'source': source,
+            'tag': tag,
+            'prefixes': list(prefixes),
+            'depth': depth,
+            'resources': [dict(resource, url=url)
+                          for url, resource in sorted(resources.items())],
+        }, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def read(path):
+    """Reads a lock file written by `write`.
+
+    Returns the lock with its resources keyed by url.
+    """
+    lgr.info('Reading lock file {0}...'.format(path))
+    with open(path) as f:
+        lock = json.load(f)
+    if lock.get('version') != VERSION:
+        raise ValueError('Unsupported lock file version {0} in {1}'.format(
+            lock.get('version'), path))
+    lock['resources'] = dict(
+        (resource.pop('url'), resource) for resource in lock['resources'])
+    return lock
@@ -1,10 +1,43 @@
 import os
 import sys
+import json
+import time
+import Queue
+import atexit
 import logging
-import dictconfig
+import threading
+from contextlib import contextmanager
 
 DEFAULT_BASE_LOGGING_LEVEL = logging.INFO
 DEFAULT_VERBOSE_LOGGING_LEVEL = logging.DEBUG
+# the most records handled by the listener thread at once
+DEFAULT_BATCH_SIZE = 256
+# what `JsonFormatter` adds to the message of span records
+SPAN_FIELDS = ('operation', 'url', 'bytes', 'duration', 'outcome')
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as JSON objects, one per line, with the fields of
+    spans (see `span`) next to the message.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for field in SPAN_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, sort_keys=True)
+
 
 LOGGER = {
     "version": 1,
@@ -14,6 +47,9 @@ LOGGER = {
         },
         "console": {
             "format": "%(levelname)s - %(message)s"
+        },
+        "json": {
+            "()": JsonFormatter
         }
     },
     "handlers": {
@@ -48,9 +84,230 @@ def init(base_level=DEFAULT_BASE_LOGGING_LEVEL,
     return lgr
 
 
-def configure():
+def set_format(console='console', file='file'):
+    """Sets the formatters of the console and file handlers, e.g. to
+    `json` for machine readable logs.
+    """
+    LOGGER['handlers']['console']['formatter'] = console
+    LOGGER['handlers']['file']['formatter'] = file
+
+
+@contextmanager
+def span(lgr, operation, url=None, level=logging.INFO):
+    """Times the enclosed block and logs it as a span of `operation`.
+
+    Yields a dict of the span's fields in which the block can set the
+    `bytes` processed or its `outcome`, which is `ok` unless the block
+    raises, in which case it is the name of the exception.
+    """
+    fields = {'operation': operation, 'url': url, 'bytes': None,
+              'outcome': None}
+    start = time.time()
+    try:
+        yield fields
+    except Exception as ex:
+        fields['outcome'] = type(ex).__name__
+        raise
+    finally:
+        if lgr.isEnabledFor(level):
+            fields['duration'] = time.time() - start
+            fields['outcome'] = fields['outcome'] or 'ok'
+            lgr.log(level, '%s %s: %s (%s bytes in %.3fs)', operation,
+                    url or '', fields['outcome'], fields['bytes'] or 0,
+                    fields['duration'], extra=fields)
+
+
+_STOP = object()
+
+_listener = None
+
+
+class _Flush(object):
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class QueueHandler(logging.Handler):
+    """Puts records on a queue to be handled by a `QueueListener`
+    (a backport of python 3's `logging.handlers.QueueHandler`).
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        # the arguments and the traceback may have changed by the time
+        # the listener gets to the record, so they are rendered now
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def handle(self, record):
+        # the queue is thread safe, so the handler lock is not needed
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """Handles the records queued by `QueueHandler`s with `handlers`,
+    in a background thread.
+
+    Whatever is waiting on the queue, up to `batch_size` records, is
+    handled at once, taking the lock of each handler once per batch.
+    """
+
+    def __init__(self, queue, handlers, batch_size=DEFAULT_BATCH_SIZE):
+        self.queue = queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='logger')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            self.handle([item for item in batch
+                         if isinstance(item, logging.LogRecord)])
+            for item in batch:
+                if isinstance(item, _Flush):
+                    item.done.set()
+            if batch[-1] is _STOP:
+                return
+
+    def handle(self, records):
+        for handler in self.handlers:
+            handler.acquire()
+            try:
+                for record in records:
+                    if record.levelno >= handler.level and \
+                            handler.filter(record):
+                        handler.emit(record)
+            finally:
+                handler.release()
+
+    def flush(self):
+        """Waits for the records queued so far to be handled.
+        """
+        if self._thread:
+            marker = _Flush()
+            self.queue.put(marker)
+            marker.done.wait()
+
+    def stop(self):
+        """Handles the records still queued and stops the thread.
+        """
+        if self._thread:
+            self.queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+
+def queue_handlers(logger, batch_size=DEFAULT_BATCH_SIZE):
+    """Moves the handlers of `logger` behind a queue, so that logging
+    only costs the calling thread a queue put while the file and
+    console I/O happen in a listener thread.
+    """
+    global _listener
+    stop()
+    queue = Queue.Queue()
+    _listener = QueueListener(queue, logger.handlers[:], batch_size)
+    for handler in _listener.handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(QueueHandler(queue))
+    _listener.start()
+
+
+def flush():
+    """Waits for the records queued so far to be written, e.g. before
+    printing to the console.
+    """
+    if _listener:
+        _listener.flush()
+
+
+def stop():
+    """Writes out all queued records and stops the listener thread.
+    """
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop)
+
+
+class _DeferredConfiguration(logging.Handler):
+    """Stands in for the configured handlers until the first record is
+    logged, so that commands which log nothing never set logging up.
+    """
+
+    def __init__(self, queued):
+        logging.Handler.__init__(self)
+        self.queued = queued
+
+    def handle(self, record):
+        lgr = logging.getLogger('user')
+        with _configuring:
+            if self in lgr.handlers:
+                # the logger is iterating over its current handler list,
+                # so the configured handlers are added to a new one
+                lgr.handlers = [self]
+                _configure(self.queued)
+        for handler in lgr.handlers:
+            if handler is not self and record.levelno >= handler.level:
+                handler.handle(record)
+        return True
+
+    def emit(self, record):
+        pass
+
+
+_configuring = threading.Lock()
+
+
+def configure(queued=True, deferred=True):
     """Configures the logger using the default configuration.
+
+    With `queued`, records are handled by a background thread (see
+    `queue_handlers`). With `deferred`, the configuration (and creating
+    the log file) waits until the first record is logged.
     """
+    if not deferred:
+        return _configure(queued)
+    stop()
+    lgr = logging.getLogger('user')
+    for handler in lgr.handlers[:]:
+        lgr.removeHandler(handler)
+        handler.close()
+    lgr.addHandler(_DeferredConfiguration(queued))
+
+
+def _configure(queued):
+    # importing the vendored dictconfig takes a while
+    import dictconfig
     try:
         log_file = LOGGER['handlers']['file']['filename']
     except KeyError as ex:
@@ -63,7 +320,11 @@ def configure():
     try:
         if not os.path.exists(log_dir) and not len(log_dir) == 0:
             os.makedirs(log_dir)
+        # the handlers of a previous configuration are closed below
+        stop()
         dictconfig.dictConfig(LOGGER)
+        if queued:
+            queue_handlers(logging.getLogger('user'))
 
     except ValueError as ex:
         sys.exit('Could not configure logger.'
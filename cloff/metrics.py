@@ -0,0 +1,164 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import bisect
+import threading
+from collections import defaultdict
+
+
+METRICS_PATH = '/_cloff/metrics'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+SIZE_BUCKETS = (
+    1024, 16 * 1024, 256 * 1024, 1024 ** 2, 16 * 1024 ** 2,
+    128 * 1024 ** 2, 512 * 1024 ** 2, 1024 ** 3)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = ['{0}="{1}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_bound(bound):
+    return repr(float(bound)) if bound != float('inf') else '+Inf'
+
+
+class Histogram(object):
+    """A cumulative histogram with fixed upper bounds.
+    """
+
+    def __init__(self, buckets):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics(object):
+    """Collects request metrics for the resource server.
+
+    Recording a request only touches a couple of dicts under a single
+    uncontended lock, so it is cheap enough for every request. All
+    formatting is deferred until the metrics endpoint is scraped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.bytes_sent = defaultdict(int)
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.response_size = defaultdict(lambda: Histogram(SIZE_BUCKETS))
+        self.cache = defaultdict(int)
+        self.active_connections = 0
+        self.in_flight = 0
+
+    def connection_opened(self):
+        with self._lock:
+            self.active_connections += 1
+
+    def connection_closed(self):
+        with self._lock:
+            self.active_connections -= 1
+
+    def request_started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def request_finished(self, path, method, status, size, duration):
+        with self._lock:
+            self.in_flight -= 1
+            self.requests[(path, method, status)] += 1
+            self.bytes_sent[path] += size
+            self.latency[path].observe(duration)
+            self.response_size[path].observe(size)
+
+    def cache_lookup(self, cache, hit):
+        with self._lock:
+            self.cache[(cache, 'hit' if hit else 'miss')] += 1
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            requests = sorted(self.requests.items())
+            bytes_sent = sorted(self.bytes_sent.items())
+            latency = sorted(
+                (p, list(h.samples()), h.sum)
+                for p, h in self.latency.items())
+            sizes = sorted(
+                (p, list(h.samples()), h.sum)
+                for p, h in self.response_size.items())
+            cache = sorted(self.cache.items())
+            active, in_flight = self.active_connections, self.in_flight
+
+        lines = []
+
+        def add(name, kind, description, samples):
+            lines.append('# HELP {0} {1}'.format(name, description))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for suffix, labels, value in samples:
+                lines.append('{0}{1}{2} {3}'.format(
+                    name, suffix, labels, value))
+
+        def histogram(name, description, series):
+            samples = []
+            for path, buckets, total in series:
+                for bound, count in buckets:
+                    samples.append(('_bucket', _labels(
+                        ('path',), (path,),
+                        'le="{0}"'.format(_format_bound(bound))), count))
+                samples.append(('_sum', _labels(('path',), (path,)), total))
+                samples.append(
+                    ('_count', _labels(('path',), (path,)), buckets[-1][1]))
+            add(name, 'histogram', description, samples)
+
+        add('cloff_http_requests_total', 'counter',
+            'Number of HTTP requests handled.',
+            [('', _labels(('path', 'method', 'status'), k), v)
+             for k, v in requests])
+        add('cloff_http_response_bytes_total', 'counter',
+            'Number of response body bytes sent.',
+            [('', _labels(('path',), (k,)), v) for k, v in bytes_sent])
+        histogram('cloff_http_request_duration_seconds',
+                  'Time spent handling a request.', latency)
+        histogram('cloff_http_response_size_bytes',
+                  'Size of response bodies.', sizes)
+        add('cloff_http_active_connections', 'gauge',
+            'Number of open client connections.', [('', '', active)])
+        add('cloff_http_requests_in_flight', 'gauge',
+            'Number of requests currently being handled.',
+            [('', '', in_flight)])
+        add('cloff_cache_requests_total', 'counter',
+            'Number of cache lookups by cache and result.',
+            [('', _labels(('cache', 'result'), k), v) for k, v in cache])
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,206 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import time
+import urllib2
+import threading
+from contextlib import closing
+
+from . import logger, rewriter, planner
+
+
+# bytes of a resource read to measure the throughput of a mirror
+PROBE_SIZE = 256 * 1024
+PROBE_TIMEOUT = 10
+# mirrors up to this many times slower than the fastest one share the load
+SPREAD = 2
+# failures in a row after which a mirror is no longer used
+MAX_FAILURES = 3
+
+lgr = logger.init()
+
+
+def read_mirrors(path):
+    """Reads the mirrors of url prefixes from a file, one prefix per line
+    followed by its mirrors, e.g.
+
+        http://repository.cloudifysource.org/org http://mirror.local/org
+
+    Empty lines and lines starting with `#` are ignored. Returns a list
+    of `(prefix, mirror)` tuples.
+    """
+    mirrors = []
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if parts and not parts[0].startswith('#'):
+                mirrors.extend((parts[0], mirror) for mirror in parts[1:])
+    return mirrors
+
+
+def probe_url(url, size=PROBE_SIZE):
+    """Fetches the first `size` bytes of `url`.
+
+    Returns the seconds until the response arrived and the bytes per
+    second read after that, which is None if nothing was read (e.g. the
+    url does not exist). Fails if the server could not be reached.
+    """
+    start = time.time()
+    try:
+        response = urllib2.urlopen(url, timeout=PROBE_TIMEOUT)
+    except urllib2.HTTPError:
+        return time.time() - start, None
+    with closing(response):
+        latency = time.time() - start
+        read = len(response.read(size))
+    elapsed = time.time() - start - latency
+    return latency, read / elapsed if read and elapsed > 0 else None
+
+
+class Mirror(object):
+    """A location serving the resources under a prefix. The prefix itself
+    is the canonical one.
+    """
+
+    def __init__(self, prefix, url):
+        self.prefix = prefix
+        self.url = url if url == prefix else \
+            url.rstrip('/') + ('/' if prefix.endswith('/') else '')
+        self.latency = None
+        self.throughput = None
+        self.failures = 0
+        self.active = 0
+
+    @property
+    def canonical(self):
+        return self.url == self.prefix
+
+    @property
+    def healthy(self):
+        return self.latency is not None and self.failures < MAX_FAILURES
+
+    def locate(self, url):
+        """Returns the url of a resource under the prefix on this mirror.
+        """
+        return self.url + url[len(self.prefix):]
+
+    def cost(self, throughput):
+        """Returns the estimated seconds a probe sized download takes,
+        assuming `throughput` if the mirror's is unknown.
+        """
+        throughput = self.throughput or throughput
+        return self.latency + (PROBE_SIZE / throughput if throughput else 0)
+
+
+class Mirrors(object):
+    """Chooses where to download the resources under mirrored prefixes.
+
+    The mirrors of a prefix, and the prefix itself, are probed for their
+    latency and throughput with the first resource requested under it.
+    Downloads are spread over the healthy ones up to `SPREAD` times
+    slower than the fastest, favouring the least busy, and the rest are
+    kept to fail over to. Mirrors which cannot be reached, or fail
+    `MAX_FAILURES` times in a row, are no longer used.
+    """
+
+    def __init__(self, mirrors, probe=None):
+        self._probe = probe or probe_url
+        self._lock = threading.Lock()
+        self._probes = {}
+        self._mirrors = {}
+        prefixes = sorted(set(prefix for prefix, _ in mirrors))
+        self.rewriter = rewriter.UrlRewriter(prefixes)
+        for prefix, mirror in mirrors:
+            # prefixes are keyed as they are matched, with the host
+            # lowercased
+            prefix = self.rewriter.match(prefix)
+            if prefix not in self._mirrors:
+                self._mirrors[prefix] = [Mirror(prefix, prefix)]
+            self._mirrors[prefix].append(Mirror(prefix, mirror))
+
+    def choose(self, url):
+        """Returns the mirrors to download `url` from, in order. The
+        canonical location is one of them, unless it is unreachable.
+
+        Returns an empty list for urls which are not mirrored.
+        """
+        prefix = self.rewriter.match(url)
+        if not prefix:
+            return []
+        self._wait_for_probe(prefix, url)
+        with self._lock:
+            healthy = [m for m in self._mirrors[prefix] if m.healthy]
+            if not healthy:
+                return []
+            known = [m.throughput for m in healthy if m.throughput]
+            # mirrors missing the probed resource are assumed to be as
+            # slow as the slowest one
+            slowest = min(known) if known else None
+            healthy.sort(key=lambda m: m.cost(slowest))
+            limit = healthy[0].cost(slowest) * SPREAD
+            spread = [m for m in healthy if m.cost(slowest) <= limit]
+            spread.sort(key=lambda m: (m.active + 1) * m.cost(slowest))
+            return spread + healthy[len(spread):]
+
+    def _wait_for_probe(self, prefix, url):
+        with self._lock:
+            probed = self._probes.get(prefix)
+            first = probed is None
+            if first:
+                probed = self._probes[prefix] = threading.Event()
+        if not first:
+            probed.wait()
+            return
+        try:
+            threads = [threading.Thread(
+                target=self._probe_mirror, args=(mirror, url),
+                name='probe-{0}'.format(i))
+                for i, mirror in enumerate(self._mirrors[prefix])]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            probed.set()
+
+    def _probe_mirror(self, mirror, url):
+        try:
+            latency, throughput = self._probe(mirror.locate(url))
+        except Exception as ex:
+            lgr.warn('Mirror %s is unreachable (%s). Not using it',
+                     mirror.url, ex)
+            return
+        with self._lock:
+            mirror.latency, mirror.throughput = latency, throughput
+        lgr.info('Mirror %s: latency %.0fms, throughput %s/s', mirror.url,
+                 latency * 1000, planner.format_size(throughput))
+
+    def started(self, mirror):
+        with self._lock:
+            mirror.active += 1
+
+    def finished(self, mirror, ok=True):
+        """Records the end of a download from `mirror`. Downloads which
+        failed or did not match their md5 are not `ok`.
+        """
+        with self._lock:
+            mirror.active -= 1
+            if ok:
+                mirror.failures = 0
+                return
+            mirror.failures += 1
+            if mirror.failures == MAX_FAILURES:
+                lgr.warn('Mirror %s failed %s times in a row. Not using it',
+                         mirror.url, MAX_FAILURES)
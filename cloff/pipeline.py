@@ -0,0 +1,279 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import os
+import sys
+import time
+import Queue
+import bisect
+import tarfile
+import itertools
+import threading
+from contextlib import closing
+
+from . import logger, six, timing, events
+
+
+DEFAULT_WORKERS = 4
+DEFAULT_SPOOL_SIZE = 32 * 1024 ** 2
+
+lgr = logger.init()
+
+_STOP = object()
+
+
+class SizeQueue(object):
+    """A work queue handing out the largest item first.
+
+    Items of unknown size go before all others, as they may well be the
+    largest. Starting the largest items first keeps a large item queued
+    late from running long after everything else finished (for items
+    known upfront, the total time is then within 4/3 of the best
+    possible). `get(smallest=True)`
+    hands out the smallest item instead, for a worker working through
+    the small items while the others transfer the large ones.
+
+    While `held`, only the smallest items are handed out, so that all
+    items known upfront can be queued before the first large one is
+    picked while the worker taking the small ones is already busy. Has
+    the methods of `Queue.Queue` that `WorkerPool` uses.
+    """
+
+    def __init__(self, held=False):
+        self._items = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._unfinished = 0
+        self._held = held
+
+    def put(self, item, size=None):
+        # equal sizes are handed out in the order they were queued
+        key = (1, 0) if size is None else (0, size)
+        with self._cond:
+            bisect.insort(self._items, (key, next(self._counter), item))
+            self._unfinished += 1
+            self._cond.notify_all()
+
+    def get(self, smallest=False):
+        with self._cond:
+            while (self._held and not smallest) or not self._items:
+                self._cond.wait()
+            # the first queued of the smallest or of the largest items
+            index = 0 if smallest else bisect.bisect_left(
+                self._items, (self._items[-1][0],))
+            return self._items.pop(index)[2]
+
+    def release(self):
+        with self._cond:
+            self._held = False
+            self._cond.notify_all()
+
+    def task_done(self):
+        with self._cond:
+            self._unfinished -= 1
+            if not self._unfinished:
+                self._cond.notify_all()
+
+    def join(self):
+        with self._cond:
+            while self._unfinished:
+                self._cond.wait()
+
+
+class WorkerPool(object):
+    """Runs `func` on queued items in a fixed number of threads.
+
+    Items can be queued while earlier ones are being processed. Once an
+    item fails, the remaining items are dropped and `join` re-raises the
+    first error.
+
+    Items are processed in the order they were queued, unless `queue`
+    is a `SizeQueue`, in which case the first of several workers takes
+    the smallest items and the others the largest.
+
+    A pool which is not joined must be stopped, or its workers keep
+    processing what is queued.
+    """
+
+    def __init__(self, func, workers=DEFAULT_WORKERS, name='worker',
+                 queue=None):
+        self.func = func
+        self.error = None
+        self._stopping = False
+        self._stopped = False
+        self._queue = queue or Queue.Queue()
+        self._threads = []
+        workers = max(workers, 1)
+        for i in range(workers):
+            smallest = i == 0 and workers > 1 and \
+                isinstance(self._queue, SizeQueue)
+            thread = threading.Thread(
+                target=self._work, args=(smallest,),
+                name='{0}-{1}'.format(name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, item, **kwargs):
+        self._queue.put(item, **kwargs)
+
+    def release(self):
+        """Starts handing out the items of a held `SizeQueue`.
+        """
+        self._queue.release()
+
+    def _work(self, smallest):
+        while True:
+            item = self._queue.get(smallest=True) if smallest \
+                else self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                if not self.error and not self._stopping:
+                    self.func(item)
+            except Exception:
+                lgr.debug('Failed processing %s', item, exc_info=True)
+                self.error = self.error or sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """Waits for all queued items, stops the workers and re-raises the
+        first error, if any.
+        """
+        self._stop_workers()
+        if self.error:
+            six.reraise(*self.error)
+
+    def stop(self):
+        """Drops the queued items, waits for the ones being processed and
+        stops the workers. Errors are not raised.
+        """
+        self._stopping = True
+        if isinstance(self._queue, SizeQueue):
+            self._queue.release()
+        self._stop_workers()
+
+    def _stop_workers(self):
+        if self._stopped:
+            return
+        self._queue.join()
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._stopped = True
+
+
+class ArchiveWriter(object):
+    """Writes files to a tar.gz archive from a single background thread.
+
+    Files are added under `<basename of root>/<path relative to root>` in
+    the order they are queued, so producers do not wait for compression
+    until `maxsize` files are queued. Bounding the queue keeps fast
+    producers from piling up every file in memory or spool files.
+    Besides paths on disk, file objects can be queued with `add_file` so
+    that their content never has to be written anywhere but the archive.
+    Time spent archiving is recorded in `report` and every file written
+    is reported to `emit` (see `events.emitter`).
+    """
+
+    def __init__(self, destination, root, report=None, emit=None,
+                 maxsize=0):
+        self.destination = destination
+        self.root = root
+        self.report = report or timing.Report()
+        self.emit = emit or events.emitter(None)
+        self.error = None
+        self._queue = Queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._write, name='archiver')
+        self._thread.daemon = True
+        lgr.info('Creating tar.gz archive: {0}...'.format(destination))
+        self._thread.start()
+
+    def arcname(self, path):
+        return os.path.join(
+            os.path.basename(self.root), os.path.relpath(path, self.root))
+
+    def add(self, path):
+        self._queue.put(path)
+
+    def add_file(self, relative_path, fileobj, size, name=None,
+                 on_archived=None):
+        """Queues a file object to be archived as `relative_path` (relative
+        to the root). The file object is closed once it was archived,
+        unless it is handed to `on_archived`, which then owns it.
+        `name` (e.g. the url the file came from) is what its `ARCHIVED`
+        event refers to, and defaults to the path in the archive.
+        """
+        info = tarfile.TarInfo(self.arcname(
+            os.path.join(self.root, relative_path)))
+        info.size = size
+        info.mtime = time.time()
+        info.mode = 0o644
+        self._queue.put((info, fileobj, name, on_archived))
+
+    def _write(self):
+        try:
+            with tarfile.open(self.destination, 'w:gz') as tar:
+                while True:
+                    item = self._queue.get()
+                    if item is _STOP:
+                        return
+                    if isinstance(item, tuple):
+                        info, fileobj, name, on_archived = item
+                        lgr.debug('Archiving %s', info.name)
+                        with self.report.phase('archive', info.size):
+                            if on_archived:
+                                tar.addfile(info, fileobj)
+                            else:
+                                with closing(fileobj):
+                                    tar.addfile(info, fileobj)
+                        if on_archived:
+                            on_archived(fileobj)
+                        self.emit(events.ARCHIVED, name or info.name,
+                                  info.size)
+                    else:
+                        lgr.debug('Archiving %s', item)
+                        with self.report.phase('archive'):
+                            tar.add(item, arcname=self.arcname(item))
+                        self.emit(events.ARCHIVED, self.arcname(item))
+        except Exception:
+            self.error = sys.exc_info()
+            # keep draining so that `close` does not block
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+                if isinstance(item, tuple):
+                    item[1].close()
+
+    def close(self):
+        """Waits for all queued files to be written and closes the archive.
+        """
+        self._queue.put(_STOP)
+        self._thread.join()
+        if self.error:
+            six.reraise(*self.error)
+
+    def abort(self):
+        """Closes the archive and removes it.
+        """
+        try:
+            self.close()
+        except Exception:
+            pass
+        if os.path.isfile(self.destination):
+            os.remove(self.destination)
@@ -0,0 +1,204 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import math
+import threading
+
+
+class PlannedResource(object):
+    """What is known about a resource without downloading it.
+    """
+
+    def __init__(self, url, path, size=None, etag=None, md5=None,
+                 cached=False, missing=False, changed=False, references=1,
+                 latency=None, error=None):
+        self.url = url
+        self.path = path
+        self.size = size
+        self.etag = etag
+        self.md5 = md5
+        self.cached = cached
+        self.missing = missing
+        # the size differs from the one recorded in the lock
+        self.changed = changed
+        self.references = references
+        self.latency = latency
+        # why the resource could not be checked, if it could not
+        self.error = error
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+def format_size(size):
+    if size is None:
+        return '?'
+    for unit in ('B', 'K', 'M'):
+        if size < 1024:
+            return '{0:.0f}{1}'.format(size, unit) if unit == 'B' \
+                else '{0:.1f}{1}'.format(size, unit)
+        size /= 1024.0
+    return '{0:.1f}G'.format(size)
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return 'unknown'
+    minutes, seconds = divmod(int(math.ceil(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0}h{1:02d}m{2:02d}s'.format(hours, minutes, seconds) if hours \
+        else '{0}m{1:02d}s'.format(minutes, seconds)
+
+
+class Plan(object):
+    """A dry run of `create`: the resources it would fetch and what
+    fetching them would cost.
+
+    The transfer time is estimated from `throughput` (bytes per second,
+    measured while fetching the blueprints repo) and from the latency of
+    the HEAD requests, assuming `workers` parallel downloads.
+    """
+
+    def __init__(self, workers, throughput=None):
+        self.workers = max(workers, 1)
+        self.throughput = throughput
+        self.resources = []
+        self._lock = threading.Lock()
+
+    def add(self, resource):
+        with self._lock:
+            self.resources.append(resource)
+
+    def _available(self):
+        return [r for r in self.resources if not r.missing]
+
+    @property
+    def hits(self):
+        return [r for r in self._available() if r.cached]
+
+    @property
+    def misses(self):
+        return [r for r in self._available() if not r.cached]
+
+    @property
+    def missing(self):
+        return [r for r in self.resources if r.missing]
+
+    @property
+    def changed(self):
+        return [r for r in self.resources if r.changed]
+
+    @property
+    def errors(self):
+        return [r for r in self.resources if r.error]
+
+    @property
+    def duplicates(self):
+        """Returns the number of references to resources already
+        referenced elsewhere, and the urls sharing their archive path with
+        another url (which `create` skips).
+        """
+        references = sum(r.references - 1 for r in self.resources)
+        seen = set()
+        shared = []
+        for resource in sorted(self._available(), key=lambda r: r.url):
+            if resource.path in seen:
+                shared.append(resource.url)
+            seen.add(resource.path)
+        return references, shared
+
+    @property
+    def unknown_sizes(self):
+        return [r for r in self._available() if r.size is None]
+
+    def total(self, resources):
+        return sum(r.size or 0 for r in resources)
+
+    @property
+    def latency(self):
+        latencies = [r.latency for r in self.resources if r.latency]
+        return sum(latencies) / len(latencies) if latencies else 0
+
+    def estimate(self):
+        """Returns the estimated transfer time in seconds, or None if the
+        throughput is unknown.
+        """
+        misses = self.misses
+        if not misses:
+            return 0
+        if not self.throughput:
+            return None
+        rounds = int(math.ceil(len(misses) / float(self.workers)))
+        return self.total(misses) / float(self.throughput) + \
+            rounds * self.latency
+
+    def to_dict(self):
+        references, shared = self.duplicates
+        return {
+            'resources': [r.to_dict() for r in
+                          sorted(self.resources, key=lambda r: r.url)],
+            'total_bytes': self.total(self._available()),
+            'download_bytes': self.total(self.misses),
+            'cache_hits': len(self.hits),
+            'cache_misses': len(self.misses),
+            'missing': [r.url for r in self.missing],
+            'changed': [r.url for r in self.changed],
+            'errors': dict((r.url, r.error) for r in self.errors),
+            'duplicate_references': references,
+            'shared_paths': shared,
+            'throughput': self.throughput,
+            'estimated_seconds': self.estimate(),
+        }
+
+    def render(self):
+        """Returns a human readable report.
+        """
+        lines = []
+        width = max([len(r.url) for r in self.resources] + [3])
+        lines.append('{0:<{1}}  {2:>8}  {3}'.format('URL', width, 'SIZE',
+                                                    'STATUS'))
+        for resource in sorted(self.resources, key=lambda r: r.url):
+            status = 'missing' if resource.missing else \
+                'cached' if resource.cached else 'download'
+            if resource.changed:
+                status += ' (changed since locked)'
+            if resource.error:
+                status += ' (could not be checked: {0})'.format(
+                    resource.error)
+            lines.append('{0:<{1}}  {2:>8}  {3}'.format(
+                resource.url, width, format_size(resource.size), status))
+        references, shared = self.duplicates
+        lines.append('')
+        lines.append('Resources:       {0} ({1} missing)'.format(
+            len(self.resources), len(self.missing)))
+        lines.append('Total size:      {0}'.format(
+            format_size(self.total(self._available()))))
+        lines.append('Cache hits:      {0} ({1})'.format(
+            len(self.hits), format_size(self.total(self.hits))))
+        lines.append('Cache misses:    {0} ({1})'.format(
+            len(self.misses), format_size(self.total(self.misses))))
+        lines.append('Duplicates:      {0} references, {1} shared '
+                     'paths'.format(references, len(shared)))
+        if self.errors:
+            lines.append('Errors:          {0}'.format(len(self.errors)))
+        if self.unknown_sizes:
+            lines.append('Unknown sizes:   {0}'.format(
+                len(self.unknown_sizes)))
+        lines.append('Throughput:      {0}'.format(
+            format_size(self.throughput) + '/s' if self.throughput
+            else 'unknown'))
+        lines.append('Estimated time:  {0}'.format(
+            format_duration(self.estimate())))
+        return '\n'.join(lines)
@@ -0,0 +1,185 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import os
+import re
+import sys
+import time
+import threading
+from collections import defaultdict
+
+from . import logger
+
+
+MODES = ('auto', 'cprofile', 'sample')
+DEFAULT_INTERVAL = 0.005
+
+lgr = logger.init()
+
+
+def _thread_group(thread_name):
+    """Returns the name of the pool a thread belongs to, e.g. `download`
+    for `download-0` or `Thread` for the `Thread-N` serving a request.
+    """
+    return re.sub(r'[-_]\d+$', '', thread_name)
+
+
+def _thread_path(path, thread_name):
+    """Returns the path of the output of the threads of a pool, e.g.
+    `create.download.pstats` for `create.pstats`.
+    """
+    base, extension = os.path.splitext(path)
+    return '{0}.{1}{2}'.format(
+        base, re.sub(r'[^\w.-]', '_', _thread_group(thread_name)),
+        extension)
+
+
+class ThreadProfiler(object):
+    """Profiles every thread with its own `cProfile.Profile`.
+
+    Threads started while profiling are profiled from their first event
+    on. `stop` writes the stats of all threads, merged, to `path` and the
+    stats of the threads of each pool (e.g. all download workers, or all
+    request threads of a server), merged, to a file of its own next to
+    it. All of them can be read with `pstats` (or e.g. turned into flame
+    graphs with flameprof or snakeviz).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._profiles = []
+
+    def _add(self):
+        import cProfile
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append((threading.current_thread().name, profile))
+        return profile
+
+    def _start_thread(self, frame, event, arg):
+        # installed by `threading.setprofile` in every new thread. enabling
+        # the thread's own profiler replaces it.
+        sys.setprofile(None)
+        self._add().enable()
+
+    def start(self):
+        threading.setprofile(self._start_thread)
+        self._add().enable()
+
+    def stop(self):
+        import pstats
+        threading.setprofile(None)
+        with self._lock:
+            profiles = list(self._profiles)
+        # the main thread's profiler is the first one
+        profiles[0][1].disable()
+        merged = None
+        groups = {}
+        for thread_name, profile in profiles:
+            try:
+                stats = pstats.Stats(profile)
+            except TypeError:
+                # nothing was recorded in this thread
+                continue
+            group = _thread_path(self.path, thread_name)
+            if group in groups:
+                groups[group].add(stats)
+            else:
+                groups[group] = pstats.Stats(profile)
+            if merged:
+                merged.add(stats)
+            else:
+                merged = stats
+        for group, stats in groups.items():
+            stats.dump_stats(group)
+        if merged:
+            merged.dump_stats(self.path)
+        lgr.info('Profile written to {0}'.format(self.path))
+
+
+class Sampler(object):
+    """A sampling profiler for all threads.
+
+    A background thread records the stacks of all other threads every
+    `interval` seconds, which costs the profiled threads next to nothing
+    and, unlike `cProfile`, also sees time spent blocked on I/O. `stop`
+    writes the samples to `path` in the collapsed stack format used by
+    flamegraph.pl, speedscope and others, with the thread name as the
+    root frame, and writes the samples of the threads of each pool to a
+    file of its own next to it.
+    """
+
+    def __init__(self, path, interval=DEFAULT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.samples = defaultdict(lambda: defaultdict(int))
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sampler')
+        self._thread.daemon = True
+
+    def _sample(self):
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == self._thread.ident:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{0} ({1}:{2})'.format(
+                    code.co_name, os.path.basename(code.co_filename),
+                    code.co_firstlineno))
+                frame = frame.f_back
+            name = names.get(ident, 'thread-{0}'.format(ident))
+            self.samples[name][';'.join(reversed(stack))] += 1
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._sample()
+            time.sleep(self.interval)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        groups = defaultdict(lambda: defaultdict(int))
+        with open(self.path, 'w') as merged:
+            for name, stacks in sorted(self.samples.items()):
+                group = groups[_thread_path(self.path, name)]
+                for stack, count in sorted(stacks.items()):
+                    group[stack] += count
+                    merged.write('{0};{1} {2}\n'.format(name, stack, count))
+        for path, stacks in groups.items():
+            with open(path, 'w') as f:
+                for stack, count in sorted(stacks.items()):
+                    f.write('{0} {1}\n'.format(stack, count))
+        lgr.info('Profile written to {0}'.format(self.path))
+
+
+def start(path, mode='auto', interval=DEFAULT_INTERVAL):
+    """Starts profiling all threads and returns the profiler.
+
+    `auto` uses the sampler where the interpreter exposes the stacks of
+    all threads, and `cProfile` otherwise.
+    """
+    if mode == 'auto':
+        mode = 'sample' if hasattr(sys, '_current_frames') else 'cprofile'
+    profiler = Sampler(path, interval) if mode == 'sample' \
+        else ThreadProfiler(path)
+    lgr.debug('Profiling with {0} to {1}'.format(mode, path))
+    profiler.start()
+    return profiler
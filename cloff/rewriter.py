@@ -0,0 +1,143 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import re
+
+
+URL_PATTERN = re.compile(r'https?://[^\s\'"]+', re.IGNORECASE)
+# YAML flow collection and shell punctuation, which `URL_PATTERN` matches
+# at the end of a url (e.g. in `[http://a/x.rpm, ...]` or `curl url;`)
+TRAILING_PUNCTUATION = ',;)]}'
+
+
+def read_prefixes(path):
+    """Reads url prefixes from a file, one per line. Empty lines and lines
+    starting with `#` are ignored.
+    """
+    with open(path) as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def split_host(url):
+    """Splits a url into its (lowercased) `scheme://host` and the rest,
+    which is kept as is.
+    """
+    end = url.find('/', url.find('://') + 3)
+    return (url.lower(), '') if end == -1 else (url[:end].lower(), url[end:])
+
+
+class _PathTrie(object):
+    """The prefix paths under a host, indexed by their `/` separated
+    segments.
+
+    All segments of a prefix path but the last are matched exactly, by
+    walking down the trie. The last one may be a partial segment (e.g.
+    `/org/cloud` matches `/org/cloudify3`), so each node keeps the last
+    segments of the prefixes ending under it along with their lengths,
+    and looks up the leading part of the path's segment for each length.
+    """
+    __slots__ = ('children', 'ends', 'lengths')
+
+    def __init__(self):
+        self.children = {}
+        self.ends = {}
+        self.lengths = []
+
+    def add(self, path):
+        segments = path.split('/')
+        node = self
+        for segment in segments[:-1]:
+            node = node.children.setdefault(segment, _PathTrie())
+        last = segments[-1]
+        node.ends[last] = path
+        if len(last) not in node.lengths:
+            node.lengths.append(len(last))
+            node.lengths.sort(reverse=True)
+
+    def match(self, path):
+        """Returns the longest prefix path `path` starts with, or None.
+        """
+        segments = path.split('/')
+        nodes = []
+        node = self
+        for segment in segments:
+            nodes.append((node, segment))
+            node = node.children.get(segment)
+            if node is None:
+                break
+        # the deepest match is the longest one
+        for node, segment in reversed(nodes):
+            for length in node.lengths:
+                if length <= len(segment):
+                    prefix = node.ends.get(segment[:length])
+                    if prefix is not None:
+                        return prefix
+        return None
+
+
+class UrlRewriter(object):
+    """Finds and rewrites urls starting with any of a set of prefixes.
+
+    Prefixes are indexed by `scheme://host`, and the paths under each
+    host in a trie of their segments, so matching a url costs a dict
+    lookup per segment of its path no matter how many prefixes there
+    are, under the same host or not. Urls are found with a single
+    compiled regex and rewritten in the same pass over the text. Trailing
+    punctuation is not considered part of a url.
+    """
+
+    def __init__(self, prefixes):
+        self.prefixes = list(prefixes)
+        self._hosts = {}
+        for prefix in self.prefixes:
+            host, path = split_host(prefix)
+            self._hosts.setdefault(host, _PathTrie()).add(path)
+
+    def match(self, url):
+        """Returns the longest prefix `url` starts with, or None.
+        """
+        host, path = split_host(url)
+        paths = self._hosts.get(host)
+        prefix_path = paths.match(path) if paths else None
+        return None if prefix_path is None else host + prefix_path
+
+    def find(self, content):
+        """Yields every url in `content` which matches a prefix.
+        """
+        for match in URL_PATTERN.finditer(content):
+            url = match.group(0).rstrip(TRAILING_PUNCTUATION)
+            if self.match(url):
+                yield url
+
+    def rewrite(self, content, replace):
+        """Rewrites all matching urls in `content` in a single pass.
+
+        `replace` is called with the matched prefix and the url and
+        returns the new url. Returns the new content and the list of
+        (original) urls that matched, in order of appearance.
+        """
+        urls = []
+
+        def _replace(match):
+            text = match.group(0)
+            url = text.rstrip(TRAILING_PUNCTUATION)
+            prefix = self.match(url)
+            if not prefix:
+                return text
+            urls.append(url)
+            return replace(prefix, url) + text[len(url):]
+
+        return URL_PATTERN.sub(_replace, content), urls
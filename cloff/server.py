@@ -0,0 +1,418 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import os
+import time
+import logging
+import gzip
+import hashlib
+import posixpath
+import urllib
+import threading
+from StringIO import StringIO
+from contextlib import closing
+from collections import OrderedDict
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+
+from . import logger, utils, metrics, throttle, upstream
+
+
+# bytes of rewritten content kept in memory by a `BlueprintRewriter`
+REWRITE_CACHE_SIZE = 32 * 1024 ** 2
+
+lgr = logger.init()
+
+
+def accepts_gzip(accept_encoding):
+    """Returns True if an `Accept-Encoding` header value allows gzip.
+    """
+    for coding in (accept_encoding or '').split(','):
+        parts = [p.strip() for p in coding.split(';')]
+        if parts[0].lower() not in ('gzip', '*'):
+            continue
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    return float(param[2:]) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def _gzip(content):
+    compressed = StringIO()
+    with closing(gzip.GzipFile(
+            fileobj=compressed, mode='wb', compresslevel=9)) as gz:
+        gz.write(content)
+    return compressed.getvalue()
+
+
+class BlueprintRewriter(object):
+    """Rewrites the file server in blueprints while serving them.
+
+    The file server an archive was created with (`original`) is replaced
+    with `file_server` or, if it is not set, with the host the client
+    used to reach the server (its `Host` header). Rewritten blueprints
+    are cached in memory, along with their gzip compressed form, per
+    target file server. As clients choose the target, the cache is
+    bounded to `cache_size` bytes, evicting the least recently used.
+
+    `files` are the paths of the files to rewrite (the blueprints and
+    the crawled scripts, configs and resources pointing at the file
+    server). Their md5 and gzip variants are regenerated from the
+    rewritten content. Without `files`, the YAML files outside the
+    resources are rewritten.
+    """
+    extensions = ('.yaml', '.yml')
+    variants = ('.md5', '.gz')
+
+    def __init__(self, root, original, file_server=None, files=None,
+                 cache_size=REWRITE_CACHE_SIZE):
+        self.resources = os.path.join(root, upstream.RESOURCES_DIR) + os.sep
+        self.original = original
+        self.file_server = file_server
+        self.files = set(os.path.abspath(path) for path in files) \
+            if files is not None else None
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+
+    def applies(self, path):
+        if self.files is None:
+            return path.endswith(self.extensions) and \
+                not path.startswith(self.resources)
+        return path in self.files or bool(self._variant_of(path))
+
+    def _variant_of(self, path):
+        """Returns the rewritten file `path` is the md5 or gzip variant
+        of, if any.
+        """
+        base, extension = os.path.splitext(path)
+        if self.files is not None and path not in self.files and \
+                extension in self.variants and base in self.files:
+            return base
+
+    def target(self, host):
+        return self.file_server or 'http://{0}/'.format(host)
+
+    def rewrite(self, path, host):
+        """Returns the rewritten and the gzipped content of `path`. The
+        latter is None if it is not smaller.
+        """
+        target = self.target(host)
+        key = (path, target, os.path.getmtime(path))
+        with self._lock:
+            cached = self._cache.pop(key, None)
+            if cached:
+                # most recently used last
+                self._cache[key] = cached
+        if cached:
+            return cached
+        base = self._variant_of(path)
+        if base:
+            content, compressed = self.rewrite(base, host)
+            if path.endswith('.md5'):
+                with open(path, 'rb') as f:
+                    md5 = f.read()
+                digest = hashlib.md5(content).hexdigest()
+                content = md5.replace(md5.split()[0], digest) \
+                    if md5.split() else digest
+            else:
+                content = compressed or _gzip(content)
+            compressed = None
+        else:
+            lgr.info('Applying server: {0} to {1}.'.format(target, path))
+            with open(path, 'rb') as f:
+                content = f.read().replace(self.original, target)
+            compressed = _gzip(content)
+            if len(compressed) >= len(content):
+                compressed = None
+        entry = content, compressed
+        self._store(key, entry)
+        return entry
+
+    def _store(self, key, entry):
+        size = sum(len(part) for part in entry if part)
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = entry
+            self._cached_bytes += size
+            while self._cached_bytes > self.cache_size and self._cache:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= sum(
+                    len(part) for part in evicted if part)
+
+
+class ResourceRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serves files from the server's root directory.
+
+    If a client accepts gzip and a precomputed `<file>.gz` variant exists
+    next to the requested file, the variant is sent instead with a
+    `Content-Encoding: gzip` header. Nothing is compressed on the fly.
+
+    Every request is recorded in the server's metrics which are exposed
+    under `metrics.METRICS_PATH`. If the server has a bandwidth limit,
+    response bodies are sent in smaller chunks paced by its scheduler.
+
+    If the server has an upstream, missing resources are fetched from it
+    and streamed to the client while they are being cached.
+
+    If the server has a blueprint rewriter, blueprints are served with
+    their file server rewritten on the fly.
+    """
+    copy_buffer_size = 64 * 1024
+    throttled_buffer_size = 16 * 1024
+
+    def setup(self):
+        SimpleHTTPServer.SimpleHTTPRequestHandler.setup(self)
+        self.server.metrics.connection_opened()
+
+    def finish(self):
+        try:
+            SimpleHTTPServer.SimpleHTTPRequestHandler.finish(self)
+        finally:
+            self.server.metrics.connection_closed()
+
+    def _handle(self, method):
+        self.status = None
+        self.bytes_sent = 0
+        start = time.time()
+        self.server.metrics.request_started()
+        try:
+            if self.path.split('?', 1)[0] == metrics.METRICS_PATH:
+                self.send_metrics(method)
+            else:
+                getattr(SimpleHTTPServer.SimpleHTTPRequestHandler,
+                        'do_' + method)(self)
+        finally:
+            duration = time.time() - start
+            path = self.path.split('?', 1)[0] \
+                if self.status and self.status != 404 else '<unmatched>'
+            self.server.metrics.request_finished(
+                path, method, self.status, self.bytes_sent, duration)
+            if lgr.isEnabledFor(logging.INFO):
+                lgr.info('%s - "%s" %s %s %.3fs', self.client_address[0],
+                         self.requestline, self.status, self.bytes_sent,
+                         duration, extra={
+                             'operation': 'serve', 'url': self.path,
+                             'bytes': self.bytes_sent, 'duration': duration,
+                             'outcome': self.status})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_HEAD(self):
+        self._handle('HEAD')
+
+    def send_response(self, code, message=None):
+        self.status = code
+        SimpleHTTPServer.SimpleHTTPRequestHandler.send_response(
+            self, code, message)
+
+    def send_metrics(self, method):
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header('Content-type', metrics.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if method == 'GET':
+            self.wfile.write(body)
+            self.bytes_sent += len(body)
+
+    def copyfile(self, source, outputfile):
+        bandwidth = self.server.bandwidth
+        if not bandwidth.enabled:
+            while True:
+                chunk = source.read(self.copy_buffer_size)
+                if not chunk:
+                    break
+                outputfile.write(chunk)
+                self.bytes_sent += len(chunk)
+            return
+        client = self.client_address[0]
+        bandwidth.start(client)
+        try:
+            while True:
+                chunk = source.read(self.throttled_buffer_size)
+                if not chunk:
+                    break
+                bandwidth.throttle(client, len(chunk))
+                outputfile.write(chunk)
+                self.bytes_sent += len(chunk)
+        finally:
+            bandwidth.stop(client)
+
+    def translate_path(self, path):
+        path = path.split('?', 1)[0].split('#', 1)[0]
+        trailing_slash = path.rstrip().endswith('/')
+        words = posixpath.normpath(urllib.unquote(path)).split('/')
+        path = self.server.root
+        for word in filter(None, words):
+            if os.path.dirname(word) or word in (os.curdir, os.pardir):
+                continue
+            path = os.path.join(path, word)
+        if trailing_slash:
+            path += '/'
+        return path
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if self.server.upstream and self.server.upstream.url_for(path):
+            cached = os.path.isfile(path)
+            self.server.metrics.cache_lookup('upstream', cached)
+            if not cached:
+                return self.send_upstream_head(path)
+        if not os.path.isfile(path):
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+        if self.server.rewriter and self.server.rewriter.applies(path):
+            return self.send_rewritten_head(path)
+        ctype = self.guess_type(path)
+        compressible = utils.is_compressible(path)
+        encoding = None
+        if compressible and \
+                accepts_gzip(self.headers.get('Accept-Encoding')):
+            variant = path + '.gz'
+            hit = os.path.isfile(variant) and \
+                os.path.getmtime(variant) >= os.path.getmtime(path)
+            self.server.metrics.cache_lookup('gzip', hit)
+            if hit:
+                path, encoding = variant, 'gzip'
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            self.send_error(404, 'File not found')
+            return None
+        try:
+            fs = os.fstat(f.fileno())
+            self.send_response(200)
+            self.send_header('Content-type', ctype)
+            if encoding:
+                self.send_header('Content-Encoding', encoding)
+            if compressible:
+                self.send_header('Vary', 'Accept-Encoding')
+            self.send_header('Content-Length', str(fs.st_size))
+            self.send_header(
+                'Last-Modified', self.date_time_string(fs.st_mtime))
+            self.end_headers()
+            return f
+        except Exception:
+            f.close()
+            raise
+
+    def send_rewritten_head(self, path):
+        host = self.headers.get('Host') or '{0}:{1}'.format(
+            *self.server.server_address)
+        content, compressed = self.server.rewriter.rewrite(path, host)
+        encoding = None
+        if compressed and accepts_gzip(self.headers.get('Accept-Encoding')):
+            content, encoding = compressed, 'gzip'
+        self.send_response(200)
+        self.send_header('Content-type', self.guess_type(path))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        return StringIO(content)
+
+    def send_upstream_head(self, path):
+        fetch = self.server.upstream.fetch(path)
+        if fetch.wait_for_headers() != 200:
+            self.send_error(fetch.status)
+            return None
+        f = fetch.reader()
+        if not f:
+            # the fetch failed after the upstream headers arrived
+            self.send_error(502)
+            return None
+        try:
+            self.send_response(200)
+            self.send_header('Content-type', self.guess_type(path))
+            length = fetch.headers.get('Content-Length')
+            if length:
+                self.send_header('Content-Length', length)
+            self.end_headers()
+            return f
+        except Exception:
+            f.close()
+            raise
+
+    def log_request(self, code='-', size='-'):
+        # requests are logged once they were sent, by `_handle`
+        pass
+
+    def log_message(self, format, *args):
+        lgr.info('%s - ' + format, self.client_address[0], *args)
+
+
+class ResourceServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # the default backlog of 5 drops connections (which are then retried
+    # a second later) as soon as a few agents download at once
+    request_queue_size = 128
+
+    def __init__(self, root, address='', port=8000, rate_limit=None,
+                 client_rate_limit=None, upstream_prefixes=None,
+                 rewrite=None, handler=ResourceRequestHandler):
+        self.root = os.path.abspath(root)
+        self.metrics = metrics.Metrics()
+        self.bandwidth = throttle.BandwidthScheduler(
+            rate_limit, client_rate_limit)
+        self.upstream = upstream.Upstream(self.root, upstream_prefixes) \
+            if upstream_prefixes else None
+        self.rewriter = BlueprintRewriter(self.root, *rewrite) \
+            if rewrite else None
+        BaseHTTPServer.HTTPServer.__init__(self, (address, port), handler)
+
+
+def serve(root, address='', port=8000, rate_limit=None,
+          client_rate_limit=None, upstream_prefixes=None, rewrite=None):
+    """Serves `root` over HTTP until interrupted.
+
+    `rate_limit` caps the total outgoing bandwidth and `client_rate_limit`
+    caps the bandwidth of each client, both in bytes per second.
+    If `upstream_prefixes` are given, missing resources are pulled
+    through from them. `rewrite` is an `(original, file_server, files)`
+    tuple for rewriting the file server in blueprints (see
+    `BlueprintRewriter`) as they are served.
+    Returns the (closed) server, with its metrics, once interrupted.
+    """
+    server = ResourceServer(root, address, port, rate_limit,
+                            client_rate_limit, upstream_prefixes, rewrite)
+    lgr.info('Serving {0} on {1}:{2}'.format(
+        root, address or '0.0.0.0', server.server_port))
+    if server.bandwidth.enabled:
+        lgr.info('Bandwidth limits: total {0}, per client {1} '
+                 '(bytes/sec).'.format(rate_limit or 'unlimited',
+                                       client_rate_limit or 'unlimited'))
+    if server.upstream:
+        lgr.info('Pulling missing resources through from: {0}'.format(
+            ', '.join(upstream_prefixes)))
+    if server.rewriter:
+        lgr.info('Serving blueprints with file server: {0}'.format(
+            server.rewriter.file_server or 'the requested host'))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return server
@@ -0,0 +1,1370 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import os
+import gzip
+import json
+import hashlib
+import logging
+import shutil
+import tarfile
+import tempfile
+import pstats
+import subprocess
+import sys
+import threading
+import time
+import urllib2
+from StringIO import StringIO
+from contextlib import closing
+
+import testtools
+import yaml
+
+import cloff.blueprint as blueprint
+import cloff.cache as cache
+import cloff.crawler as crawler
+import cloff.events as events
+import cloff.hosts as hosts
+import cloff.cloff as cloff
+import cloff.logger as logger
+import cloff.metrics as metrics
+import cloff.mirrors as mirrors
+import cloff.pipeline as pipeline
+import cloff.profiling as profiling
+import cloff.rewriter as rewriter
+import cloff.server as server
+import cloff.throttle as throttle
+import cloff.timing as timing
+import cloff.upstream as upstream
+import cloff.utils as utils
+
+
+def _start_server(root, **kwargs):
+    httpd = server.ResourceServer(root, '127.0.0.1', 0, **kwargs)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd, 'http://127.0.0.1:{0}'.format(httpd.server_port)
+
+
+def _get(url, headers=None):
+    return urllib2.urlopen(urllib2.Request(url, headers=headers or {}))
+
+
+class TestServer(testtools.TestCase):
+
+    def setUp(self):
+        super(TestServer, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        with open(os.path.join(self.root, 'blueprint.yaml'), 'w') as f:
+            f.write('inputs: {}\n' * 100)
+        utils.gzip_compressible_files(self.root)
+        self.httpd, self.url = _start_server(self.root)
+        self.addCleanup(self.httpd.server_close)
+        self.addCleanup(self.httpd.shutdown)
+
+    def test_gzip_smaller_only(self):
+        with open(os.path.join(self.root, 'tiny.json'), 'w') as f:
+            f.write('{}')
+        utils.gzip_compressible_files(self.root)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.root, 'tiny.json.gz')))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.root, 'blueprint.yaml.gz')))
+        self.assertIsNone(utils.gzip_fileobj(StringIO('{}'), 1024))
+        self.assertFalse(utils.is_compressible('a.rpm.md5'))
+
+    def test_accepts_gzip(self):
+        self.assertTrue(server.accepts_gzip('deflate, gzip;q=0.5'))
+        self.assertTrue(server.accepts_gzip('*'))
+        self.assertFalse(server.accepts_gzip('gzip;q=0'))
+        self.assertFalse(server.accepts_gzip(None))
+
+    def test_serve_gzip_variant(self):
+        r = _get(self.url + '/blueprint.yaml', {'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', r.info().get('Content-Encoding'))
+        self.assertEqual('Accept-Encoding', r.info().get('Vary'))
+        self.assertLess(len(r.read()), 100)
+
+    def test_serve_identity(self):
+        r = _get(self.url + '/blueprint.yaml')
+        self.assertIsNone(r.info().get('Content-Encoding'))
+        self.assertEqual('inputs: {}\n' * 100, r.read())
+
+    def test_metrics(self):
+        _get(self.url + '/blueprint.yaml', {'Accept-Encoding': 'gzip'}).read()
+        self.assertRaises(urllib2.HTTPError, _get, self.url + '/missing')
+        body = _get(self.url + metrics.METRICS_PATH).read()
+        self.assertIn('cloff_http_requests_total{path="/blueprint.yaml",'
+                      'method="GET",status="200"} 1', body)
+        self.assertIn('cloff_http_requests_total{path="<unmatched>",'
+                      'method="GET",status="404"} 1', body)
+        self.assertIn('cloff_http_response_bytes_total', body)
+        self.assertIn('cloff_http_request_duration_seconds_bucket{'
+                      'path="/blueprint.yaml",le="+Inf"} 1', body)
+        self.assertIn('cloff_cache_requests_total{cache="gzip",'
+                      'result="hit"} 1', body)
+        self.assertIn('cloff_http_requests_in_flight 1', body)
+
+
+class TestMetrics(testtools.TestCase):
+
+    def test_histogram(self):
+        h = metrics.Histogram((1, 10))
+        for value in (0.5, 1, 5, 50):
+            h.observe(value)
+        self.assertEqual(
+            [(1, 2), (10, 3), (float('inf'), 4)], list(h.samples()))
+        self.assertEqual(56.5, h.sum)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestThrottle(testtools.TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(512 * 1024, utils.parse_size('512K'))
+        self.assertEqual(10 * 1024 ** 2, utils.parse_size('10mb'))
+        self.assertEqual(100, utils.parse_size('100'))
+        self.assertIsNone(utils.parse_size(None))
+        self.assertRaises(ValueError, utils.parse_size, 'fast')
+
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = throttle.TokenBucket(100, clock=clock)
+        self.assertEqual(0, bucket.reserve(100))
+        self.assertEqual(0.5, bucket.reserve(50))
+        clock.now = 1.5
+        self.assertEqual(0, bucket.reserve(100))
+
+    def test_fair_share(self):
+        clock = FakeClock()
+        scheduler = throttle.BandwidthScheduler(
+            total_rate=100, client_rate=80, clock=clock, sleep=clock.sleep)
+        scheduler.start('a')
+        self.assertEqual(80, scheduler._buckets['a'].rate)
+        scheduler.start('b')
+        self.assertEqual(50, scheduler._buckets['a'].rate)
+        self.assertEqual(50, scheduler._buckets['b'].rate)
+        scheduler.throttle('b', 50)
+        scheduler.throttle('b', 50)
+        self.assertEqual(1, clock.now)
+        scheduler.stop('b')
+        self.assertEqual(80, scheduler._buckets['a'].rate)
+        self.assertNotIn('b', scheduler._buckets)
+
+
+class TestHosts(testtools.TestCase):
+
+    def _hosts(self, budget=hosts.DEFAULT_RETRY_BUDGET):
+        clock = FakeClock()
+        return hosts.Hosts(8, budget, clock=clock, sleep=clock.sleep), clock
+
+    def _failing(self, code, failures, headers=None):
+        calls = []
+
+        def _fetch():
+            calls.append(1)
+            if len(calls) <= failures:
+                raise urllib2.HTTPError('http://a/b', code, 'error',
+                                        headers or {}, None)
+            return 'content'
+        return _fetch, calls
+
+    def test_retry(self):
+        host_calls, clock = self._hosts()
+        fetch, calls = self._failing(503, 2)
+        self.assertEqual('content', host_calls.call('http://a/b', fetch, len))
+        self.assertEqual(3, len(calls))
+        # two jittered delays of 0.5 and 1 seconds
+        self.assertTrue(0.75 <= clock.now <= 1.5)
+        self.assertEqual(1, host_calls.get('http://a/c').limit)
+
+    def test_retry_after(self):
+        host_calls, clock = self._hosts()
+        fetch, calls = self._failing(429, 1, {'Retry-After': '7'})
+        host_calls.call('http://a/b', fetch)
+        self.assertEqual(7, clock.now)
+
+    def test_budget(self):
+        host_calls, clock = self._hosts(budget=10)
+        fetch, calls = self._failing(500, 100)
+        self.assertRaises(urllib2.HTTPError, host_calls.call, 'http://a/b',
+                          fetch)
+        self.assertTrue(clock.now <= 10)
+        self.assertTrue(len(calls) > 3)
+
+    def test_not_retryable(self):
+        host_calls, clock = self._hosts()
+        fetch, calls = self._failing(404, 1)
+        self.assertRaises(urllib2.HTTPError, host_calls.call, 'http://a/b',
+                          fetch)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(0, clock.now)
+
+    def test_increase(self):
+        clock = FakeClock()
+        controller = hosts.HostController('a', 4, initial=1, clock=clock)
+        # windows of 1, 2 and 3 downloads at 100/s, 200/s and 200/s
+        for size in (100, 200, 200, 200, 200, 200):
+            controller.acquire()
+            clock.now += 1
+            controller.succeeded(size)
+            controller.release()
+        self.assertEqual(3, controller.limit)
+        self.assertEqual(200, controller.rate)
+        # requests without a size are left out of the window
+        for _ in range(3):
+            controller.acquire()
+            controller.succeeded()
+            controller.release()
+        self.assertEqual(0, controller._window_count)
+        controller.failed()
+        self.assertEqual(1, controller.limit)
+        self.assertTrue(clock.now < controller.resume_at)
+
+
+class TestUpstream(testtools.TestCase):
+
+    def setUp(self):
+        super(TestUpstream, self).setUp()
+        self.origin_root = tempfile.mkdtemp()
+        self.cache_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.origin_root)
+        self.addCleanup(shutil.rmtree, self.cache_root)
+        os.makedirs(os.path.join(self.origin_root, 'org', 'x'))
+        self.data = os.urandom(512 * 1024)
+        with open(os.path.join(self.origin_root, 'org', 'x', 'r.rpm'),
+                  'wb') as f:
+            f.write(self.data)
+        self.origin, origin_url = _start_server(self.origin_root)
+        self.addCleanup(self.origin.server_close)
+        self.addCleanup(self.origin.shutdown)
+        self.httpd, self.url = _start_server(
+            self.cache_root, upstream_prefixes=[origin_url + '/org'])
+        self.addCleanup(self.httpd.server_close)
+        self.addCleanup(self.httpd.shutdown)
+
+    def test_url_for(self):
+        pull_through = self.httpd.upstream
+        self.assertEqual(
+            self.origin_url('/org/x/r.rpm'),
+            pull_through.url_for(os.path.join(
+                self.cache_root, 'resources', 'org', 'x', 'r.rpm')))
+        self.assertIsNone(pull_through.url_for(
+            os.path.join(self.cache_root, 'resources', 'other', 'r.rpm')))
+        self.assertIsNone(pull_through.url_for(
+            os.path.join(self.cache_root, 'org', 'x', 'r.rpm')))
+
+    def origin_url(self, path):
+        return 'http://127.0.0.1:{0}{1}'.format(
+            self.origin.server_port, path)
+
+    def test_pull_through_coalesced(self):
+        results = []
+
+        def get():
+            results.append(_get(self.url + '/resources/org/x/r.rpm').read())
+
+        threads = [threading.Thread(target=get) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([self.data] * 5, results)
+        cached = os.path.join(self.cache_root, 'resources', 'org', 'x',
+                              'r.rpm')
+        with open(cached, 'rb') as f:
+            self.assertEqual(self.data, f.read())
+        self.assertEqual(1, self.origin.metrics.requests[
+            ('/org/x/r.rpm', 'GET', 200)])
+        # served from the cache from now on
+        self.assertEqual(self.data, _get(
+            self.url + '/resources/org/x/r.rpm').read())
+        self.assertEqual(1, self.origin.metrics.requests[
+            ('/org/x/r.rpm', 'GET', 200)])
+
+    def test_pull_through_failed(self):
+        path = os.path.join(self.cache_root, 'resources', 'org', 'x', 'r.rpm')
+        # a fetch which failed after its headers arrived, and was joined
+        # before it ended
+        fetch = upstream.Fetch(self.origin_url('/org/x/r.rpm'), path)
+        fetch._update(status=200, headers={}, error=IOError('reset'),
+                      done=True)
+        self.httpd.upstream._fetches[path] = fetch
+        e = self.assertRaises(
+            urllib2.HTTPError, _get, self.url + '/resources/org/x/r.rpm')
+        self.assertEqual(502, e.code)
+
+    def test_pull_through_missing(self):
+        e = self.assertRaises(
+            urllib2.HTTPError, _get, self.url + '/resources/org/x/no.rpm')
+        self.assertEqual(404, e.code)
+
+
+class TestBlueprintRewriter(testtools.TestCase):
+
+    def setUp(self):
+        super(TestBlueprintRewriter, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.makedirs(os.path.join(self.root, 'resources'))
+        # long enough for the gzipped form to be smaller
+        self.content = 'url: http://10.0.0.1:8000/resources/org/x.rpm\n' * 5
+        for path in ('blueprint.yaml', os.path.join('resources', 'r.yaml')):
+            with open(os.path.join(self.root, path), 'w') as f:
+                f.write(self.content)
+
+    def _serve(self, file_server=None, files=None):
+        httpd, url = _start_server(
+            self.root, rewrite=('http://10.0.0.1:8000/', file_server, files))
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        return url
+
+    def test_rewrite_from_host(self):
+        url = self._serve()
+        self.assertEqual(
+            'url: {0}/resources/org/x.rpm\n'.format(url) * 5,
+            _get(url + '/blueprint.yaml').read())
+
+    def test_rewrite_configured(self):
+        url = self._serve('http://fs:80/')
+        r = _get(url + '/blueprint.yaml', {'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', r.info().get('Content-Encoding'))
+        with closing(gzip.GzipFile(fileobj=StringIO(r.read()))) as f:
+            self.assertEqual(
+                'url: http://fs:80/resources/org/x.rpm\n' * 5, f.read())
+
+    def test_rewrite_uncompressible(self):
+        with open(os.path.join(self.root, 'blueprint.yaml'), 'w') as f:
+            f.write('a: b\n')
+        url = self._serve('http://fs:80/')
+        r = _get(url + '/blueprint.yaml', {'Accept-Encoding': 'gzip'})
+        self.assertIsNone(r.info().get('Content-Encoding'))
+        self.assertEqual('a: b\n', r.read())
+
+    def test_resources_not_rewritten(self):
+        url = self._serve('http://fs:80/')
+        self.assertEqual(self.content, _get(url + '/resources/r.yaml').read())
+
+    def test_rewrite_cache_bounded(self):
+        path = os.path.join(self.root, 'blueprint.yaml')
+        size = len(server.BlueprintRewriter(
+            self.root, 'http://10.0.0.1:8000/').rewrite(path, 'h:1')[0])
+        blueprint_rewriter = server.BlueprintRewriter(
+            self.root, 'http://10.0.0.1:8000/', cache_size=size * 3)
+        first = blueprint_rewriter.rewrite(path, 'h:0')
+        for i in range(1, 300):
+            blueprint_rewriter.rewrite(path, 'h:{0}'.format(i))
+            # the most recently used target is kept
+            self.assertIs(first, blueprint_rewriter.rewrite(path, 'h:0'))
+        self.assertLessEqual(blueprint_rewriter._cached_bytes, size * 3)
+        self.assertLessEqual(len(blueprint_rewriter._cache), 3)
+
+    def test_rewrite_files(self):
+        path = os.path.join(self.root, 'resources', 'r.yaml')
+        with open(path + '.md5', 'w') as f:
+            f.write(hashlib.md5(self.content).hexdigest() + '  r.yaml\n')
+        utils.gzip_file(path)
+        url = self._serve('http://fs:80/', files=[path])
+        rewritten = 'url: http://fs:80/resources/org/x.rpm\n' * 5
+        self.assertEqual(rewritten, _get(url + '/resources/r.yaml').read())
+        # the md5 and gzip variants match the rewritten content
+        self.assertEqual(
+            hashlib.md5(rewritten).hexdigest() + '  r.yaml\n',
+            _get(url + '/resources/r.yaml.md5').read())
+        with closing(gzip.GzipFile(fileobj=StringIO(
+                _get(url + '/resources/r.yaml.gz').read()))) as f:
+            self.assertEqual(rewritten, f.read())
+        # only the given files are rewritten
+        self.assertEqual(self.content, _get(url + '/blueprint.yaml').read())
+
+
+def _make_manager_blueprints(destination, tag='3.3', files=None):
+    """Creates a manager blueprints repo archive like the ones on github.
+    """
+    files = files or {
+        'simple-manager-blueprint.yaml':
+            'inputs:\n'
+            '  rpm:\n'
+            '    default: http://repository.cloudifysource.org/org/a.rpm\n',
+        'openstack-manager-blueprint.yaml': 'inputs: {}\n',
+        'types/manager-types.yaml': 'node_types: {}\n',
+        'tests/test_blueprints.py': 'pass\n',
+        'README.md': 'readme\n',
+    }
+    repo = 'cloudify-manager-blueprints-{0}'.format(tag)
+    source = tempfile.mkdtemp()
+    try:
+        for path, content in files.items():
+            path = os.path.join(source, repo, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(content)
+        with closing(tarfile.open(destination, 'w:gz')) as tar:
+            tar.add(os.path.join(source, repo), arcname=repo)
+    finally:
+        shutil.rmtree(source)
+    return destination
+
+
+class TestManagerBlueprints(testtools.TestCase):
+
+    def setUp(self):
+        super(TestManagerBlueprints, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.archive = _make_manager_blueprints(
+            os.path.join(self.tmp, 'mp.tar.gz'))
+        self.destination = os.path.join(self.tmp, 'out')
+        self.repo = os.path.join(
+            self.destination, 'cloudify-manager-blueprints-3.3')
+
+    def test_get_manager_blueprints(self):
+        clo = cloff.Cloff(self.archive, '3.3')
+        paths = clo._get_manager_blueprints(self.destination)
+        self.assertEqual(
+            [os.path.join(self.repo, 'openstack-manager-blueprint.yaml'),
+             os.path.join(self.repo, 'simple-manager-blueprint.yaml')],
+            paths)
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.repo, 'types', 'manager-types.yaml')))
+        self.assertFalse(os.path.exists(os.path.join(self.repo, 'tests')))
+        self.assertFalse(os.path.exists(os.path.join(self.repo, 'README.md')))
+        self.assertEqual(['cloudify-manager-blueprints-3.3'],
+                         os.listdir(self.destination))
+
+    def test_get_manager_blueprints_missing(self):
+        archive = _make_manager_blueprints(
+            os.path.join(self.tmp, 'empty.tar.gz'),
+            files={'README.md': 'readme\n'})
+        clo = cloff.Cloff(archive, '3.3')
+        self.assertRaises(
+            IOError, clo._get_manager_blueprints, self.destination)
+
+
+class TestCreate(testtools.TestCase):
+
+    def setUp(self):
+        super(TestCreate, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        origin_root = os.path.join(self.tmp, 'origin')
+        os.makedirs(os.path.join(origin_root, 'org', 'x'))
+        self.resources = {}
+        for name in ('a.rpm', 'b.sh', 'c.tar.gz'):
+            data = os.urandom(1024) if name != 'b.sh' else 'echo b\n' * 50
+            self.resources[name] = data
+            with open(os.path.join(origin_root, 'org', 'x', name), 'wb') as f:
+                f.write(data)
+            with open(os.path.join(origin_root, 'org', 'x', name + '.md5'),
+                      'w') as f:
+                f.write(hashlib.md5(data).hexdigest() + '  ' + name + '\n')
+        self.origin, self.origin_url = _start_server(origin_root)
+        self.addCleanup(self.origin.server_close)
+        self.addCleanup(self.origin.shutdown)
+        self.prefixes = [self.origin_url + '/org']
+        blueprint = 'inputs:\n' + ''.join(
+            '  {0}:\n    default: "{1}/org/x/{0}"\n'.format(
+                name, self.origin_url) for name in sorted(self.resources))
+        self.source = _make_manager_blueprints(
+            os.path.join(self.tmp, 'mp.tar.gz'),
+            files={'simple-manager-blueprint.yaml': blueprint,
+                   'aws-ec2-manager-blueprint.yaml': blueprint})
+        cwd = os.getcwd()
+        os.chdir(self.tmp)
+        self.addCleanup(os.chdir, cwd)
+
+    def test_create(self):
+        clo = cloff.Cloff(self.source, '3.3', prefixes=self.prefixes)
+        clo.create(file_server='http://10.0.0.1:8000', gzip=True, workers=2)
+        with closing(tarfile.open('cloudify-offline.tar.gz')) as tar:
+            members = dict((m.name.split('/', 1)[1], m)
+                           for m in tar.getmembers() if '/' in m.name)
+            for name, data in self.resources.items():
+                path = 'resources/org/x/' + name
+                self.assertEqual(data, tar.extractfile(members[path]).read())
+                self.assertIn(path + '.md5', members)
+            self.assertIn('resources/org/x/b.sh.gz', members)
+            self.assertNotIn('resources/org/x/a.rpm.gz', members)
+            for name in ('simple', 'aws-ec2'):
+                blueprint = tar.extractfile(members[
+                    'cloudify-manager-blueprints-3.3/'
+                    '{0}-manager-blueprint.yaml'.format(name)]).read()
+                self.assertIn(
+                    'http://10.0.0.1:8000/resources/org/x/a.rpm', blueprint)
+                self.assertNotIn(self.origin_url, blueprint)
+            metadata = json.loads(
+                tar.extractfile(members['metadata.json']).read())
+            self.assertEqual('http://10.0.0.1:8000', metadata['file_server'])
+            self.assertEqual('3.3', metadata['tag'])
+            self.assertEqual(
+                ['aws-ec2-manager-blueprint.yaml:3 (inputs.a.rpm.default)',
+                 'simple-manager-blueprint.yaml:3 (inputs.a.rpm.default)'],
+                sorted(metadata['resources'][
+                    self.origin_url + '/org/x/a.rpm']))
+        # resources shared by both blueprints are downloaded once
+        self.assertEqual(1, self.origin.metrics.requests[
+            ('/org/x/a.rpm', 'GET', 200)])
+
+    def _make_crawl_source(self):
+        origin = os.path.join(self.tmp, 'origin', 'org', 'x')
+
+        def _add(name, data):
+            with open(os.path.join(origin, name), 'wb') as f:
+                f.write(data)
+            with open(os.path.join(origin, name + '.md5'), 'w') as f:
+                f.write(hashlib.md5(data).hexdigest() + '  ' + name + '\n')
+
+        url = self.origin_url + '/org/x/'
+        _add('d.sh', 'curl -O {0}e.rpm\n'.format(url))
+        _add('e.rpm', 'e')
+        _add('f.rpm', 'f')
+        nested = StringIO()
+        with closing(tarfile.open(fileobj=nested, mode='w:gz')) as tar:
+            script = 'curl -O {0}f.rpm\n'.format(url)
+            info = tarfile.TarInfo('plugin/install.sh')
+            info.size = len(script)
+            tar.addfile(info, StringIO(script))
+        _add('g.tar.gz', nested.getvalue())
+        return _make_manager_blueprints(
+            os.path.join(self.tmp, 'crawl.tar.gz'),
+            files={'simple-manager-blueprint.yaml':
+                   'inputs:\n  plugin: {default: "' + url + 'g.tar.gz"}\n',
+                   'components/manager/scripts/create.sh':
+                   '#!/bin/bash\ncurl -O {0}d.sh\n'.format(url)})
+
+    def test_create_flow_style(self):
+        url = self.origin_url + '/org/x/'
+        source = _make_manager_blueprints(
+            os.path.join(self.tmp, 'flow.tar.gz'),
+            files={'simple-manager-blueprint.yaml':
+                   'inputs:\n'
+                   '  rpms: {{default: [{0}a.rpm, {0}c.tar.gz]}}\n'
+                   '  script: {{default: {{url: {0}b.sh}}}}\n'.format(url)})
+        cloff.Cloff(source, '3.3', prefixes=self.prefixes).create(
+            file_server='http://10.0.0.1:8000', workers=2)
+        with closing(tarfile.open('cloudify-offline.tar.gz')) as tar:
+            members = dict((m.name.split('/', 1)[1], m)
+                           for m in tar.getmembers() if '/' in m.name)
+            for name in self.resources:
+                self.assertIn('resources/org/x/' + name, members)
+            blueprint = tar.extractfile(members[
+                'cloudify-manager-blueprints-3.3/'
+                'simple-manager-blueprint.yaml']).read()
+        fs = 'http://10.0.0.1:8000/resources/org/x/'
+        self.assertEqual(
+            'inputs:\n'
+            '  rpms: {{default: [{0}a.rpm, {0}c.tar.gz]}}\n'
+            '  script: {{default: {{url: {0}b.sh}}}}\n'.format(fs), blueprint)
+        cloff.Cloff('cloudify-offline.tar.gz').validate()
+
+    def test_modify_file_server_keeps_text(self):
+        clo = cloff.Cloff(self.source, '3.3', prefixes=self.prefixes)
+        content = 'curl -o f {0}/org/x/d.rpm?v=1#top; next\n'.format(
+            self.origin_url)
+        index = blueprint.UrlIndex()
+        list(crawler.index_text(content, clo.rewriter, index, 'install.sh'))
+        # only the host is replaced
+        self.assertEqual(
+            'curl -o f http://fs:80/resources/org/x/d.rpm?v=1#top; next\n',
+            clo._modify_file_server(
+                'install.sh', content, 'http://fs:80', index))
+
+    def test_create_crawl(self):
+        clo = cloff.Cloff(
+            self._make_crawl_source(), '3.3', prefixes=self.prefixes)
+        clo.create(file_server='http://10.0.0.1:8000', workers=2, depth=1)
+        with closing(tarfile.open('cloudify-offline.tar.gz')) as tar:
+            members = dict((m.name.split('/', 1)[1], m)
+                           for m in tar.getmembers() if '/' in m.name)
+            for name in ('d.sh', 'e.rpm', 'f.rpm', 'g.tar.gz'):
+                self.assertIn('resources/org/x/' + name, members)
+            script = tar.extractfile(members[
+                'cloudify-manager-blueprints-3.3/components/manager/'
+                'scripts/create.sh']).read()
+            self.assertIn('http://10.0.0.1:8000/resources/org/x/d.sh', script)
+            # downloaded scripts are rewritten and their md5 files updated
+            script = tar.extractfile(members['resources/org/x/d.sh']).read()
+            self.assertEqual(
+                'curl -O http://10.0.0.1:8000/resources/org/x/e.rpm\n',
+                script)
+            self.assertEqual(
+                hashlib.md5(script).hexdigest() + '  d.sh\n',
+                tar.extractfile(members['resources/org/x/d.sh.md5']).read())
+            metadata = json.loads(
+                tar.extractfile(members['metadata.json']).read())
+            self.assertEqual(
+                ['resources/org/x/g.tar.gz!plugin/install.sh:1 ()'],
+                metadata['resources'][self.origin_url + '/org/x/f.rpm'])
+
+    def test_modify_crawled(self):
+        cloff.Cloff(
+            self._make_crawl_source(), '3.3', prefixes=self.prefixes).create(
+            file_server='http://10.0.0.1:8000', gzip=True, workers=2,
+            depth=1)
+        cloff.Cloff('cloudify-offline.tar.gz').modify('http://10.0.0.2:8000')
+        with closing(tarfile.open('cloudify-offline.tar.gz')) as tar:
+            members = dict((m.name.split('/', 1)[1], m)
+                           for m in tar.getmembers() if '/' in m.name)
+            script = tar.extractfile(members[
+                'cloudify-manager-blueprints-3.3/components/manager/'
+                'scripts/create.sh']).read()
+            self.assertIn('http://10.0.0.2:8000/resources/org/x/d.sh', script)
+            script = tar.extractfile(members['resources/org/x/d.sh']).read()
+            self.assertEqual(
+                'curl -O http://10.0.0.2:8000/resources/org/x/e.rpm\n',
+                script)
+            self.assertEqual(
+                hashlib.md5(script).hexdigest() + '  d.sh\n',
+                tar.extractfile(members['resources/org/x/d.sh.md5']).read())
+            # archives are only scanned
+            self.assertEqual(
+                self._read_origin('g.tar.gz'),
+                tar.extractfile(members['resources/org/x/g.tar.gz']).read())
+        cloff.Cloff('cloudify-offline.tar.gz').validate()
+
+    def _read_origin(self, name):
+        with open(os.path.join(
+                self.tmp, 'origin', 'org', 'x', name), 'rb') as f:
+            return f.read()
+
+    def test_create_crawl_depth(self):
+        clo = cloff.Cloff(
+            self._make_crawl_source(), '3.3', prefixes=self.prefixes)
+        clo.create(file_server='http://10.0.0.1:8000', workers=2, depth=0)
+        with closing(tarfile.open('cloudify-offline.tar.gz')) as tar:
+            names = set(name.split('/', 1)[1]
+                        for name in tar.getnames() if '/' in name)
+        # downloaded resources are not scanned
+        self.assertIn('resources/org/x/d.sh', names)
+        self.assertNotIn('resources/org/x/e.rpm', names)
+        self.assertNotIn('resources/org/x/f.rpm', names)
+
+    def test_modify(self):
+        cloff.Cloff(self.source, '3.3', prefixes=self.prefixes).create(
+            file_server='http://10.0.0.1:8000', gzip=True, workers=2)
+        cloff.Cloff('cloudify-offline.tar.gz').modify('http://10.0.0.2:8000')
+        with closing(tarfile.open('cloudify-offline.tar.gz')) as tar:
+            members = dict((m.name.split('/', 1)[1], m)
+                           for m in tar.getmembers() if '/' in m.name)
+            blueprint = tar.extractfile(members[
+                'cloudify-manager-blueprints-3.3/'
+                'simple-manager-blueprint.yaml']).read()
+            self.assertIn(
+                'http://10.0.0.2:8000/resources/org/x/a.rpm', blueprint)
+            self.assertNotIn('10.0.0.1', blueprint)
+            metadata = json.loads(
+                tar.extractfile(members['metadata.json']).read())
+            self.assertEqual('http://10.0.0.2:8000/', metadata['file_server'])
+
+    def test_extract_for_serving(self):
+        cloff.Cloff(self.source, '3.3', prefixes=self.prefixes).create(
+            file_server='http://10.0.0.1:8000', workers=2)
+        os.rename('cloudify-offline.tar.gz', 'first.tar.gz')
+        serve_under = os.path.join(self.tmp, 'serve')
+        os.makedirs(serve_under)
+        first = cloff.Cloff('first.tar.gz')._extract_for_serving(serve_under)
+        self.assertTrue(os.path.isfile(os.path.join(first, 'metadata.json')))
+        # an extraction of the same archive is reused
+        open(os.path.join(first, 'kept'), 'w').close()
+        self.assertEqual(first, cloff.Cloff(
+            'first.tar.gz')._extract_for_serving(serve_under))
+        self.assertTrue(os.path.isfile(os.path.join(first, 'kept')))
+        # and replaced by an extraction of another archive
+        cloff.Cloff(self.source, '3.3', prefixes=self.prefixes).create(
+            file_server='http://10.0.0.1:8000', workers=2)
+        second = cloff.Cloff(
+            'cloudify-offline.tar.gz')._extract_for_serving(serve_under)
+        self.assertNotEqual(first, second)
+        self.assertFalse(os.path.exists(first))
+        self.assertEqual([os.path.basename(second)], [
+            name for name in os.listdir(serve_under)
+            if not name.startswith('.')])
+
+    def test_create_lock(self):
+        lock_path = os.path.join(self.tmp, 'cloff.lock')
+        cache_dir = os.path.join(self.tmp, 'cache')
+        cloff.Cloff(self.source, '3.3', prefixes=self.prefixes).create(
+            file_server='http://10.0.0.1:8000', cache_dir=cache_dir,
+            write_lock=lock_path)
+        with open(lock_path) as f:
+            locked = json.load(f)
+        self.assertEqual(self.prefixes, locked['prefixes'])
+        resources = dict((r['url'], r) for r in locked['resources'])
+        a = resources[self.origin_url + '/org/x/a.rpm']
+        self.assertEqual(1024, a['size'])
+        self.assertEqual(
+            hashlib.md5(self.resources['a.rpm']).hexdigest(), a['md5'])
+        self.assertIn(a['md5'], cache.ResourceCache(cache_dir))
+        # scanned resources are cached as they were downloaded
+        b = resources[self.origin_url + '/org/x/b.sh']
+        with open(cache.ResourceCache(cache_dir).path(b['md5'])) as f:
+            self.assertEqual(self.resources['b.sh'], f.read())
+
+        # everything is taken from the cache
+        os.remove('cloudify-offline.tar.gz')
+        cloff.Cloff('ignored').create(
+            file_server='http://10.0.0.1:8000', cache_dir=cache_dir,
+            from_lock=lock_path)
+        with closing(tarfile.open('cloudify-offline.tar.gz')) as tar:
+            members = dict((m.name.split('/', 1)[1], m)
+                           for m in tar.getmembers() if '/' in m.name)
+            self.assertEqual(self.resources['a.rpm'], tar.extractfile(
+                members['resources/org/x/a.rpm']).read())
+        self.assertEqual(1, self.origin.metrics.requests[
+            ('/org/x/a.rpm', 'GET', 200)])
+
+        # resources changed since they were locked fail the build
+        with open(os.path.join(
+                self.tmp, 'origin', 'org', 'x', 'a.rpm'), 'wb') as f:
+            f.write('changed')
+        e = self.assertRaises(IOError, cloff.Cloff('ignored').create,
+                              file_server='http://10.0.0.1:8000',
+                              from_lock=lock_path)
+        self.assertIn('changed since it was locked', str(e))
+        self.assertFalse(os.path.exists('cloudify-offline.tar.gz'))
+
+    def test_create_lock_new_url(self):
+        lock_path = os.path.join(self.tmp, 'cloff.lock')
+        cloff.Cloff(self.source, '3.3', prefixes=self.prefixes).create(
+            file_server='http://10.0.0.1:8000', write_lock=lock_path)
+        with open(lock_path) as f:
+            locked = json.load(f)
+        locked['source'] = self.source
+        locked['resources'] = [r for r in locked['resources']
+                               if not r['url'].endswith('b.sh')]
+        with open(lock_path, 'w') as f:
+            json.dump(locked, f)
+        os.remove('cloudify-offline.tar.gz')
+        e = self.assertRaises(IOError, cloff.Cloff('ignored').create,
+                              file_server='http://10.0.0.1:8000',
+                              from_lock=lock_path)
+        self.assertIn('is not in lock file', str(e))
+        self.assertFalse(os.path.exists('cloudify-offline.tar.gz'))
+        # nothing is left downloading
+        self.assertEqual([], [
+            t.name for t in threading.enumerate()
+            if t.name.startswith(('download-', 'size-'))])
+
+    def test_create_report(self):
+        clo = cloff.Cloff(self.source, '3.3', prefixes=self.prefixes)
+        clo.create(file_server='http://10.0.0.1:8000', gzip=True, workers=2)
+        phases = clo.report.phases
+        for name in ('fetch', 'untar', 'scan', 'rewrite', 'download',
+                     'verify', 'gzip', 'write', 'archive'):
+            self.assertIn(name, phases)
+        self.assertEqual(3, phases['download'].count)
+        self.assertEqual(
+            sum(len(data) for data in self.resources.values()),
+            phases['download'].bytes)
+        self.assertEqual(3, len(clo.report.transfers))
+        self.assertIn('download', clo.report.render())
+        report = clo.report.to_dict()
+        self.assertEqual('create', report['operation'])
+        json.dumps(report)
+
+    def test_create_largest_first(self):
+        downloaded = []
+        clo = cloff.Cloff(self.source, '3.3', prefixes=self.prefixes)
+        clo.create(file_server='http://10.0.0.1:8000', workers=1,
+                   on_event=lambda event: event.type == events.BYTES and
+                   event.name not in downloaded + [self.source] and
+                   downloaded.append(event.name))
+        # a.rpm and c.tar.gz are 1024 bytes, b.sh 350
+        self.assertEqual(self.origin_url + '/org/x/b.sh', downloaded[-1])
+        self.assertEqual(3, len(downloaded))
+        self.assertIn('size', clo.report.phases)
+
+    def test_create_events(self):
+        received = []
+        clo = cloff.Cloff(self.source, '3.3', prefixes=self.prefixes)
+        clo.create(file_server='http://10.0.0.1:8000', workers=2,
+                   on_event=received.append)
+        urls = sorted(self.origin_url + '/org/x/' + name
+                      for name in self.resources)
+        by_type = dict((t, [e for e in received if e.type == t])
+                       for t in events.TYPES)
+        self.assertEqual(urls, sorted(e.name for e in by_type['queued']))
+        self.assertEqual(urls, sorted(e.name for e in by_type['verified']))
+        self.assertEqual(
+            sum(len(data) for data in self.resources.values()),
+            sum(e.size for e in by_type['bytes'] if e.name in urls))
+        self.assertTrue(any(e.name == self.source for e in by_type['bytes']))
+        self.assertTrue(set(urls) <= set(e.name for e in by_type['archived']))
+        self.assertFalse(by_type['cached'])
+
+        stream = events.EventStream(cloff.Cloff(
+            'cloudify-offline.tar.gz').validate)
+        self.assertEqual(
+            sorted('resources/org/x/' + name for name in self.resources),
+            sorted(e.name for e in stream if e.type == events.VERIFIED))
+
+    def test_event_stream_error(self):
+        with open('broken.tar.gz', 'wb') as f:
+            f.write('broken')
+        stream = events.EventStream(cloff.Cloff('broken.tar.gz').validate)
+        self.assertRaises(tarfile.ReadError, list, stream)
+
+    def test_validate(self):
+        clo = cloff.Cloff(self.source, '3.3', prefixes=self.prefixes)
+        clo.create(file_server='http://10.0.0.1:8000', workers=2)
+        cloff.Cloff('cloudify-offline.tar.gz').validate()
+        # corrupt a resource
+        with closing(tarfile.open('cloudify-offline.tar.gz')) as tar:
+            tar.extractall('extracted')
+        root = os.path.join('extracted', os.listdir('extracted')[0])
+        with open(os.path.join(root, 'resources', 'org', 'x', 'a.rpm'),
+                  'wb') as f:
+            f.write('corrupt')
+        os.remove(os.path.join(root, 'resources', 'org', 'x', 'b.sh'))
+        utils.tar(root, 'corrupt.tar.gz')
+        e = self.assertRaises(
+            IOError, cloff.Cloff('corrupt.tar.gz').validate)
+        self.assertIn('(4 errors)', str(e))
+
+    def test_plan(self):
+        cache_dir = os.path.join(self.tmp, 'cache')
+        with open(os.path.join(self.tmp, 'origin', 'mp.tar.gz'), 'wb') as f:
+            with open(self.source, 'rb') as source:
+                f.write(source.read())
+        resource_cache = cache.ResourceCache(cache_dir)
+        resource_cache.put(hashlib.md5(self.resources['a.rpm']).hexdigest(),
+                           StringIO(self.resources['a.rpm']))
+        plan = cloff.Cloff(self.origin_url + '/mp.tar.gz', '3.3',
+                           prefixes=self.prefixes).plan(
+            workers=2, cache_dir=cache_dir)
+        self.assertEqual(3, len(plan.resources))
+        self.assertEqual(['a.rpm'], [r.url.split('/')[-1] for r in plan.hits])
+        self.assertEqual(1024 + 350, plan.total(plan.misses))
+        self.assertEqual((3, []), plan.duplicates)
+        self.assertTrue(plan.throughput)
+        self.assertIsNotNone(plan.estimate())
+        self.assertIn('Cache hits:      1 (1.0K)', plan.render())
+        # nothing but HEAD requests were sent for the resources
+        self.assertEqual(0, self.origin.metrics.requests[
+            ('/org/x/c.tar.gz', 'GET', 200)])
+        self.assertEqual(1, self.origin.metrics.requests[
+            ('/org/x/c.tar.gz', 'HEAD', 200)])
+
+    def test_cache_trim(self):
+        resource_cache = cache.ResourceCache(
+            os.path.join(self.tmp, 'cache'), max_size=2048)
+        for i, name in enumerate(sorted(self.resources)):
+            md5 = hashlib.md5(self.resources[name]).hexdigest()
+            resource_cache.put(md5, StringIO(self.resources[name]))
+            os.utime(resource_cache.path(md5), (i, i))
+        a = hashlib.md5(self.resources['a.rpm']).hexdigest()
+        # hits are the most recently used
+        resource_cache.get(a).close()
+        self.assertEqual(350, resource_cache.trim())
+        self.assertIn(a, resource_cache)
+        self.assertNotIn(
+            hashlib.md5(self.resources['b.sh']).hexdigest(), resource_cache)
+        self.assertEqual(0, resource_cache.trim())
+
+    def test_plan_head_rejected(self):
+        self.patch(server.ResourceRequestHandler, 'do_HEAD',
+                   lambda handler: handler.send_error(405))
+        plan = cloff.Cloff(self.source, '3.3', prefixes=self.prefixes).plan()
+        self.assertEqual(3, len(plan.resources))
+        self.assertEqual(3, len(plan.errors))
+        self.assertEqual(3, len(plan.unknown_sizes))
+        self.assertIn('HTTP Error 405', plan.errors[0].error)
+        # the md5s were still read
+        self.assertTrue(all(r.md5 for r in plan.resources))
+        self.assertIn('Errors:          3', plan.render())
+
+    def test_download_stalled(self):
+        self.patch(utils, 'DOWNLOAD_TIMEOUT', 0.2)
+        for method in ('do_GET', 'do_HEAD'):
+            self.patch(server.ResourceRequestHandler, method,
+                       lambda handler: time.sleep(2))
+        url = self.origin_url + '/org/x/a.rpm'
+        for fetch in (utils.read_url, utils.head_url):
+            start = time.time()
+            e = self.assertRaises(Exception, fetch, url)
+            self.assertLess(time.time() - start, 1.5)
+            # stalls count against the retry budget
+            self.assertTrue(hosts.is_retryable(e))
+
+    def test_create_md5_mismatch(self):
+        with open(os.path.join(
+                self.tmp, 'origin', 'org', 'x', 'a.rpm.md5'), 'w') as f:
+            f.write('0' * 32)
+        clo = cloff.Cloff(self.source, '3.3', prefixes=self.prefixes)
+        e = self.assertRaises(
+            IOError, clo.create, file_server='http://10.0.0.1:8000',
+            retry_budget=0)
+        self.assertIn('md5 checksum validation failed', str(e))
+        self.assertFalse(os.path.exists('cloudify-offline.tar.gz'))
+
+    def test_create_mirrors(self):
+        mirror_root = os.path.join(self.tmp, 'mirror')
+        os.makedirs(os.path.join(mirror_root, 'org', 'x'))
+        # a.rpm is intact, b.sh is corrupt and c.tar.gz is missing
+        for name, data in (('a.rpm', self.resources['a.rpm']),
+                           ('b.sh', 'echo corrupt\n')):
+            with open(os.path.join(mirror_root, 'org', 'x', name), 'wb') as f:
+                f.write(data)
+        mirror, mirror_url = _start_server(mirror_root)
+        self.addCleanup(mirror.server_close)
+        self.addCleanup(mirror.shutdown)
+        self.patch(mirrors, 'probe_url', lambda url: (
+            (0.001, 10 ** 9) if url.startswith(mirror_url) else (0.1, 1000)))
+        clo = cloff.Cloff(self.source, '3.3', prefixes=self.prefixes)
+        clo.create(file_server='http://10.0.0.1:8000', workers=1,
+                   mirrors=[(self.prefixes[0], mirror_url + '/org')])
+        with closing(tarfile.open('cloudify-offline.tar.gz')) as tar:
+            members = dict((m.name.split('/', 1)[1], m)
+                           for m in tar.getmembers() if '/' in m.name)
+            for name, data in self.resources.items():
+                self.assertEqual(data, tar.extractfile(
+                    members['resources/org/x/' + name]).read())
+        # b.sh and c.tar.gz failed over to the canonical source
+        for name, mirror_gets, origin_gets in (('a.rpm', 1, 0),
+                                               ('b.sh', 1, 1),
+                                               ('c.tar.gz', 0, 1)):
+            path = '/org/x/' + name
+            self.assertEqual(mirror_gets, mirror.metrics.requests[
+                (path, 'GET', 200)])
+            self.assertEqual(origin_gets, self.origin.metrics.requests[
+                (path, 'GET', 200)])
+            # md5 files only come from the canonical source
+            self.assertEqual(0, mirror.metrics.requests[
+                (path + '.md5', 'GET', 404)])
+
+
+class TestMirrors(testtools.TestCase):
+
+    def test_choose(self):
+        probes = {'http://a/org': (0.01, 1000), 'http://b/org': (0.01, 900),
+                  'http://c/org': (1, 100)}
+        chosen = mirrors.Mirrors(
+            [('http://A/org', 'http://b/org/'),
+             ('http://a/org', 'http://c/org')],
+            lambda url: probes[url.rsplit('/', 1)[0]])
+        self.assertEqual([], chosen.choose('http://d/org/x'))
+        order = chosen.choose('http://a/org/x')
+        self.assertEqual(['http://a/org', 'http://b/org', 'http://c/org'],
+                         [m.url for m in order])
+        self.assertTrue(order[0].canonical)
+        self.assertEqual('http://c/org/x', order[2].locate('http://a/org/x'))
+        # downloads are spread over the fastest mirrors
+        chosen.started(order[0])
+        self.assertEqual(
+            'http://b/org', chosen.choose('http://a/org/y')[0].url)
+        chosen.finished(order[0])
+        for _ in range(mirrors.MAX_FAILURES):
+            chosen.started(order[1])
+            chosen.finished(order[1], ok=False)
+        self.assertEqual(['http://a/org', 'http://c/org'],
+                         [m.url for m in chosen.choose('http://a/org/y')])
+
+
+class TestUrlRewriter(testtools.TestCase):
+
+    def setUp(self):
+        super(TestUrlRewriter, self).setUp()
+        self.rewriter = rewriter.UrlRewriter([
+            'http://repo.org/org',
+            'http://repo.org/org/cloudify3',
+            'http://spec.org/spec',
+            'https://other.org',
+        ])
+
+    def test_match_longest_prefix(self):
+        self.assertEqual(
+            'http://repo.org/org/cloudify3',
+            self.rewriter.match('http://repo.org/org/cloudify3/a'))
+        self.assertEqual('http://repo.org/org',
+                         self.rewriter.match('http://repo.org/org/x/a'))
+        self.assertEqual('https://other.org',
+                         self.rewriter.match('https://other.org/a'))
+        self.assertIsNone(self.rewriter.match('http://repo.org/other/a'))
+        self.assertIsNone(self.rewriter.match('https://other.org.evil/a'))
+
+    def test_match_same_host(self):
+        url_rewriter = rewriter.UrlRewriter(
+            ['http://repo.org/org/path{0}'.format(i) for i in range(800)] +
+            ['http://repo.org/org/path12/x', 'http://repo.org/'])
+        self.assertEqual('http://repo.org/org/path12/x',
+                         url_rewriter.match('http://repo.org/org/path12/x/a'))
+        self.assertEqual('http://repo.org/org/path12',
+                         url_rewriter.match('http://repo.org/org/path12/y'))
+        # the last segment of a prefix may be partial
+        self.assertEqual('http://repo.org/org/path799',
+                         url_rewriter.match('http://repo.org/org/path799a'))
+        self.assertEqual('http://repo.org/',
+                         url_rewriter.match('http://repo.org/org/other'))
+        self.assertIsNone(url_rewriter.match('http://repo.org'))
+
+    def test_find(self):
+        content = ("a: 'http://repo.org/org/a.rpm'\n"
+                   'b: "http://spec.org/spec/types.yaml"\n'
+                   'c: http://unrelated.org/x\n')
+        self.assertEqual(
+            ['http://repo.org/org/a.rpm', 'http://spec.org/spec/types.yaml'],
+            list(self.rewriter.find(content)))
+
+    def test_rewrite(self):
+        content = ("a: 'http://repo.org/org/a.rpm'\n"
+                   'c: http://unrelated.org/x\n')
+        new, urls = self.rewriter.rewrite(
+            content, lambda prefix, url: 'http://fs/' + url[len(prefix):])
+        self.assertEqual("a: 'http://fs//a.rpm'\nc: http://unrelated.org/x\n",
+                         new)
+        self.assertEqual(['http://repo.org/org/a.rpm'], urls)
+
+    def test_read_prefixes(self):
+        path = os.path.join(tempfile.mkdtemp(), 'prefixes')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('# mirrors\nhttp://a.org/x\n\n  http://b.org \n')
+        self.assertEqual(['http://a.org/x', 'http://b.org'],
+                         rewriter.read_prefixes(path))
+
+
+class TestBlueprint(testtools.TestCase):
+
+    def test_write_preserves_format(self):
+        path = os.path.join(tempfile.mkdtemp(), 'blueprint.yaml')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        content = ('# a comment\n'
+                   'tosca_definitions_version: cloudify_dsl_1_2\n'
+                   'inputs:\n'
+                   '  z: {default: 1}\n'
+                   '  a: {default: 2}\n')
+        blueprint.write(path, content)
+        with open(path) as f:
+            self.assertEqual(content, f.read())
+
+    def test_write_invalid(self):
+        path = os.path.join(tempfile.mkdtemp(), 'blueprint.yaml')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        self.assertRaises(
+            yaml.YAMLError, blueprint.write, path, 'inputs: [unclosed\n')
+        self.assertFalse(os.path.exists(path))
+
+    def test_index_urls(self):
+        content = ('# http://repository.cloudifysource.org/org/comment.rpm\n'
+                   'inputs:\n'
+                   '  rpm:\n'
+                   '    default: '
+                   '"HTTP://Repository.CloudifySource.org/org/a.rpm"\n'
+                   'node_templates:\n'
+                   '  manager:\n'
+                   '    properties:\n'
+                   '      urls:\n'
+                   '        - http://repository.cloudifysource.org/org/a.rpm\n'
+                   '        - http://example.com/b.rpm\n')
+        url_rewriter = rewriter.UrlRewriter(cloff.FILE_SERVER_MODIFIERS)
+        index = blueprint.UrlIndex()
+        urls = list(blueprint.index_urls(
+            content, url_rewriter, index, 'bp.yaml'))
+        url = 'http://repository.cloudifysource.org/org/a.rpm'
+        self.assertEqual([url], urls)
+        self.assertEqual([url], list(index))
+        first, second = index.locations[url]
+        self.assertEqual(('bp.yaml', ['inputs', 'rpm', 'default'], 4), first)
+        self.assertEqual('rpm', first.input)
+        self.assertEqual('manager', second.node)
+        self.assertEqual('properties.urls.0', second.property_path)
+        self.assertEqual(9, second.line)
+        # urls already in the index are not yielded again
+        self.assertEqual([], list(blueprint.index_urls(
+            content, url_rewriter, index, 'other.yaml')))
+        self.assertEqual(4, len(index.locations[url]))
+
+
+class TestSizeQueue(testtools.TestCase):
+
+    def test_order(self):
+        queue = pipeline.SizeQueue(held=True)
+        for item, size in (('a', 10), ('b', None), ('c', 30), ('d', 10),
+                           ('e', 20)):
+            queue.put(item, size=size)
+        taken = []
+        thread = threading.Thread(target=lambda: taken.append(queue.get()))
+        thread.start()
+        thread.join(0.1)
+        self.assertEqual([], taken)
+        # the smallest items are handed out while the queue is held
+        self.assertEqual('a', queue.get(smallest=True))
+        queue.release()
+        thread.join()
+        self.assertEqual(['b'], taken)
+        self.assertEqual(['c', 'e', 'd'], [queue.get() for _ in range(3)])
+        for _ in range(5):
+            queue.task_done()
+        queue.join()
+
+    def test_stop(self):
+        processed = []
+        started = threading.Event()
+        proceed = threading.Event()
+
+        def _process(item):
+            started.set()
+            proceed.wait()
+            processed.append(item)
+
+        pool = pipeline.WorkerPool(_process, 1,
+                                   queue=pipeline.SizeQueue(held=True))
+        for item in range(3):
+            pool.put(item, size=item)
+        pool.release()
+        started.wait()
+        stopping = threading.Thread(target=pool.stop)
+        stopping.start()
+        stopping.join(0.1)
+        # waiting for the item in progress
+        self.assertTrue(stopping.is_alive())
+        proceed.set()
+        stopping.join()
+        # only the item in progress was processed
+        self.assertEqual([2], processed)
+        self.assertTrue(all(not t.is_alive() for t in pool._threads))
+
+
+class TestArchiveWriter(testtools.TestCase):
+
+    def test_bounded_queue(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        writing = threading.Event()
+        proceed = threading.Event()
+
+        class SlowFile(StringIO):
+            def read(self, *args):
+                writing.set()
+                proceed.wait()
+                return StringIO.read(self, *args)
+
+        archive = pipeline.ArchiveWriter(
+            os.path.join(tmp, 'a.tar.gz'), os.path.join(tmp, 'root'),
+            maxsize=1)
+        archive.add_file('a', SlowFile('a'), 1)
+        writing.wait()
+        archive.add_file('b', StringIO('b'), 1)
+        # the archiver is busy and the queue is full
+        adding = threading.Thread(
+            target=archive.add_file, args=('c', StringIO('c'), 1))
+        adding.start()
+        adding.join(0.1)
+        self.assertTrue(adding.is_alive())
+        proceed.set()
+        adding.join()
+        archive.close()
+        with closing(tarfile.open(os.path.join(tmp, 'a.tar.gz'))) as tar:
+            self.assertEqual(['root/a', 'root/b', 'root/c'], tar.getnames())
+
+
+class TestTiming(testtools.TestCase):
+
+    def test_phases(self):
+        report = timing.Report('test')
+        for size in (10, 20):
+            with report.phase('download', size):
+                pass
+        with report.phase('download') as download:
+            download.bytes = 30
+        report.add('fetch', 2.0, size=100, count=4)
+        report.finish()
+        self.assertEqual(3, report.phases['download'].count)
+        self.assertEqual(60, report.phases['download'].bytes)
+        self.assertEqual(50.0, report.phases['fetch'].rate)
+        self.assertEqual(4, report.phases['fetch'].count)
+        self.assertLessEqual(report.phases['download'].wall,
+                             report.phases['download'].elapsed + 1e-3)
+
+    def test_phase_records_failures(self):
+        report = timing.Report()
+
+        def fail():
+            with report.phase('download'):
+                raise IOError()
+
+        self.assertRaises(IOError, fail)
+        self.assertEqual(1, report.phases['download'].count)
+
+
+class TestProfiling(testtools.TestCase):
+
+    def setUp(self):
+        super(TestProfiling, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def _work(self):
+        def busy():
+            sum(i * i for i in range(200000))
+        for i in range(2):
+            thread = threading.Thread(target=busy, name='worker-{0}'.format(i))
+            thread.start()
+            thread.join()
+
+    def _outputs(self):
+        return sorted(name for name in os.listdir(self.tmp)
+                      if name.startswith('profile.worker'))
+
+    def test_cprofile(self):
+        path = os.path.join(self.tmp, 'profile.pstats')
+        profiler = profiling.start(path, 'cprofile')
+        self._work()
+        profiler.stop()
+        # the threads of a pool share a file
+        self.assertEqual(['profile.worker.pstats'], self._outputs())
+        stats = pstats.Stats(
+            os.path.join(self.tmp, 'profile.worker.pstats'))
+        self.assertTrue(any(func[2] == 'busy' for func in stats.stats))
+        self.assertTrue(any(func[2] == 'busy'
+                            for func in pstats.Stats(path).stats))
+
+    def test_sample(self):
+        path = os.path.join(self.tmp, 'profile.folded')
+        profiler = profiling.start(path, 'sample', interval=0.001)
+        self._work()
+        profiler.stop()
+        self.assertEqual(['profile.worker.folded'], self._outputs())
+        with open(os.path.join(self.tmp, 'profile.worker.folded')) as f:
+            lines = f.read().splitlines()
+        stacks = dict(line.rsplit(' ', 1) for line in lines)
+        self.assertTrue(any('busy (test_cloff.py' in stack
+                            for stack in stacks))
+        self.assertTrue(all(int(count) for count in stacks.values()))
+        with open(path) as f:
+            self.assertIn('worker-0;', f.read())
+
+
+class TestLogger(testtools.TestCase):
+
+    def test_configure_deferred(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        log_file = os.path.join(tmp, 'logs', 'cloff.log')
+        handlers = logger.LOGGER['handlers']
+        self.addCleanup(handlers['file'].__setitem__, 'filename',
+                        handlers['file']['filename'])
+        handlers['file']['filename'] = log_file
+        self.addCleanup(handlers['console'].__setitem__, 'stream',
+                        handlers['console']['stream'])
+        handlers['console']['stream'] = 'ext://sys.stderr'
+        lgr = logging.getLogger('user')
+        self.addCleanup(setattr, lgr, 'handlers', [])
+        self.addCleanup(logger.stop)
+        logger.configure()
+        self.assertFalse(os.path.exists(os.path.dirname(log_file)))
+        lgr.info('first %s', 'record')
+        lgr.info('second record')
+        logger.flush()
+        with open(log_file) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertTrue(lines[0].endswith('INFO - first record'))
+
+    def test_lazy_imports(self):
+        code = (
+            'import sys\n'
+            'from cloff import cloff, logger\n'
+            'logger.configure()\n'
+            'try:\n'
+            '    cloff.main(["--help"])\n'
+            'except SystemExit:\n'
+            '    pass\n'
+            'sys.stderr.write(" ".join(m for m in {0!r}\n'
+            '                  if sys.modules.get(m)))\n').format(
+                ('yaml', 'cloff.dictconfig', 'cloff.server', 'cProfile'))
+        process = subprocess.Popen(
+            [sys.executable, '-c', code], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.dirname(cloff.__file__)))
+        out, err = process.communicate()
+        self.assertEqual(0, process.returncode, err)
+        self.assertIn('Usage:', out)
+        self.assertEqual('', err)
+
+    def test_queued_handlers(self):
+        records = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(self.format(record))
+
+        lgr = logging.getLogger('test-queued')
+        lgr.propagate = False
+        lgr.setLevel(logging.INFO)
+        lgr.addHandler(Handler())
+        logger.queue_handlers(lgr, batch_size=2)
+        self.addCleanup(logger.stop)
+        args = ['a']
+        lgr.info('args %s', args)
+        # arguments are rendered when logging, not when handling
+        args.append('b')
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            lgr.exception('failed')
+        for i in range(5):
+            lgr.debug('dropped %d', i)
+            lgr.warn('record %d', i)
+        logger.flush()
+        self.assertEqual("args ['a']", records[0])
+        self.assertTrue(records[1].startswith('failed\nTraceback'))
+        self.assertIn('ValueError: boom', records[1])
+        self.assertEqual(['record {0}'.format(i) for i in range(5)],
+                         records[2:])
+
+    def test_json_spans(self):
+        stream = StringIO()
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logger.JsonFormatter())
+        lgr = logging.getLogger('test-json')
+        lgr.propagate = False
+        lgr.setLevel(logging.INFO)
+        lgr.addHandler(handler)
+        with logger.span(lgr, 'download', 'http://x/a.rpm') as span:
+            span['bytes'] = 1024
+        with logger.span(lgr, 'download', 'http://x/b.rpm', logging.DEBUG):
+            pass
+        e = self.assertRaises(IOError, self._failing_span, lgr)
+        self.assertEqual('gone', str(e))
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(2, len(lines))
+        self.assertEqual(
+            ('download', 'http://x/a.rpm', 1024, 'ok'),
+            tuple(lines[0][field] for field in
+                  ('operation', 'url', 'bytes', 'outcome')))
+        self.assertTrue(lines[0]['duration'] >= 0)
+        self.assertEqual('IOError', lines[1]['outcome'])
+        self.assertNotIn('bytes', lines[1])
+
+    def _failing_span(self, lgr):
+        with logger.span(lgr, 'download', 'http://x/c.rpm'):
+            raise IOError('gone')
@@ -0,0 +1,117 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import time
+import threading
+
+
+class TokenBucket(object):
+    """A token bucket refilled at `rate` tokens (bytes) per second.
+
+    The bucket holds at most one second worth of tokens.
+
+    `reserve` never blocks. It takes the tokens right away, possibly
+    going into debt, and returns how long the caller has to wait before
+    using them. Callers are therefore served in the order they asked.
+    """
+
+    def __init__(self, rate, clock=time.time):
+        self._clock = clock
+        self._rate = self.capacity = self.tokens = float(rate)
+        self.last = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.last) * self._rate)
+        self.last = now
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate):
+        self._refill()
+        self._rate = self.capacity = float(rate)
+        self.tokens = min(self.tokens, self.capacity)
+
+    def reserve(self, amount):
+        self._refill()
+        self.tokens -= amount
+        return -self.tokens / self._rate if self.tokens < 0 else 0
+
+
+class BandwidthScheduler(object):
+    """Shares outgoing bandwidth fairly between clients.
+
+    Each client (identified by its address) gets its own token bucket.
+    When a total rate is set, it is split evenly between the clients
+    currently transferring, capped at the per client rate. A global
+    bucket additionally enforces the total rate.
+    """
+
+    def __init__(self, total_rate=None, client_rate=None, clock=time.time,
+                 sleep=time.sleep):
+        self.total_rate = total_rate
+        self.client_rate = client_rate
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._transfers = {}
+        self._buckets = {}
+        self._global = TokenBucket(total_rate, clock=clock) \
+            if total_rate else None
+
+    @property
+    def enabled(self):
+        return bool(self.total_rate or self.client_rate)
+
+    def _share(self):
+        rates = [r for r in (self.client_rate,) if r]
+        if self.total_rate:
+            rates.append(float(self.total_rate) / max(len(self._transfers), 1))
+        return min(rates)
+
+    def start(self, client):
+        with self._lock:
+            self._transfers[client] = self._transfers.get(client, 0) + 1
+            if client not in self._buckets:
+                self._buckets[client] = TokenBucket(
+                    self._share(), clock=self._clock)
+            self._rebalance()
+
+    def stop(self, client):
+        with self._lock:
+            self._transfers[client] -= 1
+            if not self._transfers[client]:
+                del self._transfers[client]
+                del self._buckets[client]
+            self._rebalance()
+
+    def _rebalance(self):
+        share = self._share()
+        for bucket in self._buckets.values():
+            bucket.rate = share
+
+    def throttle(self, client, amount):
+        """Blocks until `client` may send another `amount` bytes.
+        """
+        with self._lock:
+            delay = self._buckets[client].reserve(amount)
+            if self._global:
+                delay = max(delay, self._global.reserve(amount))
+        if delay:
+            self._sleep(delay)
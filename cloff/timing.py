@@ -0,0 +1,187 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from . import planner
+
+
+# not exposed by the resource module of python 2
+RUSAGE_THREAD = 1
+
+
+def thread_cpu_time():
+    """Returns the CPU time of the calling thread where the platform
+    supports it, and of the whole process otherwise.
+    """
+    if hasattr(time, 'thread_time'):
+        return time.thread_time()
+    if resource and sys.platform.startswith('linux'):
+        usage = resource.getrusage(RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    return time.clock()
+
+
+class Phase(object):
+    """Accumulated measurements of one phase of an operation.
+
+    Phases run concurrently in several threads, so `wall` is the sum of
+    the time spent in the phase by all threads while `elapsed` is the
+    time from the first entry to the last exit.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.bytes = 0
+        self.count = 0
+        self.first = None
+        self.last = None
+
+    @property
+    def elapsed(self):
+        return self.last - self.first if self.first is not None else 0.0
+
+    @property
+    def rate(self):
+        """Returns the bytes processed per second spent in the phase.
+        """
+        return self.bytes / self.wall if self.wall and self.bytes else None
+
+    def to_dict(self):
+        return {'wall_seconds': self.wall, 'cpu_seconds': self.cpu,
+                'elapsed_seconds': self.elapsed, 'bytes': self.bytes,
+                'count': self.count, 'bytes_per_second': self.rate}
+
+
+class Measurement(object):
+    """What the code inside a `Report.phase` block reports back.
+    """
+
+    def __init__(self, size=0):
+        self.bytes = size
+
+
+class Report(object):
+    """Records per-phase wall and CPU time, bytes processed and the rate
+    of every resource transfer of a cloff operation.
+
+    Measuring a phase costs two clock reads and a lock, so phases can be
+    as fine grained as a single download.
+    """
+
+    def __init__(self, operation=None):
+        self.operation = operation
+        self.phases = {}
+        self.transfers = []
+        self.started = time.time()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, size=0):
+        """Measures the enclosed block as part of phase `name`.
+
+        Yields a `Measurement` whose `bytes` can be set inside the block
+        if the size is not known in advance.
+        """
+        measurement = Measurement(size)
+        start, cpu = time.time(), thread_cpu_time()
+        try:
+            yield measurement
+        finally:
+            end = time.time()
+            self.add(name, end - start, thread_cpu_time() - cpu,
+                     measurement.bytes, start, end)
+
+    def add(self, name, wall, cpu=0.0, size=0, start=None, end=None,
+            count=1):
+        end = time.time() if end is None else end
+        start = end - wall if start is None else start
+        with self._lock:
+            phase = self.phases.get(name)
+            if not phase:
+                phase = self.phases[name] = Phase(name)
+            phase.wall += wall
+            phase.cpu += cpu
+            phase.bytes += size
+            phase.count += count
+            phase.first = start if phase.first is None \
+                else min(phase.first, start)
+            phase.last = end if phase.last is None else max(phase.last, end)
+
+    def transfer(self, url, size, seconds):
+        with self._lock:
+            self.transfers.append((url, size, seconds))
+
+    def finish(self):
+        self.finished = time.time()
+
+    @property
+    def total(self):
+        return (self.finished or time.time()) - self.started
+
+    def to_dict(self):
+        return {
+            'operation': self.operation,
+            'total_seconds': self.total,
+            'phases': dict((name, phase.to_dict())
+                           for name, phase in self.phases.items()),
+            'transfers': [
+                {'url': url, 'bytes': size, 'seconds': seconds,
+                 'bytes_per_second': size / seconds if seconds else None}
+                for url, size, seconds in sorted(self.transfers)],
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+    def render(self):
+        """Returns a table of the phases, in the order they started.
+        """
+        lines = ['{0:<12} {1:>9} {2:>9} {3:>9} {4:>7} {5:>9} {6:>11}'.format(
+            'PHASE', 'ELAPSED', 'WALL', 'CPU', 'COUNT', 'BYTES', 'RATE')]
+        for phase in sorted(self.phases.values(),
+                            key=lambda p: (p.first, p.name)):
+            lines.append(
+                '{0:<12} {1:>8.2f}s {2:>8.2f}s {3:>8.2f}s {4:>7} {5:>9} '
+                '{6:>11}'.format(
+                    phase.name, phase.elapsed, phase.wall, phase.cpu,
+                    phase.count, planner.format_size(phase.bytes),
+                    planner.format_size(phase.rate) + '/s'
+                    if phase.rate else '-'))
+        if self.transfers:
+            rates = sorted(size / seconds
+                           for _, size, seconds in self.transfers if seconds)
+            if rates:
+                lines.append('Transfers: {0}, rate min {1}/s, median {2}/s, '
+                             'max {3}/s'.format(
+                                 len(self.transfers),
+                                 planner.format_size(rates[0]),
+                                 planner.format_size(rates[len(rates) // 2]),
+                                 planner.format_size(rates[-1])))
+        lines.append('Total: {0:.2f}s'.format(self.total))
+        return '\n'.join(lines)
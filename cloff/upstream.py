@@ -0,0 +1,199 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import os
+import urllib2
+import urlparse
+import threading
+
+from . import logger
+
+
+RESOURCES_DIR = 'resources'
+CHUNK_SIZE = 64 * 1024
+UPSTREAM_TIMEOUT = 60
+
+lgr = logger.init()
+
+
+class Fetch(object):
+    """A single download of an upstream resource into the local cache.
+
+    The resource is written to `<destination>.part` and renamed once it
+    is complete. Any number of readers can stream it while it is still
+    being written.
+    """
+
+    def __init__(self, url, destination):
+        self.url = url
+        self.destination = destination
+        self.partial = destination + '.part'
+        self.status = None
+        self.headers = None
+        self.written = 0
+        self.done = False
+        self.error = None
+        self._cond = threading.Condition()
+
+    def _update(self, **attrs):
+        with self._cond:
+            for attr, value in attrs.items():
+                setattr(self, attr, value)
+            self._cond.notify_all()
+
+    def run(self):
+        with logger.span(lgr, 'upstream', self.url) as span:
+            self._fetch()
+            span['bytes'] = self.written
+            span['outcome'] = 'ok' if self.done and not self.error \
+                else self.status
+
+    def _fetch(self):
+        lgr.info('Fetching %s from upstream...', self.url)
+        try:
+            response = urllib2.urlopen(self.url, timeout=UPSTREAM_TIMEOUT)
+        except urllib2.HTTPError as ex:
+            lgr.warn('Upstream returned %s for %s', ex.code, self.url)
+            self._update(status=ex.code, done=True)
+            return
+        except Exception as ex:
+            lgr.error('Could not reach upstream for %s (%s)', self.url, ex)
+            self._update(status=502, error=ex, done=True)
+            return
+        try:
+            destination_dir = os.path.dirname(self.destination)
+            if not os.path.isdir(destination_dir):
+                os.makedirs(destination_dir)
+            with open(self.partial, 'wb') as f:
+                self._update(status=200, headers=response.info())
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    f.flush()
+                    with self._cond:
+                        self.written += len(chunk)
+                        self._cond.notify_all()
+            with self._cond:
+                os.rename(self.partial, self.destination)
+                self.done = True
+                self._cond.notify_all()
+            lgr.info('Cached %s (%s bytes)', self.destination, self.written)
+        except Exception as ex:
+            lgr.error('Failed fetching %s (%s)', self.url, ex)
+            # readers check for the error before opening the partial file
+            with self._cond:
+                if os.path.isfile(self.partial):
+                    os.remove(self.partial)
+                self._update(status=self.status or 502, error=ex, done=True)
+        finally:
+            response.close()
+
+    def wait_for_headers(self):
+        with self._cond:
+            while self.status is None:
+                self._cond.wait()
+        return self.status
+
+    def reader(self):
+        """Returns a `FetchReader` of the fetch, or None if it failed.
+        """
+        with self._cond:
+            if self.error:
+                return None
+            path = self.destination if self.done else self.partial
+            return FetchReader(self, open(path, 'rb'))
+
+
+class FetchReader(object):
+    """A file-like object following a `Fetch` as it is being written.
+    """
+
+    def __init__(self, fetch, f):
+        self._fetch = fetch
+        self._file = f
+        self._position = 0
+
+    def read(self, size=CHUNK_SIZE):
+        fetch = self._fetch
+        with fetch._cond:
+            while self._position >= fetch.written and not fetch.done:
+                fetch._cond.wait()
+            if fetch.error:
+                raise IOError('Upstream fetch of {0} failed ({1})'.format(
+                    fetch.url, fetch.error))
+            size = min(size, fetch.written - self._position)
+        data = self._file.read(size)
+        self._position += len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+class Upstream(object):
+    """A pull-through cache for the resources under `<root>/resources`.
+
+    `<root>/resources/<path>` maps to the first upstream prefix whose
+    path `<path>` starts with (e.g. `resources/org/x.rpm` is fetched from
+    `http://repository.cloudifysource.org/org/x.rpm`). Concurrent
+    requests for the same missing resource share a single fetch.
+    """
+
+    def __init__(self, root, prefixes):
+        self.root = root
+        self.prefixes = [urlparse.urlparse(p) for p in prefixes]
+        self._lock = threading.Lock()
+        self._fetches = {}
+
+    def url_for(self, path):
+        """Returns the upstream url for a local path, if there is one.
+        """
+        resources = os.path.join(self.root, RESOURCES_DIR) + os.sep
+        if not path.startswith(resources):
+            return None
+        url_path = '/' + path[len(resources):].replace(os.sep, '/')
+        for prefix in self.prefixes:
+            if url_path.startswith(prefix.path.rstrip('/') + '/'):
+                return '{0}://{1}{2}'.format(
+                    prefix.scheme, prefix.netloc, url_path)
+        return None
+
+    def fetch(self, path):
+        """Returns the (possibly in progress) fetch of `path`.
+
+        Returns None if `path` is not an upstream resource.
+        """
+        url = self.url_for(path)
+        if not url:
+            return None
+        with self._lock:
+            fetch = self._fetches.get(path)
+            if fetch:
+                lgr.debug('Joining in progress fetch of %s', url)
+                return fetch
+            fetch = self._fetches[path] = Fetch(url, path)
+        thread = threading.Thread(target=self._run, args=(fetch,))
+        thread.daemon = True
+        thread.start()
+        return fetch
+
+    def _run(self, fetch):
+        try:
+            fetch.run()
+        finally:
+            with self._lock:
+                del self._fetches[fetch.destination]
@@ -14,10 +14,17 @@
 #    * limitations under the License.
 
 import os
+import gzip
+import shutil
 import urllib
+import urllib2
+import hashlib
+import tempfile
 import tarfile
 import zipfile
 import sys
+import time
+import importlib
 from contextlib import closing
 
 from . import logger
@@ -32,13 +39,48 @@ IS_DARWIN = (PLATFORM == 'darwin')
 IS_LINUX = (PLATFORM == 'linux2')
 
 PROCESS_POLLING_INTERVAL = 0.1
+CHUNK_SIZE = 64 * 1024
+# seconds a connection or a read may stall before a download fails (and is
+# retried, see `hosts.Hosts`)
+DOWNLOAD_TIMEOUT = 60
+
+COMPRESSIBLE_EXTENSIONS = (
+    '.yaml', '.yml', '.json', '.sh', '.py', '.txt', '.conf', '.cfg',
+    '.ini', '.xml', '.j2', '.properties', '.html', '.css', '.js',
+)
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
 
 lgr = logger.init()
 
 
+class LazyModule(object):
+    """Stands in for a module which is imported when one of its
+    attributes is first used, so that commands which do not need a slow
+    to import dependency do not pay for it.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(importlib.import_module(self._name), attr)
+        # found right away from now on
+        setattr(self, attr, value)
+        return value
+
+
+def makedirs(path):
+    """Creates `path` unless it exists. Safe to call from several threads.
+    """
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
 def download_file(url, destination):
     def url_exists():
-        import urllib2
         try:
             urllib2.urlopen(url)
             return True
@@ -55,6 +97,99 @@ def download_file(url, destination):
     f.retrieve(final_url, destination)
 
 
+def open_url(url):
+    """Opens a url for reading. Returns None if it does not exist.
+
+    Connecting or reading fails once it stalls for `DOWNLOAD_TIMEOUT`
+    seconds.
+    """
+    try:
+        response = urllib2.urlopen(url, timeout=DOWNLOAD_TIMEOUT)
+    except urllib2.HTTPError as ex:
+        if ex.code == 404:
+            lgr.warn('%s does not exist. Skipping...', url)
+            return None
+        raise
+    if response.geturl() != url:
+        lgr.debug('Redirected to %s', response.geturl())
+    return response
+
+
+def head_url(url):
+    """Returns the headers of a url, fetched with a HEAD request, or None
+    if it does not exist.
+    """
+    request = urllib2.Request(url)
+    request.get_method = lambda: 'HEAD'
+    try:
+        response = urllib2.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+    except urllib2.HTTPError as ex:
+        if ex.code == 404:
+            return None
+        raise
+    with closing(response):
+        return response.info()
+
+
+def read_url(url):
+    """Returns the content of a url, or None if it does not exist.
+    """
+    response = open_url(url)
+    if not response:
+        return None
+    with closing(response):
+        return response.read()
+
+
+def download_to_spool(url, spool_size, on_read=None):
+    """Downloads a url into a temporary file object.
+
+    The content is kept in memory up to `spool_size` bytes and spills to
+    a temporary file beyond that. `on_read` is called with the size of
+    each chunk read and the time it took. Returns a `(fileobj, size, md5)`
+    tuple with the file object rewound, or None if the url does not exist.
+    """
+    response = open_url(url)
+    if not response:
+        return None
+    if on_read:
+        response = MeteredStream(response, on_read)
+    lgr.info('Downloading %s...', url)
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    md5 = hashlib.md5()
+    size = 0
+    with closing(response):
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            spool.write(chunk)
+            md5.update(chunk)
+            size += len(chunk)
+    spool.seek(0)
+    return spool, size, md5.hexdigest()
+
+
+def md5_fileobj(fileobj):
+    """Returns the md5 hex digest of the content of a file object.
+    """
+    md5 = hashlib.md5()
+    while True:
+        chunk = fileobj.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_size(fileobj):
+    position = fileobj.tell()
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(position)
+    return size
+
+
 def zip(source, destination):
     lgr.info('Creating zip archive: {0}...'.format(destination))
     with closing(zipfile.ZipFile(destination, 'w')) as zip:
@@ -76,9 +211,136 @@ def tar(source, destination):
 
 
 def untar(archive, destination):
-    """Extracts files from an archive to a destination folder.
+    """Extracts files from an archive to a destination folder and returns
+    the names of the extracted members.
     """
     lgr.debug('Extracting tar.gz {0} to {1}...'.format(archive, destination))
     with closing(tarfile.open(name=archive)) as tar:
         files = [f for f in tar.getmembers()]
         tar.extractall(path=destination, members=files)
+    return [f.name for f in files]
+
+
+def open_stream(source):
+    """Returns a readable stream of a local path or a url.
+    """
+    if os.path.isfile(source):
+        return open(source, 'rb')
+    lgr.info('Streaming {0}...'.format(source))
+    response = urllib2.urlopen(source)
+    if response.geturl() != source:
+        lgr.debug('Redirected to {0}'.format(response.geturl()))
+    return response
+
+
+class MeteredStream(object):
+    """Wraps a stream, calling `on_read` with the size of each read and
+    the time it took.
+    """
+
+    def __init__(self, stream, on_read):
+        self._stream = stream
+        self._on_read = on_read
+
+    def read(self, size=-1):
+        start = time.time()
+        data = self._stream.read(size)
+        self._on_read(len(data), time.time() - start)
+        return data
+
+    def close(self):
+        self._stream.close()
+
+
+def untar_stream(source, destination, include=None, on_read=None):
+    """Extracts members of a tar.gz archive while it is being read.
+
+    The archive (a local path or a url) is read once, sequentially,
+    without being written to disk. Only members for which `include`
+    returns True are extracted. `on_read` is called with the number of
+    bytes of each read from the source and the time it took. Returns the
+    names of the extracted members.
+    """
+    lgr.debug('Extracting tar.gz stream {0} to {1}...'.format(
+        source, destination))
+    extracted = []
+    stream = open_stream(source)
+    if on_read:
+        stream = MeteredStream(stream, on_read)
+    with closing(stream):
+        with closing(tarfile.open(fileobj=stream, mode='r|gz')) as tar:
+            for member in tar:
+                name = member.name
+                if name.startswith('/') or '..' in name.split('/'):
+                    lgr.warn('Skipping unsafe member {0}'.format(name))
+                    continue
+                if include and not include(name):
+                    continue
+                tar.extract(member, path=destination)
+                extracted.append(name)
+    return extracted
+
+
+def parse_size(size):
+    """Converts a size such as `512K`, `10M` or `1G` to bytes.
+    """
+    if not size:
+        return None
+    size = str(size).strip().upper().rstrip('B')
+    unit = size[-1] if size[-1] in SIZE_UNITS else ''
+    try:
+        return int(float(size[:len(size) - len(unit)]) * SIZE_UNITS[unit])
+    except ValueError:
+        raise ValueError('Invalid size: {0}'.format(size))
+
+
+def is_compressible(path):
+    return os.path.splitext(path)[1].lower() in COMPRESSIBLE_EXTENSIONS
+
+
+def gzip_file(path):
+    """Writes a gzip compressed `<path>.gz` variant next to `path`.
+
+    Returns its path, or None if it would not be smaller than `path`, in
+    which case there is no variant (not even a previous one).
+    """
+    destination = path + '.gz'
+    lgr.debug('Compressing {0} to {1}...'.format(path, destination))
+    with open(path, 'rb') as source:
+        with closing(gzip.open(destination, 'wb', 9)) as compressed:
+            shutil.copyfileobj(source, compressed)
+    if os.path.getsize(destination) >= os.path.getsize(path):
+        os.remove(destination)
+        return None
+    return destination
+
+
+def gzip_fileobj(fileobj, spool_size):
+    """Returns a rewound temporary file object with the gzip compressed
+    content of `fileobj`, which is rewound as well, or None if it would not
+    be smaller.
+    """
+    compressed = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    fileobj.seek(0)
+    with closing(gzip.GzipFile(
+            fileobj=compressed, mode='wb', compresslevel=9)) as gz:
+        shutil.copyfileobj(fileobj, gz, CHUNK_SIZE)
+    smaller = compressed.tell() < fileobj.tell()
+    fileobj.seek(0)
+    if not smaller:
+        compressed.close()
+        return None
+    compressed.seek(0)
+    return compressed
+
+
+def gzip_compressible_files(source):
+    """Precomputes `.gz` variants for all compressible files under `source`
+    which they make smaller.
+    """
+    lgr.info('Precomputing gzip variants under {0}...'.format(source))
+    for root, _, files in os.walk(source):
+        for f in files:
+            path = os.path.join(root, f)
+            if is_compressible(path):
+                gzip_file(path)
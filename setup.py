@@ -44,8 +44,6 @@ setup(
     },
     install_requires=[
         "click==6.2",
-        "pyyaml==3.10",
-        "sh==1.11",
-        "retrying==1.3.3"
+        "pyyaml==3.10"
     ]
 )